@@ -0,0 +1,11 @@
+import atexit
+import os
+
+from app.graph.csr import EDGE_KINDS, DocumentGraph
+from app.graph.frontier import DiscoveryFrontier
+from setting import setting
+
+document_graph = DocumentGraph(setting.GRAPH_DIR)
+atexit.register(document_graph.flush)
+discovery_frontier = DiscoveryFrontier(os.path.join(setting.GRAPH_DIR, 'frontier.json'))
+atexit.register(discovery_frontier.save)
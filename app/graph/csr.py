@@ -0,0 +1,460 @@
+import json
+import mmap
+import os
+import shutil
+import threading
+from array import array
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy import select
+
+from app.helper.db import LocalSession
+from app.helper.logger import setup_logger
+from app.helper.sql_export import stream_rows
+from app.model import Vbpl, VbplDocMap, VbplRelatedDocument
+
+_logger = setup_logger('graph_logger', 'log/graph.log')
+
+_manifest_file = 'manifest.json'
+# edge table -> (model, target column, type column)
+EDGE_KINDS = {
+    'related': (VbplRelatedDocument, VbplRelatedDocument.related_id, VbplRelatedDocument.doc_type),
+    'doc_map': (VbplDocMap, VbplDocMap.doc_map_id, VbplDocMap.doc_map_type),
+}
+
+
+def _write_json(path, value):
+    with open(path + '.tmp', 'w', encoding='utf-8') as json_file:
+        json.dump(value, json_file, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+
+
+class _Csr:
+    """
+    Adjacency of one direction of one edge table in compressed sparse row form:
+    the neighbors of node n are neighbors[offsets[n]:offsets[n + 1]], with the edge type codes alongside
+    """
+
+    def __init__(self, offsets, neighbors, types, buffers=()):
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.types = types
+        # mmaps and files behind the memoryviews, released on close
+        self._buffers = buffers
+
+    @classmethod
+    def build(cls, node_count, sources, targets, codes):
+        """
+        Counting sort of the edges by source
+        :param node_count: nodes are 0 .. node_count - 1
+        :param sources: array of source nodes
+        :param targets: array of target nodes, same length
+        :param codes: array of edge type codes, same length
+        """
+        offsets = array('Q', bytes(8 * (node_count + 1)))
+        for source in sources:
+            offsets[source + 1] += 1
+        for node in range(node_count):
+            offsets[node + 1] += offsets[node]
+
+        positions = array('Q', offsets[:-1]) if node_count else array('Q')
+        neighbors = array('I', bytes(4 * len(sources)))
+        types = array('H', bytes(2 * len(sources)))
+        for source, target, code in zip(sources, targets, codes):
+            position = positions[source]
+            neighbors[position] = target
+            types[position] = code
+            positions[source] = position + 1
+        return cls(offsets, neighbors, types)
+
+    @property
+    def node_count(self):
+        return len(self.offsets) - 1
+
+    def edges(self, node):
+        if node < 0 or node >= self.node_count:
+            return ()
+        start, end = self.offsets[node], self.offsets[node + 1]
+        return zip(self.neighbors[start:end], self.types[start:end])
+
+    def degree(self, node):
+        if node < 0 or node >= self.node_count:
+            return 0
+        return self.offsets[node + 1] - self.offsets[node]
+
+    def write(self, path, prefix):
+        for name, values in (('offsets', self.offsets), ('neighbors', self.neighbors), ('types', self.types)):
+            with open(os.path.join(path, f'{prefix}.{name}.bin'), 'wb') as array_file:
+                array_file.write(memoryview(values).cast('B'))
+
+    @classmethod
+    def open(cls, path, prefix):
+        """
+        Memory-map a written adjacency, nothing is read until it is queried
+        """
+        views = []
+        buffers = []
+        for name, type_code in (('offsets', 'Q'), ('neighbors', 'I'), ('types', 'H')):
+            array_file = open(os.path.join(path, f'{prefix}.{name}.bin'), 'rb')
+            if os.fstat(array_file.fileno()).st_size == 0:
+                array_file.close()
+                views.append(array(type_code))
+                continue
+            mapped = mmap.mmap(array_file.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(mapped).cast(type_code)
+            views.append(view)
+            buffers.append((view, mapped, array_file))
+        return cls(*views, buffers=buffers)
+
+    def close(self):
+        for view, mapped, array_file in self._buffers:
+            view.release()
+            mapped.close()
+            array_file.close()
+        self._buffers = ()
+
+
+class _EdgeSet:
+    """
+    Edges of one table: a compacted part in both directions plus the sources whose edges were replaced since
+    """
+
+    def __init__(self, outgoing, incoming):
+        self.outgoing = outgoing
+        self.incoming = incoming
+        # source -> {target: code}, replaces the compacted edges of the source
+        self.replaced = {}
+        # target -> {source: code}, reverse of replaced
+        self.replaced_incoming = {}
+
+    def out_edges(self, node):
+        replaced = self.replaced.get(node)
+        if replaced is not None:
+            return replaced.items()
+        return self.outgoing.edges(node)
+
+    def in_edges(self, node):
+        for source, code in self.incoming.edges(node):
+            if source not in self.replaced:
+                yield source, code
+        yield from self.replaced_incoming.get(node, {}).items()
+
+    def replace(self, source, edges):
+        for target in self.replaced.get(source, ()):
+            self.replaced_incoming[target].pop(source, None)
+        self.replaced[source] = edges
+        for target, code in edges.items():
+            self.replaced_incoming.setdefault(target, {})[source] = code
+
+    def all_edges(self):
+        for source in range(self.outgoing.node_count):
+            if source not in self.replaced:
+                for target, code in self.outgoing.edges(source):
+                    yield source, target, code
+        for source, edges in self.replaced.items():
+            for target, code in edges.items():
+                yield source, target, code
+
+    def close(self):
+        self.outgoing.close()
+        self.incoming.close()
+
+
+class DocumentGraph:
+    """
+    Amendment, replacement and consolidation graph of the vbpl, from vbpl_related_document and vbpl_doc_map.
+    The edges live in CSR arrays snapshotted to memory-mapped files, so loading is instant; the sources
+    changed since the snapshot (vbpl.updated_at moves with their edges) are reloaded from the database,
+    then the writer keeps the graph up to date after each commit.
+    """
+    # replaced sources kept beside the CSR arrays before they are compacted into new arrays
+    _max_replaced = 20000
+
+    def __init__(self, path):
+        self.path = path
+        self._edge_sets = {}
+        self._types = []
+        self._type_codes = {}
+        self._snapshot_time = None
+        self._dirty = False
+        self._lock = threading.RLock()
+        self._loaded = False
+        # set while the first load reads the database, the edges committed meanwhile wait for the lock
+        self._loading = False
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, _manifest_file))
+
+    def _type_code(self, edge_type):
+        code = self._type_codes.get(edge_type)
+        if code is None:
+            code = len(self._types)
+            self._types.append(edge_type)
+            self._type_codes[edge_type] = code
+        return code
+
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self._loading = True
+            try:
+                if self.exists():
+                    self._open_snapshot()
+                    self._catch_up()
+                else:
+                    self.rebuild()
+                self._loaded = True
+            finally:
+                self._loading = False
+
+    def _open_snapshot(self):
+        with open(os.path.join(self.path, _manifest_file), encoding='utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
+        self._types = manifest['types']
+        self._type_codes = {edge_type: code for code, edge_type in enumerate(self._types)}
+        self._snapshot_time = datetime.fromisoformat(manifest['snapshot_time'])
+        folder = os.path.join(self.path, manifest['folder'])
+        self._edge_sets = {kind: _EdgeSet(_Csr.open(folder, f'{kind}.out'), _Csr.open(folder, f'{kind}.in'))
+                           for kind in EDGE_KINDS.keys()}
+        _logger.info(f'Opened graph snapshot {folder} taken at {self._snapshot_time}')
+
+    def _catch_up(self):
+        """
+        Reload the edges of the vbpl touched after the snapshot
+        """
+        with LocalSession.begin() as session:
+            changed = [row[0] for row in session.query(Vbpl.id).filter(Vbpl.updated_at > self._snapshot_time)]
+            for kind, (model, target_column, type_column) in EDGE_KINDS.items():
+                edges_by_source = {source: {} for source in changed}
+                for start in range(0, len(changed), 1000):
+                    chunk = changed[start:start + 1000]
+                    for source, target, edge_type in session.query(model.source_id, target_column, type_column). \
+                            filter(model.source_id.in_(chunk)):
+                        edges_by_source[source][target] = self._type_code(edge_type)
+                for source, edges in edges_by_source.items():
+                    self._edge_sets[kind].replace(source, edges)
+        if changed:
+            self._dirty = True
+            _logger.info(f'Reloaded the edges of {len(changed)} vbpl changed since the snapshot')
+
+    def rebuild(self):
+        """
+        Load every edge from the database and write a new snapshot
+        :return: number of edges
+        """
+        with self._lock:
+            # taken before reading, edges written during the rebuild are reloaded by the next catch up
+            snapshot_time = datetime.now()
+            self._types = []
+            self._type_codes = {}
+            edge_lists = {}
+            with LocalSession.begin() as session:
+                for kind, (model, target_column, type_column) in EDGE_KINDS.items():
+                    sources, targets, codes = array('I'), array('I'), array('H')
+                    statement = select(model.source_id, target_column, type_column)
+                    for source, target, edge_type in stream_rows(session, statement, 10000):
+                        sources.append(source)
+                        targets.append(target)
+                        codes.append(self._type_code(edge_type))
+                    edge_lists[kind] = (sources, targets, codes)
+            count = self._write_snapshot(edge_lists, snapshot_time)
+            _logger.info(f'Rebuilt graph: {count} edges')
+            return count
+
+    def _write_snapshot(self, edge_lists, snapshot_time):
+        node_count = 1 + max([0] + [max(array_, default=0) for sources, targets, _ in edge_lists.values()
+                                    for array_ in (sources, targets)])
+        folder = f'snapshot-{snapshot_time:%Y%m%dT%H%M%S%f}'
+        os.makedirs(os.path.join(self.path, folder))
+        edge_sets = {}
+        for kind, (sources, targets, codes) in edge_lists.items():
+            outgoing = _Csr.build(node_count, sources, targets, codes)
+            incoming = _Csr.build(node_count, targets, sources, codes)
+            outgoing.write(os.path.join(self.path, folder), f'{kind}.out')
+            incoming.write(os.path.join(self.path, folder), f'{kind}.in')
+            edge_sets[kind] = _EdgeSet(outgoing, incoming)
+
+        previous = self._read_manifest_folder()
+        _write_json(os.path.join(self.path, _manifest_file), {
+            'folder': folder,
+            'snapshot_time': snapshot_time.isoformat(),
+            'types': self._types,
+        })
+        for edge_set in self._edge_sets.values():
+            edge_set.close()
+        self._edge_sets = edge_sets
+        self._snapshot_time = snapshot_time
+        self._dirty = False
+        if previous is not None and previous != folder:
+            shutil.rmtree(os.path.join(self.path, previous), ignore_errors=True)
+        return sum(len(sources) for sources, _, _ in edge_lists.values())
+
+    def _read_manifest_folder(self):
+        if not self.exists():
+            os.makedirs(self.path, exist_ok=True)
+            return None
+        with open(os.path.join(self.path, _manifest_file), encoding='utf-8') as manifest_file:
+            return json.load(manifest_file)['folder']
+
+    def compact(self):
+        """
+        Fold the replaced sources into new CSR arrays and snapshot them
+        """
+        with self._lock:
+            if not self._loaded or not self._dirty:
+                return
+            # the edges committed until now are all in memory
+            snapshot_time = datetime.now()
+            edge_lists = {}
+            for kind, edge_set in self._edge_sets.items():
+                sources, targets, codes = array('I'), array('I'), array('H')
+                for source, target, code in edge_set.all_edges():
+                    sources.append(source)
+                    targets.append(target)
+                    codes.append(code)
+                edge_lists[kind] = (sources, targets, codes)
+            count = self._write_snapshot(edge_lists, snapshot_time)
+            _logger.info(f'Compacted graph: {count} edges')
+
+    def flush(self):
+        if self._dirty:
+            self.compact()
+
+    def replace_edges(self, kind, source_id, edges):
+        """
+        Record the committed edges of a source, nothing to do while the graph is not loaded
+        since loading reads them from the database. During the first load they are applied once it is done,
+        the load may have read the database before they were committed.
+        :param kind: key of EDGE_KINDS
+        :param source_id:
+        :param edges: dict of target id -> edge type
+        """
+        if not self._loaded and not self._loading:
+            return
+        with self._lock:
+            if not self._loaded:
+                return
+            edge_set = self._edge_sets[kind]
+            edge_set.replace(int(source_id), {int(target): self._type_code(edge_type)
+                                              for target, edge_type in edges.items()})
+            self._dirty = True
+            if len(edge_set.replaced) >= self._max_replaced:
+                self.compact()
+
+    def add_edges(self, kind, source_id, edges):
+        """
+        Record committed edges added to a source, its other edges are kept
+        :param edges: dict of target id -> edge type
+        """
+        if not self._loaded and not self._loading:
+            return
+        with self._lock:
+            if not self._loaded:
+                return
+            edge_set = self._edge_sets[kind]
+            merged = dict(edge_set.out_edges(int(source_id)))
+            merged.update({int(target): self._type_code(edge_type) for target, edge_type in edges.items()})
+            edge_set.replace(int(source_id), merged)
+            self._dirty = True
+            if len(edge_set.replaced) >= self._max_replaced:
+                self.compact()
+
+    def _codes(self, types):
+        if types is None:
+            return None
+        return {self._type_codes[edge_type] for edge_type in types if edge_type in self._type_codes}
+
+    def _edges(self, node, direction, kinds, codes):
+        for kind in kinds or EDGE_KINDS.keys():
+            edge_set = self._edge_sets[kind]
+            edges = edge_set.out_edges(node) if direction == 'out' else edge_set.in_edges(node)
+            for neighbor, code in edges:
+                if codes is None or code in codes:
+                    yield neighbor, kind, code
+
+    def neighbors(self, doc_id, direction='out', kinds=None, types=None):
+        """
+        Edges of a vbpl, sample: neighbors(32801, 'in', ['related']) lists the documents pointing to 32801
+        :param doc_id:
+        :param direction: 'out' from doc_id, 'in' to doc_id
+        :param kinds: keys of EDGE_KINDS, default all
+        :param types: edge types (doc_type / doc_map_type) to follow, default all
+        :return: list of (doc id, kind, edge type)
+        """
+        self.ensure_loaded()
+        with self._lock:
+            return [(neighbor, kind, self._types[code])
+                    for neighbor, kind, code in self._edges(int(doc_id), direction, kinds, self._codes(types))]
+
+    def degree(self, doc_id, direction='out', kinds=None, types=None):
+        return len(self.neighbors(doc_id, direction, kinds, types))
+
+    def traverse(self, doc_id, direction='in', kinds=None, types=None, max_depth=None):
+        """
+        Breadth first transitive closure, sample: everything that amends 32801 directly or through
+        another amendment is traverse(32801, 'in', types=[<amendment edge type>])
+        :return: dict of reached doc id -> depth, doc_id itself excluded
+        """
+        self.ensure_loaded()
+        with self._lock:
+            codes = self._codes(types)
+            start = int(doc_id)
+            depths = {start: 0}
+            queue = deque([start])
+            while queue:
+                node = queue.popleft()
+                depth = depths[node]
+                if max_depth is not None and depth >= max_depth:
+                    continue
+                for neighbor, _, _ in self._edges(node, direction, kinds, codes):
+                    if neighbor not in depths:
+                        depths[neighbor] = depth + 1
+                        queue.append(neighbor)
+            del depths[start]
+            return depths
+
+    def shortest_path(self, source_id, target_id, direction='out', kinds=None, types=None, max_depth=None):
+        """
+        Shortest chain of edges between two vbpl
+        :return: list of doc ids from source_id to target_id, None if they are not connected
+        """
+        self.ensure_loaded()
+        with self._lock:
+            codes = self._codes(types)
+            source, target = int(source_id), int(target_id)
+            parents = {source: None}
+            depths = {source: 0}
+            queue = deque([source])
+            while queue and target not in parents:
+                node = queue.popleft()
+                if max_depth is not None and depths[node] >= max_depth:
+                    continue
+                for neighbor, _, _ in self._edges(node, direction, kinds, codes):
+                    if neighbor not in parents:
+                        parents[neighbor] = node
+                        depths[neighbor] = depths[node] + 1
+                        queue.append(neighbor)
+            if target not in parents:
+                return None
+            chain = []
+            node = target
+            while node is not None:
+                chain.append(node)
+                node = parents[node]
+            return chain[::-1]
+
+    def stats(self):
+        self.ensure_loaded()
+        with self._lock:
+            return {kind: sum(1 for _ in edge_set.all_edges()) for kind, edge_set in self._edge_sets.items()}
+
+    def close(self):
+        with self._lock:
+            for edge_set in self._edge_sets.values():
+                edge_set.close()
+            self._edge_sets = {}
+            self._loaded = False
@@ -0,0 +1,179 @@
+import heapq
+import json
+import os
+import threading
+
+from app.helper.enum import VbplType
+from app.helper.logger import setup_logger
+from app.helper.vbpl_index import known_vbpl_index
+
+_logger = setup_logger('frontier_logger', 'log/frontier.log')
+
+
+class DiscoveryFrontier:
+    """
+    Vbpl ids referenced by a related doc or doc map edge but not crawled yet, the most referenced first.
+    sync_edges skips the edges to missing vbpl, every entry keeps these edges so they are inserted once the row
+    of its vbpl commits (see VbplService.insert_pending_edges) instead of crawling their sources again.
+    Kept in a json file so the ids found by a crawl are not lost when it stops before draining them.
+    """
+    # a target failing this many times is dropped, it is usually a dead link
+    _max_attempts = 3
+
+    def __init__(self, path):
+        self.path = path
+        # doc id -> {'vbpl_type', 'edges': {kind: {source id: edge type}}, 'attempts'}
+        self._entries = {}
+        # entries popped and being crawled, their edges are still pending until the vbpl commits
+        self._crawling = {}
+        # (-number of edges, doc id), entries are pushed again when they get a new edge, stale items are
+        # skipped when popped
+        self._heap = []
+        # ids without a document behind them, not queued again when another edge references them
+        self._dropped = set()
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def __len__(self):
+        self.ensure_loaded()
+        return len(self._entries)
+
+    @staticmethod
+    def _priority(entry):
+        return -sum(len(edges) for edges in entry['edges'].values())
+
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            if os.path.exists(self.path):
+                with open(self.path, encoding='utf-8') as frontier_file:
+                    saved = json.load(frontier_file)
+                    self._dropped = set(saved['dropped'])
+                    for doc_id, entry in saved['entries'].items():
+                        self._entries[int(doc_id)] = {
+                            'vbpl_type': entry['vbpl_type'],
+                            'edges': {kind: {int(source): edge_type for source, edge_type in edges.items()}
+                                      for kind, edges in entry.get('edges', {}).items()},
+                            'attempts': entry['attempts'],
+                        }
+                self._heap = [(self._priority(entry), doc_id) for doc_id, entry in self._entries.items()]
+                heapq.heapify(self._heap)
+                _logger.info(f'Loaded {len(self._entries)} frontier entries')
+            self._loaded = True
+
+    def add(self, edges, target_type: VbplType, kind, source_id):
+        """
+        Record the edges of a source to vbpl that are not crawled yet, call it only once the edges are committed
+        :param edges: dict of target id skipped by sync_edges -> edge type
+        :param target_type: type to crawl the targets with
+        :param kind: key of EDGE_KINDS
+        :param source_id:
+        """
+        self.ensure_loaded()
+        added = 0
+        with self._lock:
+            for target, edge_type in edges.items():
+                target = int(target)
+                # crawled meanwhile, by the listing or by another discovery
+                if known_vbpl_index.contains(target) or target in self._dropped:
+                    continue
+                entry = self._crawling.get(target)
+                if entry is not None:
+                    entry['edges'].setdefault(kind, {})[int(source_id)] = edge_type
+                    continue
+                entry = self._entries.get(target)
+                if entry is None:
+                    entry = self._entries[target] = {'vbpl_type': target_type.name, 'edges': {}, 'attempts': 0}
+                    added += 1
+                entry['edges'].setdefault(kind, {})[int(source_id)] = edge_type
+                heapq.heappush(self._heap, (self._priority(entry), target))
+        if added:
+            _logger.info(f'Vbpl {source_id} references {added} new vbpl, frontier size {len(self._entries)}')
+
+    def pop(self):
+        """
+        :return: (doc id, entry) of the most referenced vbpl, None when the frontier is empty
+        """
+        self.ensure_loaded()
+        with self._lock:
+            while self._heap:
+                priority, doc_id = heapq.heappop(self._heap)
+                entry = self._entries.get(doc_id)
+                if entry is None or priority != self._priority(entry):
+                    continue
+                self._crawling[doc_id] = self._entries.pop(doc_id)
+                return doc_id, entry
+            return None
+
+    def pending_edges(self, doc_id):
+        """
+        :return: dict of kind -> {source id: edge type} of the edges waiting for doc_id, empty when none
+        """
+        self.ensure_loaded()
+        with self._lock:
+            entry = self._entries.get(int(doc_id)) or self._crawling.get(int(doc_id))
+            if entry is None:
+                return {}
+            return {kind: dict(edges) for kind, edges in entry['edges'].items() if edges}
+
+    def resolve(self, doc_id, inserted):
+        """
+        Forget the pending edges of doc_id that were inserted, the entry is removed once it has none left
+        :param inserted: dict of kind -> {source id: edge type}, as returned by pending_edges
+        """
+        doc_id = int(doc_id)
+        with self._lock:
+            entry = self._entries.get(doc_id) or self._crawling.get(doc_id)
+            if entry is None:
+                return
+            for kind, edges in inserted.items():
+                pending = entry['edges'].get(kind, {})
+                for source_id in edges:
+                    pending.pop(source_id, None)
+            if not any(entry['edges'].values()):
+                self._entries.pop(doc_id, None)
+                self._crawling.pop(doc_id, None)
+
+    def retry(self, doc_id, entry):
+        """
+        Put back a popped entry whose crawl failed
+        :return: False when it reached the maximum attempts and is dropped
+        """
+        entry['attempts'] += 1
+        if entry['attempts'] >= self._max_attempts:
+            _logger.warning(f'Drop vbpl {doc_id} from the frontier after {entry["attempts"]} failed attempts')
+            self.drop(doc_id)
+            return False
+        with self._lock:
+            self._crawling.pop(doc_id, None)
+            self._entries[doc_id] = entry
+            heapq.heappush(self._heap, (self._priority(entry), doc_id))
+        return True
+
+    def drop(self, doc_id):
+        """
+        Never queue this id again, its pending edges are forgotten
+        """
+        with self._lock:
+            self._entries.pop(int(doc_id), None)
+            self._crawling.pop(int(doc_id), None)
+            self._dropped.add(int(doc_id))
+
+    def save(self):
+        if not self._loaded:
+            return
+        with self._lock:
+            # the entries being crawled are saved too, their edges are lost otherwise if the crawl stops
+            entries = {str(doc_id): {'vbpl_type': entry['vbpl_type'],
+                                     'edges': {kind: {str(source): edge_type for source, edge_type in edges.items()}
+                                               for kind, edges in entry['edges'].items()},
+                                     'attempts': entry['attempts']}
+                       for doc_id, entry in list(self._entries.items()) + list(self._crawling.items())}
+            dropped = sorted(self._dropped)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as frontier_file:
+            json.dump({'entries': entries, 'dropped': dropped}, frontier_file, ensure_ascii=False)
+        os.replace(self.path + '.tmp', self.path)
@@ -0,0 +1,120 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import zipfile
+
+from app.helper.logger import setup_logger
+
+_logger = setup_logger('archive_logger', 'log/archive.log')
+
+# formats that are already compressed, deflating them again only burns cpu
+STORED_EXTENSIONS = {'.pdf', '.docx', '.xlsx', '.pptx', '.zip', '.rar', '.7z', '.gz', '.jpg', '.jpeg', '.png'}
+DUPLICATES_MANIFEST = 'duplicates.json'
+
+_chunk_size = 1024 * 1024
+
+
+def split_file_links(file_link):
+    """
+    vbpl.file_link and anle.file_link hold space separated paths, sample:
+    split_file_links('documents/pdf/a.pdf documents/doc/a.doc') -> ['documents/pdf/a.pdf', 'documents/doc/a.doc']
+    """
+    if not file_link:
+        return []
+    return file_link.split()
+
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as source:
+        while True:
+            chunk = source.read(_chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArchiveBuilder:
+    """
+    Zip archive writer for the preview bundles, zip64 when needed:
+    - identical files are stored once, the other paths are listed in duplicates.json
+    - already compressed formats are stored, the rest is deflated
+    - entries are written in path order so the same files give the same archive
+    Every file is hashed on a thread pool first, then read again when it is written. The entries are deflated
+    one after the other by zipfile, it has no public way to append data compressed elsewhere.
+    """
+
+    def __init__(self, archive_path, max_workers=None, compress_level=6):
+        self.archive_path = archive_path
+        self.max_workers = max_workers or min(8, os.cpu_count() or 1)
+        self.compress_level = compress_level
+        self._paths = {}
+
+    def add(self, path, arcname=None):
+        path = os.path.normpath(path)
+        if path in self._paths:
+            return
+        if not os.path.isfile(path):
+            _logger.warning(f'Skip missing file {path}')
+            return
+        self._paths[path] = (arcname or path).replace(os.sep, '/').lstrip('/')
+
+    def add_file_links(self, file_link):
+        for path in split_file_links(file_link):
+            self.add(path)
+
+    def _write_file(self, archive, path, arcname):
+        deflate = os.path.splitext(path)[1].lower() not in STORED_EXTENSIONS
+        archive.write(path, arcname, compress_type=zipfile.ZIP_DEFLATED if deflate else zipfile.ZIP_STORED,
+                      compresslevel=self.compress_level if deflate else None)
+        return archive.getinfo(arcname).file_size
+
+    def build(self):
+        """
+        Write the archive
+        :return: dict of file, duplicate and byte counts
+        """
+        paths = sorted(self._paths.items(), key=lambda item: item[1])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers,
+                                                   thread_name_prefix='archive') as executor:
+            futures = [executor.submit(_file_digest, path) for path, _ in paths]
+
+        files = 0
+        duplicates = {}
+        kept_by_digest = {}
+        total_size = 0
+        os.makedirs(os.path.dirname(self.archive_path) or '.', exist_ok=True)
+        with zipfile.ZipFile(self.archive_path, 'w') as archive:
+            for (path, arcname), future in zip(paths, futures):
+                try:
+                    digest = future.result()
+                    kept = kept_by_digest.get(digest)
+                    if kept is not None:
+                        duplicates[arcname] = kept
+                        total_size += os.path.getsize(path)
+                        continue
+                    total_size += self._write_file(archive, path, arcname)
+                except OSError as e:
+                    _logger.warning(f'Skip unreadable file {e}')
+                    continue
+                kept_by_digest[digest] = arcname
+                files += 1
+
+            if duplicates:
+                info = zipfile.ZipInfo(DUPLICATES_MANIFEST)
+                info.external_attr = 0o100644 << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                archive.writestr(info, json.dumps(duplicates, ensure_ascii=False, indent=2))
+                files += 1
+        archive_size = os.path.getsize(self.archive_path)
+
+        _logger.info(f'Archive {self.archive_path}: {files} entries, {len(duplicates)} duplicates, '
+                     f'{total_size} bytes in, {archive_size} bytes out')
+        return {
+            'files': files,
+            'duplicates': len(duplicates),
+            'input_bytes': total_size,
+            'archive_bytes': archive_size,
+        }
@@ -0,0 +1,203 @@
+from datetime import datetime
+
+from sqlalchemy import case, literal_column, not_, tuple_
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.orm import Session
+
+# keep every statement well below max_allowed_packet (32505856 in docker-compose.yml)
+_max_rows_per_statement = 500
+_max_statement_bytes = 16 * 1024 * 1024
+# columns that are only set once when the row is created
+_insert_only_columns = ('created_at', 'deleted_at')
+
+
+def estimate_row_size(row: dict):
+    size = 0
+    for value in row.values():
+        if value is None:
+            size += 4
+        elif isinstance(value, str):
+            size += len(value.encode('utf-8'))
+        elif isinstance(value, bytes):
+            size += len(value)
+        else:
+            size += len(str(value))
+    return size
+
+
+def iter_row_batches(rows, max_rows=_max_rows_per_statement, max_bytes=_max_statement_bytes):
+    """
+    Split rows into batches limited by row count and by estimated packet size
+    :param rows: list of dict
+    :param max_rows:
+    :param max_bytes:
+    :return: generator of list of dict
+    """
+    batch = []
+    batch_size = 0
+    for row in rows:
+        row_size = estimate_row_size(row)
+        if batch and (len(batch) >= max_rows or batch_size + row_size > max_bytes):
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(row)
+        batch_size += row_size
+    if batch:
+        yield batch
+
+
+def model_to_row(obj, now=None) -> dict:
+    row = obj.to_dict()
+    now = now or datetime.now()
+    if 'created_at' in row and row['created_at'] is None:
+        row['created_at'] = now
+    if 'updated_at' in row:
+        # onupdate is not applied by ON DUPLICATE KEY UPDATE so it has to be set explicitly
+        row['updated_at'] = now
+    return row
+
+
+def bulk_upsert(session: Session, model, rows, update_columns=None):
+    """
+    Write rows with multi-row INSERT ... ON DUPLICATE KEY UPDATE, sample:
+    bulk_upsert(session, VbplToanVan, [section.to_dict() for section in sections])
+    :param session:
+    :param model: mapped class, its primary key is used as the duplicate key
+    :param rows: list of dict, every dict must have the same keys
+    :param update_columns: columns to overwrite on duplicate, default all non primary key columns
+    :return: number of statements executed
+    """
+    if not rows:
+        return 0
+
+    table = model.__table__
+    if update_columns is None:
+        primary_keys = {column.name for column in table.primary_key.columns}
+        update_columns = [key for key in rows[0].keys()
+                          if key not in primary_keys and key not in _insert_only_columns]
+
+    hash_guarded_columns = getattr(model, 'hash_guarded_columns', {})
+    # MySQL applies the assignments left to right, guarded content must be compared before its hash is updated
+    update_columns = sorted(update_columns, key=lambda column: column not in hash_guarded_columns)
+
+    statement_count = 0
+    for batch in iter_row_batches(rows):
+        statement = insert(table).values(batch)
+        if update_columns:
+            assignments = []
+            for column in update_columns:
+                hash_column = hash_guarded_columns.get(column)
+                if hash_column is not None and hash_column in update_columns:
+                    # keep the stored content when its hash did not change, statement.inserted can not be used
+                    # for another column inside an expression (it renders VALUES() of the assigned column)
+                    new_hash = literal_column(f'VALUES({hash_column})')
+                    assignments.append((column, case(
+                        (table.c[hash_column].is_not_distinct_from(new_hash), table.c[column]),
+                        else_=statement.inserted[column])))
+                else:
+                    assignments.append((column, statement.inserted[column]))
+            statement = statement.on_duplicate_key_update(assignments)
+        else:
+            # nothing to update, turn the duplicate into a no-op
+            first_key = next(iter(table.primary_key.columns)).name
+            statement = statement.on_duplicate_key_update({first_key: statement.inserted[first_key]})
+        session.execute(statement)
+        statement_count += 1
+    return statement_count
+
+
+def delete_missing(session: Session, model, parent_criterion, key_columns, keep_keys):
+    """
+    Delete child rows of one parent whose key is not in keep_keys, sample:
+    delete_missing(session, VbplToanVan, VbplToanVan.vbpl_id == 1, [VbplToanVan.section_number], [(1,), (2,)])
+    :param session:
+    :param model:
+    :param parent_criterion: criterion selecting all children of the parent
+    :param key_columns: list of columns identifying a child inside its parent
+    :param keep_keys: list of tuples, same order as key_columns
+    :return: number of deleted rows
+    """
+    query = session.query(model).filter(parent_criterion)
+    keep_keys = list(keep_keys)
+    if keep_keys:
+        if len(key_columns) == 1:
+            keep_criterion = key_columns[0].in_([key[0] for key in keep_keys])
+        else:
+            keep_criterion = tuple_(*key_columns).in_(keep_keys)
+        query = query.filter(not_(keep_criterion))
+    return query.delete(synchronize_session=False)
+
+
+def sync_edges(session: Session, model, source_column, target_column, type_column, source_id, edges: dict,
+               target_model=None):
+    """
+    Make the edges of one source equal to `edges` with a set-based diff, sample:
+    sync_edges(session, VbplRelatedDocument, VbplRelatedDocument.source_id, VbplRelatedDocument.related_id,
+               VbplRelatedDocument.doc_type, 1, {2: 'Văn bản căn cứ'})
+    :param session:
+    :param model: edge model
+    :param source_column:
+    :param target_column:
+    :param type_column:
+    :param source_id:
+    :param edges: dict of target id -> edge type
+    :param target_model: if given, edges to targets missing from this model are skipped (foreign key)
+    :return: tuple of (inserted, updated, deleted, skipped) target ids
+    """
+    existing = dict(session.query(target_column, type_column).filter(source_column == source_id).all())
+
+    skipped = []
+    if target_model is not None:
+        new_targets = [target for target in edges.keys() if target not in existing]
+        if new_targets:
+            known_targets = {row[0] for row in
+                             session.query(target_model.id).filter(target_model.id.in_(new_targets)).all()}
+            skipped = [target for target in new_targets if target not in known_targets]
+
+    skipped_set = set(skipped)
+    inserted = [target for target in edges.keys() if target not in existing and target not in skipped_set]
+    updated = [target for target in edges.keys() if target in existing and existing[target] != edges[target]]
+    deleted = [target for target in existing.keys() if target not in edges]
+
+    if inserted:
+        bulk_upsert(session, model, [{source_column.key: source_id,
+                                      target_column.key: target,
+                                      type_column.key: edges[target]} for target in inserted])
+
+    # one UPDATE per distinct edge type
+    targets_by_type = {}
+    for target in updated:
+        targets_by_type.setdefault(edges[target], []).append(target)
+    for edge_type, targets in targets_by_type.items():
+        session.query(model).filter(source_column == source_id, target_column.in_(targets)). \
+            update({type_column.key: edge_type}, synchronize_session=False)
+
+    if deleted:
+        session.query(model).filter(source_column == source_id, target_column.in_(deleted)). \
+            delete(synchronize_session=False)
+
+    return inserted, updated, deleted, skipped
+
+
+def upsert_changed(session: Session, model, parent_criterion, key_columns, rows):
+    """
+    Upsert only the children of one parent whose content_hash changed, then delete the children
+    that are not in rows anymore. Rows must carry content_hash, see Base.compute_content_hash
+    :param session:
+    :param model: model having a content_hash column
+    :param parent_criterion: criterion selecting all children of the parent
+    :param key_columns: list of columns identifying a child inside its parent
+    :param rows: list of dict
+    :return: number of upserted and deleted rows
+    """
+    key_names = [column.key for column in key_columns]
+    stored_hashes = {tuple(row[:-1]): row[-1] for row in
+                     session.query(*key_columns, model.content_hash).filter(parent_criterion).all()}
+
+    changed_rows = [row for row in rows
+                    if stored_hashes.get(tuple(row[key] for key in key_names)) != row['content_hash']]
+    bulk_upsert(session, model, changed_rows)
+    deleted = delete_missing(session, model, parent_criterion, key_columns, [tuple(row[key] for key in key_names)
+                                                                             for row in rows])
+    return len(changed_rows) + deleted
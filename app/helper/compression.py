@@ -0,0 +1,135 @@
+import zlib
+
+from sqlalchemy.dialects.mysql import LONGBLOB, LONGTEXT
+from sqlalchemy.types import TypeDecorator
+
+from app.helper.logger import setup_logger
+from setting import setting
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_logger = setup_logger('compression_logger', 'log/compression.log')
+
+# first byte of a compressed value, plain text has no header (utf-8 text never starts with these control bytes);
+# HEADER_RAW is only read, plain text was written with it before the columns could stay LONGTEXT
+HEADER_RAW = b'\x00'
+HEADER_ZLIB = b'\x01'
+HEADER_ZSTD = b'\x02'
+
+CODEC_NONE = 'none'
+CODEC_ZLIB = 'zlib'
+CODEC_ZSTD = 'zstd'
+CODECS = (CODEC_NONE, CODEC_ZLIB, CODEC_ZSTD)
+
+
+def get_default_codec():
+    codec = (setting.DB_COMPRESSION or CODEC_NONE).lower()
+    if codec not in CODECS:
+        _logger.warning(f'Unknown DB_COMPRESSION {codec}, storing uncompressed')
+        return CODEC_NONE
+    if codec == CODEC_ZSTD and zstandard is None:
+        _logger.warning('DB_COMPRESSION is zstd but zstandard is not installed, falling back to zlib')
+        return CODEC_ZLIB
+    return codec
+
+
+def compress_text(text: str, codec=None, level=None) -> bytes:
+    """
+    Encode text for a compressed column, sample: compress_text('<div>...</div>', 'zlib')
+    :param text:
+    :param codec: none, zlib or zstd, default DB_COMPRESSION
+    :param level: compression level, default DB_COMPRESSION_LEVEL
+    :return: bytes with a one byte codec header, plain utf-8 for none
+    """
+    if text is None:
+        return None
+    codec = codec or get_default_codec()
+    level = level if level is not None else setting.DB_COMPRESSION_LEVEL
+    data = text.encode('utf-8')
+
+    if codec == CODEC_ZLIB:
+        return HEADER_ZLIB + zlib.compress(data, level if level > 0 else 6)
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError('zstandard is required to write zstd compressed values')
+        compressor = zstandard.ZstdCompressor(level=level if level > 0 else 3)
+        return HEADER_ZSTD + compressor.compress(data)
+    return data
+
+
+def decompress_text(value) -> str:
+    """
+    Decode a value of a compressed column, also reads plain utf-8 text written before compression
+    :param value: bytes
+    :return: str
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value
+
+    value = bytes(value)
+    header = value[:1]
+    if header == HEADER_ZLIB:
+        return zlib.decompress(value[1:]).decode('utf-8')
+    if header == HEADER_ZSTD:
+        if zstandard is None:
+            raise RuntimeError('zstandard is required to read zstd compressed values')
+        return zstandard.ZstdDecompressor().decompress(value[1:]).decode('utf-8')
+    if header == HEADER_RAW:
+        return value[1:].decode('utf-8')
+    return value.decode('utf-8')
+
+
+def stored_codec(value):
+    """
+    Codec a stored value was written with
+    :param value: bytes
+    :return: none, zlib, zstd or None for plain text written with HEADER_RAW
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return CODEC_NONE
+    header = bytes(value[:1])
+    if header == HEADER_ZLIB:
+        return CODEC_ZLIB
+    if header == HEADER_ZSTD:
+        return CODEC_ZSTD
+    if header == HEADER_RAW:
+        return None
+    return CODEC_NONE
+
+
+def text_column_type(codec=None):
+    """
+    Column type of the text stored with codec, text stays LONGTEXT when it is not compressed
+    :param codec: none, zlib or zstd, default DB_COMPRESSION
+    """
+    if (codec or get_default_codec()) == CODEC_NONE:
+        return LONGTEXT(collation='utf8mb4_unicode_ci')
+    return LONGBLOB()
+
+
+class CompressedText(TypeDecorator):
+    """
+    Text compressed with the DB_COMPRESSION codec on write and decompressed on read, so models and services keep
+    working with str. The column is a LONGTEXT written as is while DB_COMPRESSION is none, the recompress command
+    (MaintenanceService.recompress_text) turns it into a LONGBLOB when a codec is set.
+    """
+    impl = LONGTEXT
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        return dialect.type_descriptor(text_column_type())
+
+    def process_bind_param(self, value, dialect):
+        if get_default_codec() == CODEC_NONE:
+            return value
+        return compress_text(value)
+
+    def process_result_value(self, value, dialect):
+        return decompress_text(value)
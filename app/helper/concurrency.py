@@ -0,0 +1,369 @@
+import asyncio
+import contextlib
+import threading
+import time
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+import aiohttp
+import requests
+
+from app.helper.logger import setup_logger
+from setting import setting
+
+_logger = setup_logger('concurrency_logger', 'log/concurrency.log')
+
+# errors telling the host is overloaded, other errors leave the limit alone
+_overload_errors = (asyncio.TimeoutError, aiohttp.ServerDisconnectedError, aiohttp.ClientConnectorError,
+                    requests.Timeout, requests.ConnectionError)
+
+
+def is_overload_status(status):
+    return status == HTTPStatus.TOO_MANY_REQUESTS or status >= HTTPStatus.INTERNAL_SERVER_ERROR
+
+
+class RequestOutcome:
+    """
+    Set by the caller inside a limiter slot, the status of the response if there is one
+    """
+
+    def __init__(self):
+        self.status = None
+
+
+class SharedLimit:
+    """
+    Fixed number of slots shared by the coroutines of every crawl thread, each thread runs its own event loop.
+    A coroutine waiting for a slot polls on its loop like AimdLimiter, the other coroutines of the loop go on.
+    """
+    _poll_interval = 0.05
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = max(1, limit)
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def _try_acquire(self):
+        with self._lock:
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                return True
+            return False
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """
+        async with limit.slot(): ...
+        """
+        while not self._try_acquire():
+            await asyncio.sleep(self._poll_interval)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+class AimdLimiter:
+    """
+    In-flight request limit of one host, shared by the crawl threads, adapted like TCP congestion control:
+    - additive increase: +1 per `limit` healthy responses, so about +1 per round of requests, while the limit
+      is used up and the recent latency stays under latency_tolerance times the usual latency
+    - multiplicative decrease: x decrease_factor on a timeout, a dropped connection, a 5xx or a 429, at most
+      once per round (the recent latency) so a burst of failures of the same round only counts once
+    """
+    _latency_tolerance = 2.0
+    # weights of the last response in the recent and the usual latency averages
+    _recent_weight = 0.2
+    _usual_weight = 0.02
+    # how often a waiting coroutine checks for a free slot, slots are released by other threads too
+    _poll_interval = 0.05
+
+    def __init__(self, host, initial_limit, min_limit=1, max_limit=64, decrease_factor=0.5):
+        self.host = host
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.limit = float(min(max_limit, max(min_limit, initial_limit)))
+        self.in_flight = 0
+        self.successes = 0
+        self.overloads = 0
+        self.decreases = 0
+        self._recent_latency = None
+        self._usual_latency = None
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def _try_acquire(self):
+        with self._condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    async def acquire(self):
+        while not self._try_acquire():
+            await asyncio.sleep(self._poll_interval)
+
+    def acquire_blocking(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait(self._poll_interval)
+            self.in_flight += 1
+
+    def release(self, latency, overloaded, failed=False):
+        """
+        :param latency: seconds
+        :param overloaded: the host answered it is overloaded
+        :param failed: the request failed for another reason (cancelled, bad url), only frees the slot
+        """
+        with self._condition:
+            self.in_flight -= 1
+            previous = int(self.limit)
+            # the limit only grows when it is what holds the requests back
+            saturated = self.in_flight + 1 >= previous
+            now = time.monotonic()
+            if overloaded:
+                self.overloads += 1
+                if now - self._last_decrease >= (self._recent_latency or 0):
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+                    self.decreases += 1
+            elif not failed:
+                self.successes += 1
+                if self._recent_latency is None:
+                    self._recent_latency = self._usual_latency = latency
+                else:
+                    self._recent_latency += self._recent_weight * (latency - self._recent_latency)
+                if self._recent_latency <= self._latency_tolerance * self._usual_latency:
+                    # the usual latency only learns from healthy periods, a slowdown does not become usual
+                    self._usual_latency += self._usual_weight * (latency - self._usual_latency)
+                    if saturated:
+                        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            current = int(self.limit)
+            self._condition.notify_all()
+        if current != previous:
+            _logger.info(f'{self.host} limit {previous} -> {current}')
+
+    def _finish(self, start, outcome, error):
+        overloaded = isinstance(error, _overload_errors) or \
+            (outcome.status is not None and is_overload_status(outcome.status))
+        self.release(time.monotonic() - start, overloaded, error is not None)
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """
+        async with limiter.slot() as outcome: ... outcome.status = resp.status
+        """
+        await self.acquire()
+        outcome = RequestOutcome()
+        start = time.monotonic()
+        try:
+            yield outcome
+        except BaseException as e:
+            self._finish(start, outcome, e)
+            raise
+        self._finish(start, outcome, None)
+
+    @contextlib.contextmanager
+    def blocking_slot(self):
+        """
+        Same as slot for the synchronous requests
+        """
+        self.acquire_blocking()
+        outcome = RequestOutcome()
+        start = time.monotonic()
+        try:
+            yield outcome
+        except BaseException as e:
+            self._finish(start, outcome, e)
+            raise
+        self._finish(start, outcome, None)
+
+    def metrics(self):
+        with self._condition:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'successes': self.successes,
+                'overloads': self.overloads,
+                'decreases': self.decreases,
+                'recent_latency': self._recent_latency,
+                'usual_latency': self._usual_latency,
+            }
+
+
+class HostLimiters:
+    """
+    One AimdLimiter per upstream host (vbpl.vn, bientap.vbpl.vn, concetti, thuvienphapluat, luatvietnam),
+    created on the first request to the host. Their metrics, with the circuit of the host, can be reported
+    every few seconds during a crawl by a reporter thread.
+    """
+
+    def __init__(self, initial_limit, max_limit, breakers=None):
+        self.initial_limit = initial_limit
+        self.max_limit = max_limit
+        self.breakers = breakers
+        self._limiters = {}
+        self._lock = threading.Lock()
+        self._reporter = None
+        self._stop_reporting = threading.Event()
+
+    def get(self, url) -> AimdLimiter:
+        host = urlsplit(str(url)).netloc.lower()
+        limiter = self._limiters.get(host)
+        if limiter is None:
+            with self._lock:
+                limiter = self._limiters.get(host)
+                if limiter is None:
+                    limiter = self._limiters[host] = AimdLimiter(host, self.initial_limit,
+                                                                 max_limit=self.max_limit)
+        return limiter
+
+    def metrics(self):
+        """
+        :return: dict of host -> limiter metrics and circuit state
+        """
+        with self._lock:
+            limiters = list(self._limiters.values())
+        metrics = {limiter.host: limiter.metrics() for limiter in limiters}
+        if self.breakers is not None:
+            for host, breaker_metrics in self.breakers.metrics().items():
+                metrics.setdefault(host, {}).update(breaker_metrics)
+        return metrics
+
+    def format_metrics(self):
+        """
+        :return: one line per host, sample: vbpl.vn: limit 12, in_flight 9, ..., circuit closed, circuit_opens 0
+        """
+        return [f'{host}: ' + ', '.join(f'{name} {value:.3f}' if isinstance(value, float) else f'{name} {value}'
+                                        for name, value in metrics.items())
+                for host, metrics in sorted(self.metrics().items())]
+
+    def log_metrics(self):
+        for line in self.format_metrics():
+            _logger.info(line)
+
+    def start_reporting(self, interval, report=None):
+        """
+        Report the metrics every interval seconds until stop_reporting, nothing when interval is 0
+        :param report: callable run by the reporter thread, default log_metrics
+        """
+        if interval <= 0 or self._reporter is not None:
+            return
+        report = report or self.log_metrics
+        self._stop_reporting.clear()
+
+        def run():
+            while not self._stop_reporting.wait(interval):
+                report()
+
+        self._reporter = threading.Thread(target=run, name='host-metrics', daemon=True)
+        self._reporter.start()
+
+    def stop_reporting(self):
+        if self._reporter is not None:
+            self._stop_reporting.set()
+            self._reporter.join()
+            self._reporter = None
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a host that fails all of them:
+    - closed: requests go through, failure_threshold failures in a row open it
+    - open: requests fail fast for open_seconds, doubled every time it opens again, up to max_open_seconds
+    - half open: once open_seconds passed, one request goes through and closes or opens it again
+    """
+
+    def __init__(self, host, failure_threshold=10, open_seconds=30, max_open_seconds=600):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._open_for = open_seconds
+        self._probing = False
+        self.opens = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        return 'half_open' if time.monotonic() - self._opened_at >= self._open_for else 'open'
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self._open_for:
+                return False
+            # half open: one request goes through, the next one waits another open period unless this one
+            # closes the circuit, so a probe that never reports back does not keep it open for good
+            self._opened_at = time.monotonic()
+            self._probing = True
+            return True
+
+    def record(self, failed):
+        with self._lock:
+            if not failed:
+                if self._opened_at is not None:
+                    _logger.info(f'{self.host} circuit closed')
+                self._failures = 0
+                self._opened_at = None
+                self._open_for = self.open_seconds
+                self._probing = False
+                return
+            self._failures += 1
+            if self._probing:
+                # the probe failed, stay open longer
+                self._open_for = min(self.max_open_seconds, self._open_for * 2)
+                self._opened_at = time.monotonic()
+                self._probing = False
+                self.opens += 1
+                _logger.warning(f'{self.host} circuit opened again for {self._open_for}s')
+            elif self._opened_at is None and self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self.opens += 1
+                _logger.warning(f'{self.host} circuit opened for {self._open_for}s after {self._failures} failures')
+
+
+class HostCircuitBreakers:
+    """
+    One CircuitBreaker per upstream host, created on the first request to the host
+    """
+
+    def __init__(self):
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, url) -> CircuitBreaker:
+        host = urlsplit(str(url)).netloc.lower()
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(host, CircuitBreaker(host))
+        return breaker
+
+    def states(self):
+        """
+        :return: dict of host -> closed, open or half_open
+        """
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.host: breaker.state for breaker in breakers}
+
+    def metrics(self):
+        """
+        :return: dict of host -> circuit state and number of times it opened
+        """
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.host: {'circuit': breaker.state, 'circuit_opens': breaker.opens} for breaker in breakers}
+
+
+host_breakers = HostCircuitBreakers()
+host_limiters = HostLimiters(setting.CRAWL_MAX_THREADS, setting.CRAWL_MAX_HOST_CONCURRENCY, host_breakers)
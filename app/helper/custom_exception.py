@@ -1,4 +1,4 @@
-from app.helper.enum import ObjectNotFoundType
+from app.helper.enum import CrawlErrorKind, ObjectNotFoundType
 
 
 class CommonException(Exception):
@@ -16,3 +16,13 @@ class CommonException(Exception):
 class ObjectNotFound(CommonException):
     def __init__(self, obj: ObjectNotFoundType):
         super().__init__(code=404, message=f"{obj.value} not found")
+
+
+class UpstreamError(CommonException):
+    """
+    Request to a source that failed after its retries, or was not sent because the circuit of the host is open
+    """
+
+    def __init__(self, kind: CrawlErrorKind, url, reason):
+        super().__init__(code=502, message=f"{kind.value} error calling {url}: {reason}")
+        self.kind = kind
@@ -1,3 +1,6 @@
+import asyncio
+import concurrent.futures
+import functools
 import time
 import logging
 from sqlalchemy import create_engine, event
@@ -7,9 +10,16 @@ from setting import setting
 
 _logger = logging.getLogger(__name__)
 
-db_engine = create_engine(setting.SQLALCHEMY_DATABASE_URI, pool_pre_ping=True)
+# every crawl thread can wait on one query while the batch writer flushes, keep a spare connection for both
+DB_POOL_SIZE = setting.DB_POOL_SIZE or setting.CRAWL_MAX_THREADS + 2
+
+db_engine = create_engine(setting.SQLALCHEMY_DATABASE_URI, pool_pre_ping=True,
+                          pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_SIZE // 2)
 LocalSession = sessionmaker(autocommit=True, autoflush=True, bind=db_engine, expire_on_commit=False)
 
+# dedicated threads for blocking database work so it never runs on an event loop
+_db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='db')
+
 
 def open_db_session() -> Session:
     return LocalSession()
@@ -21,3 +31,24 @@ def db_session():
         yield session
     finally:
         session.close()
+
+
+async def run_in_db(func, *args, **kwargs):
+    """
+    Run a blocking database function on the db thread pool, sample:
+    sector = await run_in_db(run_in_session, lambda session: session.query(Vbpl.sector).first())
+    :param func:
+    :param args:
+    :param kwargs:
+    :return: result of func
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+
+
+def run_in_session(func, *args, **kwargs):
+    """
+    Run func(session, *args, **kwargs) inside its own transaction
+    """
+    with LocalSession.begin() as session:
+        return func(session, *args, **kwargs)
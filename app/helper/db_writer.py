@@ -0,0 +1,214 @@
+import asyncio
+import atexit
+import queue
+import threading
+import time
+
+from app.helper.bulk_upsert import bulk_upsert
+from app.helper.db import LocalSession, run_in_db
+from app.helper.logger import setup_logger
+from app.model.base import Base
+
+_logger = setup_logger('db_writer_logger', 'log/db_writer.log')
+
+
+class WriteUnit:
+    """
+    Everything one crawled document wants to persist, written atomically
+    upserts: list of (model, list of row dict) or (model, list of row dict, update columns),
+             written with bulk_upsert
+    ops: list of callable(session), run after the upserts in submit order
+    after_commit: list of callable(), run once the unit is committed
+    on_failure: list of callable(error), run when the unit could not be written even alone, so the caller can
+                record it for a retry (see DeadLetterStore.record)
+    """
+
+    def __init__(self, upserts=None, ops=None, after_commit=None, on_failure=None):
+        self.upserts = upserts or []
+        self.ops = ops or []
+        self.after_commit = after_commit or []
+        self.on_failure = on_failure or []
+
+    @property
+    def row_count(self):
+        return sum(len(upsert[1]) for upsert in self.upserts) + len(self.ops)
+
+
+class DbBatchWriter:
+    """
+    Write-behind batcher shared by all crawl threads. Units submitted by many documents are
+    grouped into one transaction when flush_rows rows are pending or flush_interval seconds passed.
+    submit blocks when max_pending_units units are waiting, which slows the crawl down to the
+    speed of the database instead of piling up memory.
+    A unit failing inside a group is written again alone, a unit failing alone is dropped, counted in
+    failed_units and handed to its on_failure callbacks.
+    """
+    _stop = object()
+    # how often asubmit checks for room in the queue while the writer is behind
+    _poll_interval = 0.05
+
+    def __init__(self, flush_rows=2000, flush_interval=2.0, max_pending_units=256):
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_pending_units)
+        self._flush_requested = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.failed_units = 0
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='db-batch-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, upserts=None, ops=None, after_commit=None, on_failure=None):
+        unit = WriteUnit(upserts, ops, after_commit, on_failure)
+        if unit.row_count == 0:
+            return
+        self._ensure_started()
+        # blocks while the writer is behind (back-pressure)
+        self._queue.put(unit)
+
+    async def asubmit(self, upserts=None, ops=None, after_commit=None, on_failure=None):
+        """
+        Same as submit but waits for back-pressure on the event loop, a db thread blocked on the queue would be
+        missing to the writer and the reads
+        """
+        unit = WriteUnit(upserts, ops, after_commit, on_failure)
+        if unit.row_count == 0:
+            return
+        self._ensure_started()
+        while True:
+            try:
+                self._queue.put_nowait(unit)
+                return
+            except queue.Full:
+                await asyncio.sleep(self._poll_interval)
+
+    async def aflush(self):
+        await run_in_db(self.flush)
+
+    def flush(self):
+        """
+        Block until every submitted unit is written
+        """
+        if self._thread is None:
+            return
+        self._flush_requested.set()
+        self._queue.join()
+
+    def close(self):
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._flush_requested.set()
+        self._queue.put(self._stop)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            item = self._queue.get()
+            if item is self._stop:
+                self._queue.task_done()
+                break
+
+            units = [item]
+            row_count = item.row_count
+            deadline = time.monotonic() + self.flush_interval
+            while row_count < self.flush_rows and not self._flush_requested.is_set():
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is self._stop:
+                    self._queue.task_done()
+                    stopped = True
+                    break
+                units.append(item)
+                row_count += item.row_count
+
+            # drain whatever is already queued when a flush was asked for
+            while self._flush_requested.is_set() and not stopped:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    self._flush_requested.clear()
+                    break
+                if item is self._stop:
+                    self._queue.task_done()
+                    stopped = True
+                    break
+                units.append(item)
+
+            self._write(units)
+            for _ in units:
+                self._queue.task_done()
+
+    def _write(self, units):
+        try:
+            with LocalSession.begin() as session:
+                self._write_units(session, units)
+            _logger.info(f'Flushed {len(units)} units, {sum(unit.row_count for unit in units)} rows')
+            self._run_after_commit(units)
+            return
+        except Exception as e:
+            if len(units) == 1:
+                self._fail(units[0], e)
+                return
+            _logger.warning(f'Grouped write of {len(units)} units failed, retrying one by one: {e}')
+
+        # isolate the failing unit so it does not take the others with it
+        for unit in units:
+            try:
+                with LocalSession.begin() as session:
+                    self._write_units(session, [unit])
+            except Exception as e:
+                self._fail(unit, e)
+                continue
+            self._run_after_commit([unit])
+
+    def _fail(self, unit, error):
+        self.failed_units += 1
+        _logger.error(f'Write unit failed, {self.failed_units} failed so far: {error}', exc_info=error)
+        for callback in unit.on_failure:
+            try:
+                callback(error)
+            except Exception as e:
+                _logger.exception(f'On failure callback failed {e}')
+
+    @staticmethod
+    def _run_after_commit(units):
+        for unit in units:
+            for callback in unit.after_commit:
+                try:
+                    callback()
+                except Exception as e:
+                    _logger.exception(f'After commit callback failed {e}')
+
+    def _write_units(self, session, units):
+        # rows of the same model and the same update columns go into the same statements
+        rows_by_key = {}
+        for unit in units:
+            for upsert in unit.upserts:
+                model, rows = upsert[0], upsert[1]
+                update_columns = tuple(upsert[2]) if len(upsert) > 2 and upsert[2] is not None else None
+                rows_by_key.setdefault((model, update_columns), []).extend(rows)
+
+        # parents before children so foreign keys are satisfied
+        table_order = {table: index for index, table in enumerate(Base.metadata.sorted_tables)}
+        for model, update_columns in sorted(rows_by_key, key=lambda key: table_order.get(key[0].__table__, 0)):
+            bulk_upsert(session, model, rows_by_key[(model, update_columns)],
+                        list(update_columns) if update_columns is not None else None)
+
+        for unit in units:
+            for op in unit.ops:
+                op(session)
+
+
+db_writer = DbBatchWriter()
+atexit.register(db_writer.close)
@@ -0,0 +1,162 @@
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete
+
+from app.helper.custom_exception import UpstreamError
+from app.helper.db import LocalSession, run_in_db
+from app.helper.db_writer import db_writer
+from app.helper.enum import CrawlErrorKind, CrawlStage, VbplType
+from app.helper.logger import setup_logger
+from app.model import CrawlDeadLetter
+
+_logger = setup_logger('dead_letter_logger', 'log/dead_letter.log')
+
+# what a page that does not look like expected raises while it is parsed
+_parse_errors = (AttributeError, IndexError, KeyError, TypeError, ValueError)
+
+
+def classify_error(error: BaseException) -> CrawlErrorKind:
+    """
+    Kind of a crawl failure, the crawl functions wrap the original error in a CommonException so the chain
+    of causes is followed
+    """
+    while error is not None:
+        if isinstance(error, UpstreamError):
+            return error.kind
+        if isinstance(error, _parse_errors):
+            return CrawlErrorKind.PARSE
+        error = error.__cause__ or error.__context__
+    return CrawlErrorKind.OTHER
+
+
+class DeadLetterStore:
+    """
+    Crawl steps that failed for one page or one document, kept in crawl_dead_letter to be retried later
+    instead of failing the whole listing page. A step is retried with a backoff depending on the kind of error,
+    a page that did not parse is unlikely to parse again soon; it is given up after _max_attempts.
+    A step that succeeds in a normal crawl also deletes its dead letter, the keys of the stored ones are
+    kept in memory so the other steps cost nothing.
+    """
+    _max_attempts = 5
+    _max_retry_delay = timedelta(days=7)
+    # first delay before retrying, doubled after every failed attempt
+    _retry_delay = {
+        CrawlErrorKind.NETWORK: timedelta(minutes=15),
+        CrawlErrorKind.SERVER: timedelta(minutes=15),
+        CrawlErrorKind.CIRCUIT_OPEN: timedelta(minutes=15),
+        CrawlErrorKind.PARSE: timedelta(days=1),
+        CrawlErrorKind.OTHER: timedelta(hours=1),
+    }
+
+    def __init__(self):
+        # (stage, item id, vbpl type) of the stored dead letters
+        self._recorded = set()
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            with LocalSession.begin() as session:
+                self._recorded = {tuple(row) for row in session.query(
+                    CrawlDeadLetter.stage, CrawlDeadLetter.item_id, CrawlDeadLetter.vbpl_type)}
+            self._loaded = True
+
+    def _record_op(self, stage: CrawlStage, item_id, vbpl_type: VbplType, error: BaseException):
+        kind = classify_error(error)
+        now = datetime.now()
+        key = (stage.value, int(item_id), vbpl_type.name)
+        _logger.warning(f'{stage.value} {item_id} ({vbpl_type.name}) failed with a {kind.value} error: {error}')
+        with self._lock:
+            self._recorded.add(key)
+
+        def write(session):
+            dead_letter = session.get(CrawlDeadLetter, key)
+            if dead_letter is None:
+                dead_letter = CrawlDeadLetter(stage=key[0], item_id=key[1], vbpl_type=key[2], attempts=0,
+                                              first_failed_at=now)
+                session.add(dead_letter)
+            dead_letter.attempts += 1
+            dead_letter.error_kind = kind.value
+            dead_letter.error_message = str(error)
+            dead_letter.last_failed_at = now
+            dead_letter.next_retry_at = now + min(self._max_retry_delay,
+                                                  self._retry_delay[kind] * 2 ** (dead_letter.attempts - 1))
+        return write
+
+    async def arecord(self, stage: CrawlStage, item_id, vbpl_type: VbplType, error: BaseException):
+        """
+        Record a failed step through the batch writer, a step failing again counts one more attempt
+        """
+        await db_writer.asubmit(ops=[self._record_op(stage, item_id, vbpl_type, error)])
+
+    def record(self, stage: CrawlStage, item_id, vbpl_type: VbplType, error: BaseException):
+        """
+        Same as arecord in its own transaction, for the write units that the batch writer failed to commit
+        """
+        try:
+            with LocalSession.begin() as session:
+                self._record_op(stage, item_id, vbpl_type, error)(session)
+        except Exception as e:
+            _logger.exception(f'Recording {stage.value} {item_id} failed {e}')
+
+    @staticmethod
+    def _delete_op(key):
+        return lambda session: session.execute(
+            delete(CrawlDeadLetter.__table__).where(CrawlDeadLetter.stage == key[0],
+                                                    CrawlDeadLetter.item_id == key[1],
+                                                    CrawlDeadLetter.vbpl_type == key[2]))
+
+    def _discard(self, key):
+        with self._lock:
+            self._recorded.discard(key)
+
+    async def aresolve(self, stage: CrawlStage, item_id, vbpl_type: VbplType):
+        """
+        Forget a step that succeeded without anything to write
+        """
+        key = (stage.value, int(item_id), vbpl_type.name)
+        self._discard(key)
+        await db_writer.asubmit(ops=[self._delete_op(key)])
+
+    async def aresolve_recorded(self, stage: CrawlStage, item_id, vbpl_type: VbplType):
+        """
+        Same as aresolve, nothing is written when the step has no dead letter
+        """
+        if not self._loaded:
+            await run_in_db(self.ensure_loaded)
+        if (stage.value, int(item_id), vbpl_type.name) in self._recorded:
+            await self.aresolve(stage, item_id, vbpl_type)
+
+    def resolve_in(self, stage: CrawlStage, item_id, vbpl_type: VbplType, ops, after_commit):
+        """
+        Delete the dead letter of a step, if it has one, in the write unit holding the result of the step,
+        so it only goes away when that result commits
+        :param ops: ops of the write unit
+        :param after_commit: after commit callbacks of the write unit
+        """
+        key = (stage.value, int(item_id), vbpl_type.name)
+        if key not in self._recorded:
+            return
+        ops.append(self._delete_op(key))
+        after_commit.append(lambda: self._discard(key))
+
+    def due(self, limit=None):
+        """
+        :return: list of (stage, item id, vbpl type) to retry now, oldest failure first
+        """
+        with LocalSession.begin() as session:
+            query = session.query(CrawlDeadLetter.stage, CrawlDeadLetter.item_id, CrawlDeadLetter.vbpl_type). \
+                filter(CrawlDeadLetter.next_retry_at <= datetime.now(),
+                       CrawlDeadLetter.attempts < self._max_attempts). \
+                order_by(CrawlDeadLetter.first_failed_at)
+            if limit is not None:
+                query = query.limit(limit)
+            return [(CrawlStage(stage), item_id, VbplType[vbpl_type]) for stage, item_id, vbpl_type in query]
+
+
+dead_letters = DeadLetterStore()
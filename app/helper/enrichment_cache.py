@@ -0,0 +1,101 @@
+import json
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete
+
+from app.helper.db import LocalSession, run_in_db
+from app.helper.db_writer import db_writer
+from app.helper.enum import EnrichmentSource
+from app.helper.logger import setup_logger
+from app.helper.utility import content_hash
+from app.helper.vbpl_resolver import resolver_key
+from app.model import EnrichmentCache
+from setting import setting
+
+_logger = setup_logger('enrichment_cache_logger', 'log/enrichment_cache.log')
+
+# returned by get when the source has to be searched
+MISS = object()
+
+
+def enrichment_key(serial_number, title):
+    """
+    Cache key of a document, the same serial number and title written differently share the key
+    """
+    return content_hash(resolver_key(serial_number or ''), resolver_key(title or ''))
+
+
+class EnrichmentCacheStore:
+    """
+    Persistent cache of the third-party searches made for every crawled vbpl.
+    A result is either a payload (found) or a "not found" marker, both expire after the ttl of their source;
+    a not found expires sooner since the source may publish the document later.
+    """
+    # source -> (found ttl, not found ttl)
+    _ttl = {
+        EnrichmentSource.CONCETTI: (timedelta(days=30), timedelta(days=7)),
+        EnrichmentSource.TVPL: (timedelta(days=90), timedelta(days=14)),
+        EnrichmentSource.LUAT_VN: (timedelta(days=90), timedelta(days=14)),
+    }
+
+    def __init__(self, force_refresh=False):
+        # ignore the cached results, the fresh results still overwrite them
+        self.force_refresh = force_refresh
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, source: EnrichmentSource, serial_number, title):
+        """
+        :return: payload dict, None for a cached "not found", MISS when the source has to be searched
+        """
+        if self.force_refresh:
+            return MISS
+        with LocalSession.begin() as session:
+            cached = session.query(EnrichmentCache.found, EnrichmentCache.payload). \
+                filter(EnrichmentCache.source == source.value,
+                       EnrichmentCache.lookup_key == enrichment_key(serial_number, title),
+                       EnrichmentCache.expires_at > datetime.now()).first()
+        if cached is None:
+            self.misses += 1
+            return MISS
+        self.hits += 1
+        if not cached.found:
+            return None
+        return json.loads(cached.payload) if cached.payload else {}
+
+    async def aget(self, source: EnrichmentSource, serial_number, title):
+        return await run_in_db(self.get, source, serial_number, title)
+
+    def to_row(self, source: EnrichmentSource, serial_number, title, payload):
+        now = datetime.now()
+        found_ttl, not_found_ttl = self._ttl[source]
+        return {
+            'source': source.value,
+            'lookup_key': enrichment_key(serial_number, title),
+            'serial_number': serial_number[:100] if serial_number else serial_number,
+            'title': title[:455] if title else title,
+            'found': payload is not None,
+            'payload': json.dumps(payload, ensure_ascii=False) if payload is not None else None,
+            'fetched_at': now,
+            'expires_at': now + (found_ttl if payload is not None else not_found_ttl),
+        }
+
+    async def aput(self, source: EnrichmentSource, serial_number, title, payload):
+        """
+        Cache the result of a search through the batch writer
+        :param payload: dict, None when the source does not have the document
+        """
+        await db_writer.asubmit([(EnrichmentCache, [self.to_row(source, serial_number, title, payload)])])
+
+    def purge_expired(self):
+        """
+        :return: number of deleted rows
+        """
+        with LocalSession.begin() as session:
+            count = session.execute(delete(EnrichmentCache.__table__).
+                                    where(EnrichmentCache.expires_at <= datetime.now())).rowcount
+        _logger.info(f'Purged {count} expired enrichment results')
+        return count
+
+
+enrichment_cache = EnrichmentCacheStore(setting.ENRICHMENT_CACHE_REFRESH)
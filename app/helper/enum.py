@@ -20,3 +20,24 @@ class VbplTab(Enum):
 class VbplType(Enum):
     PHAP_QUY = 'KetQuaTimKiemVanBan'
     HOP_NHAT = 'KetQuaTimKiemHopNhat'
+
+
+class EnrichmentSource(Enum):
+    CONCETTI = 'concetti'
+    TVPL = 'tvpl'
+    LUAT_VN = 'luatvietnam'
+
+
+class CrawlStage(Enum):
+    PAGE = 'page'
+    DOCUMENT = 'document'
+    RELATED_DOC = 'related_doc'
+    DOC_MAP = 'doc_map'
+
+
+class CrawlErrorKind(Enum):
+    NETWORK = 'network'
+    SERVER = 'server'
+    CIRCUIT_OPEN = 'circuit_open'
+    PARSE = 'parse'
+    OTHER = 'other'
@@ -0,0 +1,142 @@
+import bisect
+
+from rapidfuzz import process
+from rapidfuzz.distance import Indel
+
+from app.helper.vbpl_resolver import resolver_key
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Indel.normalized_similarity is Levenshtein.ratio
+_scorer = Indel.normalized_similarity
+# queries scored together in one cdist call, bounds the similarity matrix to rows x block size
+_max_group_size = 512
+# smaller candidate sets are scored whole, blocking only pays off on catalogs
+_min_blocking_size = 1000
+# a query is scored against the candidates sharing one of its rarest tokens, one token alone misses the
+# candidates where only that token is misspelled or missing
+_block_tokens = 3
+
+
+class CandidateSet:
+    """
+    Candidate strings prepared once for many batch_match calls, sorted by length inside token blocks. The blocks
+    are built from the folded keys, the scores from the original strings. A query is only scored against the
+    blocks of its _block_tokens rarest tokens, and only against the candidates whose length can reach the threshold.
+    """
+
+    def __init__(self, candidates):
+        self.candidates = [candidate or '' for candidate in candidates]
+        blocks = {}
+        if len(self.candidates) < _min_blocking_size:
+            # one block holding every candidate, under the empty token
+            blocks[''] = [index for index, candidate in enumerate(self.candidates) if candidate]
+        else:
+            for index, candidate in enumerate(self.candidates):
+                for token in set(resolver_key(candidate).split()):
+                    blocks.setdefault(token, []).append(index)
+        # token -> (candidate indexes, their lengths), both sorted by length
+        self._blocks = {}
+        for token, indexes in blocks.items():
+            indexes.sort(key=lambda candidate: len(self.candidates[candidate]))
+            self._blocks[token] = (indexes, [len(self.candidates[candidate]) for candidate in indexes])
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def block_tokens(self, key):
+        """
+        :return: tuple of the rarest tokens of key having a block, None when it has none
+        """
+        if '' in self._blocks:
+            return ('',)
+        tokens = sorted((token for token in set(key.split()) if token in self._blocks),
+                        key=lambda token: (len(self._blocks[token][0]), token))
+        return tuple(sorted(tokens[:_block_tokens])) or None
+
+    def block(self, tokens, min_length, max_length):
+        """
+        :return: sorted indexes of the candidates in the blocks of tokens whose length is in the window
+        """
+        block = set()
+        for token in tokens:
+            indexes, lengths = self._blocks[token]
+            start = bisect.bisect_left(lengths, min_length)
+            end = bisect.bisect_right(lengths, max_length)
+            block.update(indexes[start:end])
+        return sorted(block)
+
+
+def _length_window(length, threshold):
+    # ratio = 1 - distance / (l1 + l2) and distance >= |l1 - l2|, so l2 has to be in this window
+    if threshold <= 0:
+        return 0, float('inf')
+    return length * threshold / (2 - threshold), length * (2 - threshold) / threshold
+
+
+def _top(scored, limit):
+    scored.sort(key=lambda match: (-match[1], match[0]))
+    return scored[:limit]
+
+
+def batch_match(queries, candidates, threshold=0.8, limit=1):
+    """
+    Best candidates of every query by Levenshtein ratio, the folded keys only pick the candidates to score, sample:
+    batch_match(['Luật đất đai 2013'], ['Luật đất đai 2013', 'Luật nhà ở']) -> [[(0, 1.0)]]
+    Queries sharing a block are scored with one rapidfuzz cdist call when numpy is installed,
+    one rapidfuzz extract call per query otherwise, both run in C.
+    :param queries: list of str
+    :param candidates: list of str or CandidateSet
+    :param threshold: minimum ratio
+    :param limit: matches kept per query
+    :return: one list of (candidate index, ratio) per query, best first, empty when nothing reaches threshold
+    """
+    candidate_set = candidates if isinstance(candidates, CandidateSet) else CandidateSet(candidates)
+    results = [[] for _ in queries]
+
+    groups = {}
+    for query_index, query in enumerate(queries):
+        key = resolver_key(query) if query else ''
+        tokens = candidate_set.block_tokens(key) if key else None
+        if tokens is not None:
+            groups.setdefault(tokens, []).append((query_index, query))
+
+    for tokens, group in groups.items():
+        group.sort(key=lambda query: len(query[1]))
+        for start in range(0, len(group), _max_group_size):
+            chunk = group[start:start + _max_group_size]
+            if numpy is not None and len(chunk) > 1:
+                min_length = _length_window(len(chunk[0][1]), threshold)[0]
+                max_length = _length_window(len(chunk[-1][1]), threshold)[1]
+                block = candidate_set.block(tokens, min_length, max_length)
+                if not block:
+                    continue
+                matrix = process.cdist([query for _, query in chunk],
+                                       [candidate_set.candidates[index] for index in block],
+                                       scorer=_scorer, score_cutoff=threshold, dtype=numpy.float32, workers=-1)
+                for row, (query_index, _) in enumerate(chunk):
+                    # float32 scores, below the cutoff they are 0
+                    columns = numpy.nonzero(matrix[row] >= threshold - 1e-6)[0]
+                    results[query_index] = _top([(block[column], float(matrix[row][column]))
+                                                 for column in columns], limit)
+            else:
+                for query_index, query in chunk:
+                    block = candidate_set.block(tokens, *_length_window(len(query), threshold))
+                    if not block:
+                        continue
+                    matches = process.extract(query, [candidate_set.candidates[index] for index in block],
+                                              scorer=_scorer, score_cutoff=threshold, limit=limit)
+                    results[query_index] = _top([(block[position], score) for _, score, position in matches],
+                                                limit)
+    return results
+
+
+def best_match(query, candidates, threshold=0.8):
+    """
+    :return: (candidate index, ratio) of the most similar candidate, None when nothing reaches threshold
+    """
+    matches = batch_match([query], candidates, threshold)[0]
+    return matches[0] if matches else None
@@ -0,0 +1,215 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+
+import aiohttp
+
+from app.helper.concurrency import host_breakers, host_limiters, is_overload_status
+from app.helper.custom_exception import UpstreamError
+from app.helper.enum import CrawlErrorKind
+from app.helper.logger import setup_logger
+
+_logger = setup_logger('http_client_logger', 'log/http_client.log')
+
+
+_max_attempts = 3
+_max_retry_after = 60
+
+
+def _retry_delay(attempt, resp=None):
+    # a 429 tells how long to wait, otherwise 1s, 2s, ... with jitter so the crawl threads do not retry together
+    if resp is not None and resp.headers.get('Retry-After', '').isdigit():
+        return min(_max_retry_after, int(resp.headers['Retry-After']))
+    return 2 ** attempt + random.random()
+
+
+async def send_with_retries(url, send, max_attempts=_max_attempts):
+    """
+    Retry a request on network errors, 5xx and 429 under the circuit breaker of its host.
+    Other statuses, 404 included, are returned to the caller as they are.
+    :param url: url of the request, its host picks the circuit breaker
+    :param send: async callable(attempt) sending the request once and returning the response
+    :return: response
+    :raise UpstreamError: when every attempt failed or the circuit of the host is open
+    """
+    breaker = host_breakers.get(url)
+    kind, reason = None, None
+    for attempt in range(max_attempts):
+        if not breaker.allow():
+            raise UpstreamError(CrawlErrorKind.CIRCUIT_OPEN, url, f'circuit of {breaker.host} is open')
+        resp = None
+        try:
+            resp = await send(attempt)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            kind, reason = CrawlErrorKind.NETWORK, repr(e)
+        else:
+            if not is_overload_status(resp.status):
+                breaker.record(False)
+                return resp
+            kind, reason = CrawlErrorKind.SERVER, f'http {resp.status}'
+        breaker.record(True)
+        if attempt < max_attempts - 1:
+            _logger.warning(f'Calling {url} failed with {reason}, retrying (attempt {attempt + 1}/{max_attempts})')
+            await asyncio.sleep(_retry_delay(attempt, resp))
+    raise UpstreamError(kind, url, reason)
+
+
+async def _send(method, url, **kwargs):
+    async with host_limiters.get(url).slot() as outcome:
+        async with aiohttp.ClientSession(trust_env=True) as session:
+            async with session.request(method, url, **kwargs) as resp:
+                await resp.text()
+        outcome.status = resp.status
+    return resp
+
+
+async def fetch(method, url, **kwargs):
+    """
+    One request under the concurrency limit and the circuit breaker of its host, retried on network errors,
+    5xx and 429
+    :param kwargs: passed to aiohttp request
+    :return: aiohttp response with its body read
+    :raise UpstreamError:
+    """
+    return await send_with_retries(url, lambda attempt: _send(method, url, **kwargs))
+
+
+class LatencyTracker:
+    """
+    Latency of the last requests of every endpoint, shared by the crawl threads
+    """
+
+    def __init__(self, window=500, min_samples=20):
+        self.window = window
+        # percentiles of fewer samples are not trusted
+        self.min_samples = min_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds):
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None:
+                samples = self._samples[endpoint] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentiles(self, endpoint, *quantiles):
+        """
+        :param quantiles: between 0 and 1, sample: percentiles('/x', 0.5, 0.95)
+        :return: list of seconds, None when the endpoint does not have enough samples
+        """
+        with self._lock:
+            samples = sorted(self._samples.get(endpoint, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return [samples[min(len(samples) - 1, int(quantile * len(samples)))] for quantile in quantiles]
+
+    def stats(self):
+        """
+        :return: dict of endpoint -> (sample count, p50, p95, p99)
+        """
+        with self._lock:
+            endpoints = {endpoint: len(samples) for endpoint, samples in self._samples.items()}
+        stats = {}
+        for endpoint, count in endpoints.items():
+            values = self.percentiles(endpoint, 0.5, 0.95, 0.99)
+            if values is not None:
+                stats[endpoint] = (count, *values)
+        return stats
+
+
+class HedgedHttpClient:
+    """
+    Requests whose timeout follows the observed latency of their endpoint instead of a flat value:
+    - the timeout is a multiple of p99, within [min_timeout, max_timeout]; max_timeout until there are enough samples
+    - when hedging, a GET still running after p95 is sent a second time, the first response wins and the
+      other request is cancelled
+    - retried like fetch, the retries use max_timeout since the percentiles can lag behind a server getting slower
+    The response body is read before returning, like the callers expect.
+    """
+    _timeout_factor = 3
+
+    def __init__(self, name, hedge=True, min_timeout=10, max_timeout=90):
+        self.name = name
+        self.hedge = hedge
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.latency = LatencyTracker()
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def timeout(self, endpoint):
+        values = self.latency.percentiles(endpoint, 0.99)
+        if values is None:
+            return self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, values[0] * self._timeout_factor))
+
+    def hedge_delay(self, endpoint):
+        values = self.latency.percentiles(endpoint, 0.95)
+        return values[0] if values is not None else None
+
+    async def _fetch(self, endpoint, method, url, timeout, **kwargs):
+        async with host_limiters.get(url).slot() as outcome:
+            # started once the host has a free slot, waiting for it is not latency of the page
+            start = time.monotonic()
+            try:
+                async with aiohttp.ClientSession(trust_env=True) as session:
+                    async with session.request(method, url, timeout=timeout, **kwargs) as resp:
+                        await resp.text()
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                # slower than the timeout is still a sample, it pulls p99 and the next timeouts up
+                # a request cancelled because its hedge won took at least this long, leaving it out would
+                # keep only the fast side of the hedged requests and lower p95, hedging more and more
+                self.latency.record(endpoint, time.monotonic() - start)
+                raise
+            outcome.status = resp.status
+        self.latency.record(endpoint, time.monotonic() - start)
+        return resp
+
+    async def _hedged_fetch(self, endpoint, method, url, timeout, **kwargs):
+        first = asyncio.ensure_future(self._fetch(endpoint, method, url, timeout, **kwargs))
+        delay = self.hedge_delay(endpoint) if self.hedge and method == 'GET' else None
+        if delay is None or delay >= timeout:
+            return await first
+
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+        self.hedges += 1
+        second = asyncio.ensure_future(self._fetch(endpoint, method, url, timeout, **kwargs))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def request(self, method, url, endpoint=None, **kwargs):
+        """
+        :param method:
+        :param url:
+        :param endpoint: key of the latency samples, the url by default, should not contain ids
+        :param kwargs: passed to aiohttp request, except timeout
+        :return: aiohttp response with its body read
+        :raise UpstreamError:
+        """
+        endpoint = endpoint or url
+        timeout = self.timeout(endpoint)
+        return await send_with_retries(url, lambda attempt: self._hedged_fetch(
+            endpoint, method, url, timeout if attempt == 0 else self.max_timeout, **kwargs))
+
+    def log_stats(self):
+        for endpoint, (count, p50, p95, p99) in sorted(self.latency.stats().items()):
+            _logger.info(f'{self.name} {endpoint}: {count} samples, p50 {p50:.2f}s, p95 {p95:.2f}s, p99 {p99:.2f}s')
+        _logger.info(f'{self.name}: {self.hedges} hedged requests, {self.hedge_wins} won by the hedge')
@@ -0,0 +1,65 @@
+from pymysql.converters import escape_item
+from sqlalchemy.orm import Session
+
+_charset = 'utf8mb4'
+_max_rows_per_statement = 500
+# stay well below the default max_allowed_packet of the server the script is loaded into
+_max_statement_bytes = 4 * 1024 * 1024
+_yield_per = 1000
+
+
+def stream_rows(session: Session, statement, yield_per=_yield_per):
+    """
+    Iterate the rows of a select with a server side cursor, only yield_per rows are held in memory
+    :param session:
+    :param statement: select statement
+    :param yield_per:
+    :return: iterator of rows
+    """
+    result = session.execute(statement.execution_options(stream_results=True))
+    for partition in result.partitions(yield_per):
+        yield from partition
+
+
+def escape_value(value) -> str:
+    return escape_item(value, _charset)
+
+
+def write_insert_statements(dump_file, table_name, column_names, rows, on_row=None,
+                            max_rows=_max_rows_per_statement, max_bytes=_max_statement_bytes):
+    """
+    Write rows as escaped multi-row INSERT statements, sample:
+    write_insert_statements(dump_file, 'anle', ['id', 'title'], stream_rows(session, select(Anle.id, Anle.title)))
+    :param dump_file: text file opened for writing
+    :param table_name:
+    :param column_names: in the same order as the row values
+    :param rows: iterable of rows
+    :param on_row: called with every row after it is written
+    :param max_rows: rows per statement
+    :param max_bytes: approximate size of a statement
+    :return: number of written rows
+    """
+    header = f"INSERT INTO `{table_name}` ({', '.join(f'`{column}`' for column in column_names)}) VALUES\n"
+    values = []
+    values_size = 0
+    count = 0
+
+    def flush():
+        dump_file.write(header)
+        dump_file.write(',\n'.join(values))
+        dump_file.write(';\n')
+
+    for row in rows:
+        value = '(' + ', '.join(escape_value(item) for item in row) + ')'
+        if values and (len(values) >= max_rows or values_size + len(value) > max_bytes):
+            flush()
+            values = []
+            values_size = 0
+        values.append(value)
+        values_size += len(value)
+        count += 1
+        if on_row is not None:
+            on_row(row)
+    if values:
+        flush()
+    return count
@@ -0,0 +1,74 @@
+import atexit
+import json
+import os
+import threading
+
+from app.helper.enum import VbplTab, VbplType
+from app.helper.logger import setup_logger
+from setting import setting
+
+_logger = setup_logger('tab_probe_logger', 'log/tab_probe.log')
+
+
+class TabProbeOrder:
+    """
+    Which tab page of a vbpl held its file list, counted per vbpl type and doc type while crawling,
+    so the tab that usually has it is probed first. Doc types not seen yet fall back to the counts of
+    their vbpl type, then to the given order.
+    Kept in a json file next to the other crawl state so a new crawl starts with the counts of the previous ones.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # (vbpl type, doc type or None for every doc type) -> {tab: hits}
+        self._hits = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            if os.path.exists(self.path):
+                with open(self.path, encoding='utf-8') as probe_file:
+                    for entry in json.load(probe_file):
+                        self._hits[(VbplType[entry['vbpl_type']], entry['doc_type'])] = \
+                            {VbplTab[tab]: hits for tab, hits in entry['hits'].items()}
+                _logger.info(f'Loaded the tab hits of {len(self._hits)} vbpl / doc types')
+            self._loaded = True
+
+    def order(self, vbpl_type: VbplType, doc_type, tabs):
+        """
+        :param tabs: list of VbplTab, the default order
+        :return: the tabs, most hits first
+        """
+        self.ensure_loaded()
+        by_doc_type = self._hits.get((vbpl_type, doc_type), {}) if doc_type is not None else {}
+        by_vbpl_type = self._hits.get((vbpl_type, None), {})
+        return sorted(tabs, key=lambda tab: (-by_doc_type.get(tab, 0), -by_vbpl_type.get(tab, 0), tabs.index(tab)))
+
+    def record(self, vbpl_type: VbplType, doc_type, tab: VbplTab):
+        self.ensure_loaded()
+        with self._lock:
+            keys = [(vbpl_type, None)] if doc_type is None else [(vbpl_type, doc_type), (vbpl_type, None)]
+            for key in keys:
+                counts = self._hits.setdefault(key, {})
+                counts[tab] = counts.get(tab, 0) + 1
+
+    def save(self):
+        if not self._loaded:
+            return
+        with self._lock:
+            entries = [{'vbpl_type': vbpl_type.name, 'doc_type': doc_type,
+                        'hits': {tab.name: hits for tab, hits in counts.items()}}
+                       for (vbpl_type, doc_type), counts in self._hits.items()]
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as probe_file:
+            json.dump(entries, probe_file, ensure_ascii=False)
+        os.replace(self.path + '.tmp', self.path)
+
+
+tab_probe_order = TabProbeOrder(os.path.join(setting.GRAPH_DIR, 'tab_probe.json'))
+atexit.register(tab_probe_order.save)
@@ -1,3 +1,4 @@
+import hashlib
 import re
 from datetime import datetime
 
@@ -102,3 +103,16 @@ def check_header_tag(tag):
     if re.search('h\\d+', tag):
         return True
     return False
+
+
+def content_hash(*values):
+    """
+    Hash of text content used to skip rewriting unchanged rows, sample: content_hash(vbpl.html)
+    :param values:
+    :return: 32 chars hex string
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for value in values:
+        digest.update(b'\x00' if value is None else str(value).encode('utf-8'))
+        digest.update(b'\x1f')
+    return digest.hexdigest()
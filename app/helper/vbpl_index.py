@@ -0,0 +1,146 @@
+import hashlib
+import threading
+from array import array
+from datetime import datetime
+
+from app.helper.db import LocalSession
+from app.helper.logger import setup_logger
+from app.model import Vbpl
+
+_logger = setup_logger('vbpl_index_logger', 'log/vbpl_index.log')
+
+# columns covered by the fingerprint, html is covered through html_hash, the sections are not part of it
+FINGERPRINT_COLUMNS = (
+    'file_link',
+    'title',
+    'sub_title',
+    'doc_type',
+    'serial_number',
+    'issuance_date',
+    'effective_date',
+    'expiration_date',
+    'gazette_date',
+    'state',
+    'issuing_authority',
+    'applicable_information',
+    'sector',
+    'org_pdf_link',
+    'html_hash',
+)
+
+
+def vbpl_fingerprint(values, overrides=None) -> int:
+    """
+    64 bit fingerprint of the metadata and the html hash of a vbpl
+    :param values: Vbpl object or query row having FINGERPRINT_COLUMNS
+    :param overrides: dict of column -> value written since values were read, sample: {'sector': 'Đất đai'}
+    :return: int, never 0 (0 marks an unknown fingerprint)
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for column in FINGERPRINT_COLUMNS:
+        value = overrides[column] if overrides and column in overrides else getattr(values, column)
+        if isinstance(value, datetime):
+            value = value.strftime('%Y-%m-%d %H:%M:%S')
+        digest.update(b'\x00' if value is None else str(value).encode('utf-8'))
+        digest.update(b'\x1f')
+    return int.from_bytes(digest.digest(), 'big') or 1
+
+
+class KnownVbplIndex:
+    """
+    Compact in-memory index of the vbpl rows already in the database:
+    a bitmap of ids, the last written fingerprint and the sector of every id.
+    Loaded once from the database, then kept up to date by the writer after each commit.
+    """
+
+    def __init__(self):
+        self._bitmap = bytearray()
+        self._fingerprints = array('Q')
+        self._sector_codes = array('H')
+        # sector code 0 is None
+        self._sectors = [None]
+        self._sector_to_code = {None: 0}
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def __len__(self):
+        return sum(bin(byte).count('1') for byte in self._bitmap)
+
+    def _grow(self, doc_id):
+        size = len(self._fingerprints)
+        if doc_id < size:
+            return
+        new_size = max(doc_id + 1, size * 2, 1024)
+        # readers check the fingerprint length first, so grow it last
+        self._bitmap.extend(b'\x00' * (new_size // 8 + 1 - len(self._bitmap)))
+        self._sector_codes.extend([0] * (new_size - size))
+        self._fingerprints.extend([0] * (new_size - size))
+
+    def _sector_code(self, sector):
+        code = self._sector_to_code.get(sector)
+        if code is None:
+            code = len(self._sectors)
+            self._sectors.append(sector)
+            self._sector_to_code[sector] = code
+        return code
+
+    def _set(self, doc_id, fingerprint, sector):
+        self._grow(doc_id)
+        self._bitmap[doc_id >> 3] |= 1 << (doc_id & 7)
+        self._fingerprints[doc_id] = fingerprint
+        self._sector_codes[doc_id] = self._sector_code(sector)
+
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            columns = [getattr(Vbpl, column) for column in FINGERPRINT_COLUMNS]
+            count = 0
+            with LocalSession.begin() as session:
+                for row in session.query(Vbpl.id, *columns).filter(Vbpl.deleted_at.is_(None)).yield_per(10000):
+                    self._set(row.id, vbpl_fingerprint(row), row.sector)
+                    count += 1
+            self._loaded = True
+            _logger.info(f'Loaded {count} known vbpl ids')
+
+    def contains(self, doc_id) -> bool:
+        self.ensure_loaded()
+        doc_id = int(doc_id)
+        return doc_id < len(self._fingerprints) and bool(self._bitmap[doc_id >> 3] & (1 << (doc_id & 7)))
+
+    def fingerprint(self, doc_id):
+        if not self.contains(doc_id):
+            return None
+        return self._fingerprints[int(doc_id)]
+
+    def sector(self, doc_id):
+        if not self.contains(doc_id):
+            return None
+        return self._sectors[self._sector_codes[int(doc_id)]]
+
+    def needs_refresh(self, doc_id, fingerprint) -> bool:
+        return self.fingerprint(doc_id) != fingerprint
+
+    def add(self, doc_id, fingerprint, sector):
+        """
+        Record a written vbpl, call it only once the row is committed
+        """
+        self.ensure_loaded()
+        with self._lock:
+            self._set(int(doc_id), fingerprint, sector)
+
+    def set_sector(self, doc_id, sector, fingerprint):
+        """
+        Record a sector written outside of the crawl (bulk enrichment), nothing to do before the index is loaded
+        :param fingerprint: fingerprint of the row with the new sector
+        """
+        if not self._loaded or not self.contains(doc_id):
+            return
+        with self._lock:
+            self._fingerprints[int(doc_id)] = fingerprint
+            self._sector_codes[int(doc_id)] = self._sector_code(sector)
+
+
+known_vbpl_index = KnownVbplIndex()
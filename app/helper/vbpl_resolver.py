@@ -0,0 +1,207 @@
+import re
+import threading
+from array import array
+
+import Levenshtein
+
+from app.helper.db import LocalSession
+from app.helper.logger import setup_logger
+from app.model import Vbpl
+from app.search.tokenizer import tokenize
+
+_logger = setup_logger('vbpl_resolver_logger', 'log/vbpl_resolver.log')
+
+RESOLVER_COLUMNS = ('title', 'sub_title', 'serial_number')
+# sample: 43/2014/NĐ-CP, 01/VBHN-BTP
+_serial_regex = re.compile(r'\d+(?:/\d{4})?/[\w\-]+', re.UNICODE)
+_year_regex = re.compile(r'(?<!\d)(?:19|20)\d{2}(?!\d)')
+
+
+def resolver_key(text, fold=True):
+    """
+    Lookup key of a title or serial number, punctuation and spacing do not matter, sample:
+    resolver_key('Nghị định 43/2014/NĐ-CP') -> 'nghi dinh 43 2014 nd cp'
+    """
+    return ' '.join(tokenize(text, fold))
+
+
+def extract_serial_numbers(text):
+    """
+    Serial numbers quoted in a title, sample: extract_serial_numbers('Nghị định 43/2014/NĐ-CP về đất đai')
+    -> ['43/2014/NĐ-CP']
+    """
+    return _serial_regex.findall(text or '')
+
+
+def extract_years(text):
+    return set(_year_regex.findall(text or ''))
+
+
+def _trigrams(key):
+    padded = f' {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class VbplResolver:
+    """
+    In-memory index from the title, sub title and serial number of the known vbpl to their ids:
+    - exact keys, with and without diacritics
+    - a trigram index over the folded keys for the fuzzy matches
+    - the serial numbers and years quoted in the keys of every id, a fuzzy match has to agree with them
+    Loaded once from the database, then kept up to date by the writer after each commit.
+    """
+    _fuzzy_threshold = 0.85
+    _max_candidates = 20
+    # trigrams shared by more keys than this ("luat", " so ") do not narrow anything down
+    _max_posting_size = 5000
+
+    def __init__(self):
+        self._exact = {}
+        self._folded = {}
+        # key number -> (vbpl id, folded key), the trigram postings hold key numbers
+        self._keys = []
+        self._key_numbers = {}
+        self._trigrams = {}
+        # id -> (set of folded serial numbers, set of years)
+        self._facts = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _add_key(self, doc_id, text):
+        if not text:
+            return
+        exact = resolver_key(text, fold=False)
+        folded = resolver_key(text)
+        if not folded:
+            return
+        self._exact.setdefault(exact, set()).add(doc_id)
+        self._folded.setdefault(folded, set()).add(doc_id)
+        serials, years = self._facts.setdefault(doc_id, (set(), set()))
+        serials.update(resolver_key(serial) for serial in extract_serial_numbers(text))
+        years.update(extract_years(text))
+
+        if (doc_id, folded) in self._key_numbers:
+            return
+        number = len(self._keys)
+        self._keys.append((doc_id, folded))
+        self._key_numbers[(doc_id, folded)] = number
+        for trigram in _trigrams(folded):
+            postings = self._trigrams.get(trigram)
+            if postings is None:
+                postings = self._trigrams[trigram] = array('I')
+            postings.append(number)
+
+    def _set(self, doc_id, values):
+        for column in RESOLVER_COLUMNS:
+            self._add_key(doc_id, getattr(values, column))
+
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            columns = [getattr(Vbpl, column) for column in RESOLVER_COLUMNS]
+            count = 0
+            with LocalSession.begin() as session:
+                for row in session.query(Vbpl.id, *columns).filter(Vbpl.deleted_at.is_(None)).yield_per(10000):
+                    self._set(row.id, row)
+                    count += 1
+            self._loaded = True
+            _logger.info(f'Loaded {count} vbpl, {len(self._keys)} keys, {len(self._trigrams)} trigrams')
+
+    def add(self, doc_id, values):
+        """
+        Record the keys of a written vbpl, call it only once the row is committed
+        :param doc_id:
+        :param values: Vbpl object or row having RESOLVER_COLUMNS
+        """
+        self.ensure_loaded()
+        with self._lock:
+            self._set(int(doc_id), values)
+
+    def lookup(self, text):
+        """
+        Ids having exactly this title, sub title or serial number, diacritics are only ignored
+        when the text does not match with them
+        :return: set of ids, empty when unknown
+        """
+        self.ensure_loaded()
+        if not text:
+            return set()
+        ids = self._exact.get(resolver_key(text, fold=False))
+        if not ids:
+            ids = self._folded.get(resolver_key(text))
+        return set(ids) if ids else set()
+
+    def fuzzy(self, text, threshold=None, limit=5):
+        """
+        Closest keys by Levenshtein ratio, only the keys sharing most trigrams with the text are scored
+        :return: list of (id, ratio) sorted by ratio, best first
+        """
+        self.ensure_loaded()
+        threshold = self._fuzzy_threshold if threshold is None else threshold
+        folded = resolver_key(text) if text else ''
+        if not folded:
+            return []
+
+        query_trigrams = _trigrams(folded)
+        counts = {}
+        used = 0
+        for trigram in query_trigrams:
+            postings = self._trigrams.get(trigram)
+            if postings is None or len(postings) > self._max_posting_size:
+                continue
+            used += 1
+            for number in postings:
+                counts[number] = counts.get(number, 0) + 1
+        # a key at the threshold still shares about half of the selective trigrams
+        min_shared = used * threshold / 2
+        candidates = sorted((number for number, count in counts.items() if count >= min_shared),
+                            key=lambda number: counts[number], reverse=True)[:self._max_candidates]
+
+        best = {}
+        for number in candidates:
+            doc_id, key = self._keys[number]
+            ratio = Levenshtein.ratio(folded, key)
+            if ratio >= threshold and ratio > best.get(doc_id, 0):
+                best[doc_id] = ratio
+        return sorted(best.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    def _agrees(self, doc_id, serials, years):
+        known_serials, known_years = self._facts.get(doc_id, (set(), set()))
+        return bool(serials & known_serials) and years <= known_years
+
+    def resolve(self, text, threshold=None):
+        """
+        Id of the vbpl a link text refers to: exact key, then the serial number in the text, then fuzzy.
+        Titles of different versions of a law or of decrees on the same subject are close, so a fuzzy match is
+        only taken when it quotes the serial number of the text and its years.
+        :return: id or None when unknown or ambiguous, the caller then searches remotely
+        """
+        ids = self.lookup(text)
+        if len(ids) == 1:
+            return next(iter(ids))
+        if ids:
+            return None
+
+        for serial_number in extract_serial_numbers(text):
+            ids = self.lookup(serial_number)
+            if len(ids) == 1:
+                return next(iter(ids))
+
+        serials = {resolver_key(serial) for serial in extract_serial_numbers(text)}
+        if not serials:
+            return None
+        years = extract_years(text)
+        matches = [match for match in self.fuzzy(text, threshold) if self._agrees(match[0], serials, years)]
+        # two documents equally close to the text, e.g. two versions of the same law
+        if not matches or (len(matches) > 1 and matches[0][1] == matches[1][1]):
+            return None
+        return matches[0][0]
+
+
+vbpl_resolver = VbplResolver()
@@ -1,2 +1,4 @@
-from .vbpl import Vbpl, VbplDocMap, VbplRelatedDocument, VbplToanVan
+from .vbpl import Vbpl, VbplDocMap, VbplHtml, VbplRelatedDocument, VbplToanVan
 from .anle import Anle, AnleSection
+from .enrichment import ConcettiDocument, EnrichmentCache
+from .crawl import CrawlDeadLetter
@@ -6,7 +6,7 @@ from sqlalchemy.orm import relationship
 class Anle(BareBaseModel):
     __tablename__ = 'anle'
 
-    doc_id = Column(String(25), nullable=False)
+    doc_id = Column(String(25), nullable=False, unique=True, index=True)
     file_link = Column(String(1000), nullable=True)
     title = Column(String(455), nullable=False)
     serial_number = Column(String(100), nullable=False)
@@ -46,10 +46,14 @@ class Anle(BareBaseModel):
 class AnleSection(BareBaseModel):
     __tablename__ = 'anle_section'
 
-    anle_id = Column(Integer, ForeignKey('anle.id'), nullable=False)
+    # one section per anle, the unique key lets the writer upsert it
+    anle_id = Column(Integer, ForeignKey('anle.id'), nullable=False, unique=True, index=True)
     context = Column(Text, nullable=True)
     solution = Column(Text, nullable=True)
     content = Column(Text, nullable=True)
+    content_hash = Column(String(32), nullable=True)
+
+    hashed_columns = ('context', 'solution', 'content')
 
     # relationship
     anle_source = relationship("Anle", foreign_keys='AnleSection.anle_id',
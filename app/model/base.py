@@ -9,6 +9,7 @@ from sqlalchemy.orm import Session
 
 from app.helper.custom_exception import ObjectNotFound
 from app.helper.enum import ObjectNotFoundType
+from app.helper.utility import content_hash
 
 
 @as_declarative()
@@ -21,6 +22,14 @@ class Base:
     def __tablename__(cls) -> str:
         return cls.__name__.lower()
 
+    # columns covered by content_hash, empty for tables without a content hash
+    hashed_columns = ()
+    # content column -> hash column, on upsert the content is only overwritten when the hash changed
+    hash_guarded_columns = {}
+
+    def compute_content_hash(self):
+        return content_hash(*(getattr(self, column) for column in self.hashed_columns))
+
     def as_dict(self) -> dict:
         return {c.key: getattr(self, c.key) for c in inspect(self).mapper.column_attrs}
 
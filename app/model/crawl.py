@@ -0,0 +1,23 @@
+from app.model.base import Base
+from sqlalchemy import Column, DateTime, Index, Integer, String, Text
+
+
+class CrawlDeadLetter(Base):
+    __tablename__ = 'crawl_dead_letter'
+    __table_args__ = (
+        Index('ix_crawl_dead_letter_next_retry_at', 'next_retry_at'),
+    )
+
+    # page, document, related_doc or doc_map, see CrawlStage
+    stage = Column(String(20), primary_key=True, nullable=False)
+    # listing page number for a page, vbpl id otherwise
+    item_id = Column(Integer, primary_key=True, nullable=False, autoincrement=False)
+    # name of the VbplType
+    vbpl_type = Column(String(20), primary_key=True, nullable=False)
+    # network, server, circuit_open, parse or other, see CrawlErrorKind
+    error_kind = Column(String(20), nullable=False)
+    error_message = Column(Text, nullable=True)
+    attempts = Column(Integer, nullable=False)
+    first_failed_at = Column(DateTime, nullable=False)
+    last_failed_at = Column(DateTime, nullable=False)
+    next_retry_at = Column(DateTime, nullable=False)
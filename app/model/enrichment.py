@@ -0,0 +1,39 @@
+from app.model.base import Base
+from sqlalchemy import Boolean, Column, DateTime, Index, String, Text
+
+
+class EnrichmentCache(Base):
+    __tablename__ = 'enrichment_cache'
+    __table_args__ = (
+        Index('ix_enrichment_cache_expires_at', 'expires_at'),
+    )
+
+    # concetti, tvpl or luatvietnam, see EnrichmentSource
+    source = Column(String(20), primary_key=True, nullable=False)
+    # content_hash of the normalized serial number and title
+    lookup_key = Column(String(32), primary_key=True, nullable=False)
+    serial_number = Column(String(100), nullable=True)
+    title = Column(String(455), nullable=True)
+    # false is a "not found" marker, the source is not searched again until it expires
+    found = Column(Boolean, nullable=False)
+    # json of what the source returned
+    payload = Column(Text, nullable=True)
+    fetched_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+
+class ConcettiDocument(Base):
+    __tablename__ = 'concetti_document'
+    __table_args__ = (
+        Index('ix_concetti_document_issue_date', 'issue_date'),
+    )
+
+    slug = Column(String(255), primary_key=True, nullable=False)
+    key = Column(String(255), nullable=True)
+    name = Column(Text, nullable=True)
+    number = Column(String(100), nullable=True)
+    issue_date = Column(DateTime, nullable=True)
+    effective_date = Column(DateTime, nullable=True)
+    expiry_date = Column(DateTime, nullable=True)
+    pdf_file = Column(String(64), nullable=True)
+    fetched_at = Column(DateTime, nullable=False)
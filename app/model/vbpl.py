@@ -1,18 +1,22 @@
+from app.helper.compression import CompressedText
 from app.model.base import BareBaseModel, Base
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey
-from sqlalchemy.dialects.mysql import LONGTEXT
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Index
+from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import relationship
 
 
 class Vbpl(BareBaseModel):
     __tablename__ = 'vbpl'
+    __table_args__ = (
+        Index('ix_vbpl_updated_at', 'updated_at'),
+    )
 
     file_link = Column(Text, nullable=True)
     title = Column(String(455), nullable=False)
     sub_title = Column(Text, nullable=True)
     doc_type = Column(String(100), nullable=True)
     serial_number = Column(String(100), nullable=False)
-    issuance_date = Column(DateTime, nullable=True)
+    issuance_date = Column(DateTime, nullable=True, index=True)
     effective_date = Column(DateTime, nullable=True)
     expiration_date = Column(DateTime, nullable=True)
     gazette_date = Column(DateTime, nullable=True)
@@ -20,10 +24,18 @@ class Vbpl(BareBaseModel):
     issuing_authority = Column(String(100), nullable=True)
     applicable_information = Column(String(100), nullable=True)
     sector = Column(String(100), nullable=True)
-    html = Column(LONGTEXT, nullable=True)
+    html_hash = Column(String(32), nullable=True)
     org_pdf_link = Column(Text, nullable=True)
 
     # relationship
+    # the html lives in vbpl_html so the vbpl rows stay narrow, it is only loaded when vbpl.html is accessed
+    html_content = relationship("VbplHtml", foreign_keys='VbplHtml.vbpl_id',
+                                primaryjoin='VbplHtml.vbpl_id == Vbpl.id',
+                                back_populates="vbpl",
+                                uselist=False,
+                                lazy='select')
+    html = association_proxy('html_content', 'html', creator=lambda html: VbplHtml(html=html))
+
     toan_van = relationship("VbplToanVan", foreign_keys='VbplToanVan.vbpl_id',
                             primaryjoin='VbplToanVan.vbpl_id == Vbpl.id',
                             back_populates="vbpl",
@@ -74,13 +86,30 @@ class Vbpl(BareBaseModel):
                 f'########################')
 
 
+class VbplHtml(Base):
+    __tablename__ = 'vbpl_html'
+
+    vbpl_id = Column(Integer, ForeignKey('vbpl.id'), primary_key=True, nullable=False)
+    html = Column(CompressedText, nullable=True)
+    html_hash = Column(String(32), nullable=True)
+
+    # on duplicate key, html is only overwritten when html_hash changed
+    hash_guarded_columns = {'html': 'html_hash'}
+
+    # relationship
+    vbpl = relationship("Vbpl", foreign_keys='VbplHtml.vbpl_id',
+                        primaryjoin='and_(VbplHtml.vbpl_id == Vbpl.id, Vbpl.deleted_at.is_(None))',
+                        back_populates="html_content",
+                        lazy='select')
+
+
 class VbplToanVan(Base):
     __tablename__ = 'vbpl_toan_van'
 
     vbpl_id = Column(Integer, ForeignKey('vbpl.id'), primary_key=True, nullable=False)
     section_number = Column(Integer, primary_key=True, nullable=False)
     section_name = Column(String(400), nullable=True)
-    section_content = Column(LONGTEXT, nullable=True)
+    section_content = Column(CompressedText, nullable=True)
     chapter_number = Column(String(400), nullable=True)
     chapter_name = Column(Text, nullable=True)
     big_part_number = Column(String(25), nullable=True)
@@ -89,6 +118,10 @@ class VbplToanVan(Base):
     part_name = Column(String(1000), nullable=True)
     mini_part_number = Column(String(25), nullable=True)
     mini_part_name = Column(String(200), nullable=True)
+    content_hash = Column(String(32), nullable=True)
+
+    hashed_columns = ('section_name', 'section_content', 'chapter_number', 'chapter_name', 'big_part_number',
+                      'big_part_name', 'part_number', 'part_name', 'mini_part_number', 'mini_part_name')
 
     # relationship
     vbpl = relationship("Vbpl", foreign_keys='VbplToanVan.vbpl_id',
@@ -152,6 +185,9 @@ class VbplSubPart(Base):
     sub_section_title = Column(String(1000), nullable=False)
     sub_section_part_number = Column(String(10), primary_key=True, nullable=False)
     sub_section_part_title = Column(Text, nullable=True)
+    content_hash = Column(String(32), nullable=True)
+
+    hashed_columns = ('sub_section_title', 'sub_section_part_title')
 
     # relationship
     vbpl = relationship("Vbpl", foreign_keys='VbplSubPart.vbpl_id',
@@ -0,0 +1,8 @@
+import atexit
+
+from app.search.index import SearchIndex
+from app.search.tokenizer import fold_diacritics, normalize, tokenize
+from setting import setting
+
+search_index = SearchIndex(setting.SEARCH_INDEX_DIR)
+atexit.register(search_index.flush)
@@ -0,0 +1,410 @@
+import heapq
+import json
+import math
+import mmap
+import os
+import shutil
+import threading
+from array import array
+from collections import Counter
+
+from app.helper.logger import setup_logger
+from app.search.tokenizer import tokenize
+
+_logger = setup_logger('search_logger', 'log/search.log')
+
+_manifest_file = 'manifest.json'
+# BM25 parameters
+_k1 = 1.2
+_b = 0.75
+
+
+def _write_json(path, value):
+    with open(path + '.tmp', 'w', encoding='utf-8') as json_file:
+        json.dump(value, json_file, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+
+
+def _group_of(key):
+    return key.rsplit(':', 1)[0]
+
+
+class _Segment:
+    """
+    Immutable part of the index, only its deleted bitmap changes after it is written:
+    - postings.bin: (doc ordinal, term frequency) uint32 pairs, grouped by term, memory-mapped
+    - lexicon.json: term -> [offset, count] in pairs
+    - docs.json: key and content hash of every doc ordinal
+    - lengths.bin: token count of every doc ordinal
+    - deleted.bin: bitmap of the doc ordinals replaced by a newer segment or deleted
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, 'lexicon.json'), encoding='utf-8') as lexicon_file:
+            self.lexicon = json.load(lexicon_file)
+        with open(os.path.join(path, 'docs.json'), encoding='utf-8') as docs_file:
+            docs = json.load(docs_file)
+        self.keys = docs['keys']
+        self.hashes = docs['hashes']
+        self.lengths = array('I')
+        with open(os.path.join(path, 'lengths.bin'), 'rb') as lengths_file:
+            self.lengths.frombytes(lengths_file.read())
+        deleted_path = os.path.join(path, 'deleted.bin')
+        if os.path.exists(deleted_path):
+            with open(deleted_path, 'rb') as deleted_file:
+                self.deleted = bytearray(deleted_file.read())
+        else:
+            self.deleted = bytearray(len(self.keys) // 8 + 1)
+
+        self._postings_file = open(os.path.join(path, 'postings.bin'), 'rb')
+        size = os.fstat(self._postings_file.fileno()).st_size
+        self._postings = mmap.mmap(self._postings_file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+
+    @classmethod
+    def write(cls, path, keys, hashes, lengths, term_postings):
+        """
+        :param path: segment directory
+        :param keys: key of every doc ordinal
+        :param hashes: content hash of every doc ordinal
+        :param lengths: array of the token count of every doc ordinal
+        :param term_postings: iterable of (term, array of ordinal / frequency pairs), sorted by term
+        """
+        os.makedirs(path)
+        lexicon = {}
+        offset = 0
+        with open(os.path.join(path, 'postings.bin'), 'wb') as postings_file:
+            for term, postings in term_postings:
+                postings.tofile(postings_file)
+                lexicon[term] = [offset, len(postings) // 2]
+                offset += len(postings) // 2
+
+        with open(os.path.join(path, 'lengths.bin'), 'wb') as lengths_file:
+            lengths.tofile(lengths_file)
+        _write_json(os.path.join(path, 'lexicon.json'), lexicon)
+        _write_json(os.path.join(path, 'docs.json'), {'keys': keys, 'hashes': hashes})
+        return cls(path)
+
+    @classmethod
+    def write_docs(cls, path, docs):
+        """
+        :param path: segment directory
+        :param docs: list of (key, hash, Counter of tokens)
+        """
+        postings_by_term = {}
+        lengths = array('I')
+        for ordinal, (_, _, counts) in enumerate(docs):
+            lengths.append(sum(counts.values()))
+            for term, frequency in counts.items():
+                postings = postings_by_term.get(term)
+                if postings is None:
+                    postings = postings_by_term[term] = array('I')
+                postings.append(ordinal)
+                postings.append(frequency)
+        term_postings = ((term, postings_by_term[term]) for term in sorted(postings_by_term))
+        return cls.write(path, [doc[0] for doc in docs], [doc[1] for doc in docs], lengths, term_postings)
+
+    @classmethod
+    def write_merged(cls, path, segments):
+        """
+        Merge segments term by term, only the lexicons and the doc tables are held in memory
+        """
+        keys = []
+        hashes = []
+        lengths = array('I')
+        remaps = []
+        for segment in segments:
+            remap = {}
+            for ordinal, key in enumerate(segment.keys):
+                if not segment.is_deleted(ordinal):
+                    remap[ordinal] = len(keys)
+                    keys.append(key)
+                    hashes.append(segment.hashes[ordinal])
+                    lengths.append(segment.lengths[ordinal])
+            remaps.append(remap)
+
+        def term_postings():
+            for term in sorted(set().union(*(segment.lexicon.keys() for segment in segments))):
+                merged = array('I')
+                # the ordinals of a later segment are all higher, the merged postings stay sorted
+                for segment, remap in zip(segments, remaps):
+                    postings = segment.postings(term)
+                    for index in range(0, len(postings), 2):
+                        new_ordinal = remap.get(postings[index])
+                        if new_ordinal is not None:
+                            merged.append(new_ordinal)
+                            merged.append(postings[index + 1])
+                if merged:
+                    yield term, merged
+
+        return cls.write(path, keys, hashes, lengths, term_postings())
+
+    def postings(self, term):
+        entry = self.lexicon.get(term)
+        if entry is None or self._postings is None:
+            return array('I')
+        offset, count = entry
+        # slicing copies the bytes, no buffer stays exported on the mmap
+        postings = array('I')
+        postings.frombytes(self._postings[offset * 8:(offset + count) * 8])
+        return postings
+
+    def document_frequency(self, term):
+        entry = self.lexicon.get(term)
+        return entry[1] if entry else 0
+
+    def is_deleted(self, ordinal):
+        return bool(self.deleted[ordinal >> 3] & (1 << (ordinal & 7)))
+
+    def delete(self, ordinal):
+        self.deleted[ordinal >> 3] |= 1 << (ordinal & 7)
+
+    def save_deleted(self):
+        with open(os.path.join(self.path, 'deleted.bin.tmp'), 'wb') as deleted_file:
+            deleted_file.write(self.deleted)
+        os.replace(os.path.join(self.path, 'deleted.bin.tmp'), os.path.join(self.path, 'deleted.bin'))
+
+    def close(self):
+        if self._postings is not None:
+            self._postings.close()
+        self._postings_file.close()
+
+
+class SearchIndex:
+    """
+    Embedded inverted index with BM25 ranking, made of immutable segments.
+    New and changed documents are buffered and written as a new segment on flush,
+    the replaced documents are only marked deleted in the older segments until the segments are merged.
+    """
+    _flush_docs = 2000
+    _max_segments = 16
+
+    def __init__(self, path):
+        self.path = path
+        self.fold = True
+        self._segments = []
+        self._next_segment = 0
+        # key -> (segment, ordinal) of the live version of every doc
+        self._locations = {}
+        self._groups = {}
+        self._live_length = 0
+        # key -> (hash, Counter) waiting for the next flush, None for a pending delete
+        self._pending = {}
+        self._lock = threading.RLock()
+        self._loaded = False
+        # turned off while building the whole index, the segments are merged once at the end
+        self.auto_merge = True
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, _manifest_file))
+
+    def _load(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            with open(os.path.join(self.path, _manifest_file), encoding='utf-8') as manifest_file:
+                manifest = json.load(manifest_file)
+            self.fold = manifest['fold']
+            self._next_segment = manifest['next_segment']
+            for name in manifest['segments']:
+                self._attach(_Segment(os.path.join(self.path, name)))
+            self._loaded = True
+            _logger.info(f'Loaded search index {self.path}: {len(self._segments)} segments, '
+                         f'{len(self._locations)} documents')
+
+    def _attach(self, segment):
+        self._segments.append(segment)
+        for ordinal, key in enumerate(segment.keys):
+            if segment.is_deleted(ordinal):
+                continue
+            self._locations[key] = (segment, ordinal)
+            self._groups.setdefault(_group_of(key), set()).add(key)
+            self._live_length += segment.lengths[ordinal]
+
+    def _save_manifest(self):
+        _write_json(os.path.join(self.path, _manifest_file), {
+            'fold': self.fold,
+            'next_segment': self._next_segment,
+            'segments': [segment.name for segment in self._segments],
+        })
+
+    def create(self, fold=True):
+        """
+        Start an empty index, an existing index at the same path is removed
+        """
+        with self._lock:
+            self.close()
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path)
+            self.fold = fold
+            self._next_segment = 0
+            self._save_manifest()
+            self._loaded = True
+
+    def __len__(self):
+        self._load()
+        return len(self._locations)
+
+    def _stored_hash(self, key):
+        if key in self._pending:
+            pending = self._pending[key]
+            return pending[0] if pending is not None else None
+        location = self._locations.get(key)
+        if location is None:
+            return None
+        segment, ordinal = location
+        return segment.hashes[ordinal]
+
+    def add_documents(self, docs):
+        """
+        Add or replace documents, unchanged documents are skipped, sample:
+        search_index.add_documents([('anle_section:TAND292162', section.content_hash, text)])
+        :param docs: iterable of (key, content hash, text)
+        """
+        self._load()
+        with self._lock:
+            for key, content_hash, text in docs:
+                if content_hash is not None and self._stored_hash(key) == content_hash:
+                    continue
+                self._pending[key] = (content_hash, Counter(tokenize(text, self.fold)))
+            if len(self._pending) >= self._flush_docs:
+                self.flush()
+
+    def replace_group(self, group, docs):
+        """
+        Make the documents of a group equal to docs, the other documents of the group are deleted
+        :param group: key prefix, sample: 'vbpl_toan_van:32801' for the keys 'vbpl_toan_van:32801:<section>'
+        :param docs: iterable of (key, content hash, text)
+        """
+        self._load()
+        docs = list(docs)
+        with self._lock:
+            keep = {doc[0] for doc in docs}
+            # the flushed documents of the group and the ones still waiting for a flush
+            pending_keys = [key for key, value in self._pending.items()
+                            if value is not None and _group_of(key) == group]
+            for key in list(self._groups.get(group, ())) + pending_keys:
+                if key not in keep:
+                    self._pending[key] = None
+            self.add_documents(docs)
+
+    def delete_documents(self, keys):
+        self._load()
+        with self._lock:
+            for key in keys:
+                self._pending[key] = None
+
+    def flush(self):
+        """
+        Write the pending documents as a new segment and mark their older versions deleted
+        """
+        if not self._loaded:
+            return
+        with self._lock:
+            if not self._pending:
+                return
+            pending = self._pending
+            self._pending = {}
+
+            changed_segments = set()
+            for key in pending.keys():
+                location = self._locations.pop(key, None)
+                if location is not None:
+                    segment, ordinal = location
+                    segment.delete(ordinal)
+                    self._live_length -= segment.lengths[ordinal]
+                    changed_segments.add(segment)
+                    self._groups.get(_group_of(key), set()).discard(key)
+
+            docs = [(key, value[0], value[1]) for key, value in pending.items() if value is not None]
+            if docs:
+                name = f'seg_{self._next_segment:06d}'
+                self._next_segment += 1
+                self._attach(_Segment.write_docs(os.path.join(self.path, name), docs))
+            for segment in changed_segments:
+                segment.save_deleted()
+            self._save_manifest()
+            _logger.info(f'Flush search index: {len(docs)} documents written, '
+                         f'{len(pending) - len(docs)} deleted, {len(self._segments)} segments')
+
+            if self.auto_merge and len(self._segments) > self._max_segments:
+                self.merge()
+
+    def merge(self):
+        """
+        Merge every segment into one, dropping the deleted documents
+        """
+        self._load()
+        with self._lock:
+            self.flush()
+            if len(self._segments) <= 1:
+                return
+            name = f'seg_{self._next_segment:06d}'
+            self._next_segment += 1
+            merged = _Segment.write_merged(os.path.join(self.path, name), self._segments)
+
+            old_segments = self._segments
+            self._segments = []
+            self._locations = {}
+            self._groups = {}
+            self._live_length = 0
+            self._attach(merged)
+            self._save_manifest()
+            for segment in old_segments:
+                segment.close()
+                shutil.rmtree(segment.path, ignore_errors=True)
+            _logger.info(f'Merge search index: {len(old_segments)} segments into {name}, '
+                         f'{len(merged.keys)} documents')
+
+    def search(self, query, limit=10):
+        """
+        BM25 search, sample: search_index.search('quyền sử dụng đất', 5)
+        :param query:
+        :param limit:
+        :return: list of (key, score), best first
+        """
+        self._load()
+        terms = set(tokenize(query, self.fold))
+        # searched under the lock, a merge closes the segments it replaces
+        with self._lock:
+            live_count = len(self._locations)
+            if not terms or not live_count:
+                return []
+            average_length = self._live_length / live_count
+
+            scores = {}
+            for term in terms:
+                # the document frequency counts the deleted postings too until the next merge
+                frequency = sum(segment.document_frequency(term) for segment in self._segments)
+                if not frequency:
+                    continue
+                idf = math.log(1 + (live_count - frequency + 0.5) / (frequency + 0.5))
+                for segment_index, segment in enumerate(self._segments):
+                    postings = segment.postings(term)
+                    lengths = segment.lengths
+                    for index in range(0, len(postings), 2):
+                        ordinal = postings[index]
+                        if segment.is_deleted(ordinal):
+                            continue
+                        tf = postings[index + 1]
+                        norm = _k1 * (1 - _b + _b * lengths[ordinal] / average_length)
+                        score_key = (segment_index, ordinal)
+                        scores[score_key] = scores.get(score_key, 0.0) + idf * tf * (_k1 + 1) / (tf + norm)
+
+            best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+            return [(self._segments[segment_index].keys[ordinal], score)
+                    for (segment_index, ordinal), score in best]
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments:
+                segment.close()
+            self._segments = []
+            self._locations = {}
+            self._groups = {}
+            self._live_length = 0
+            self._pending = {}
+            self._loaded = False
@@ -0,0 +1,40 @@
+import re
+import unicodedata
+
+# old style tone placement -> new style, both are found in the crawled documents ("hoà" and "hòa")
+_tone_placement = {
+    'òa': 'oà', 'óa': 'oá', 'ỏa': 'oả', 'õa': 'oã', 'ọa': 'oạ',
+    'òe': 'oè', 'óe': 'oé', 'ỏe': 'oẻ', 'õe': 'oẽ', 'ọe': 'oẹ',
+    'ùy': 'uỳ', 'úy': 'uý', 'ủy': 'uỷ', 'ũy': 'uỹ', 'ụy': 'uỵ',
+}
+_tone_placement_regex = re.compile('|'.join(_tone_placement.keys()))
+_token_regex = re.compile(r'\w+', re.UNICODE)
+
+
+def fold_diacritics(text: str) -> str:
+    """
+    Remove Vietnamese diacritics, sample: fold_diacritics('đất đai') -> 'dat dai'
+    """
+    text = unicodedata.normalize('NFD', text)
+    text = ''.join(char for char in text if unicodedata.category(char) != 'Mn')
+    return text.replace('đ', 'd').replace('Đ', 'D')
+
+
+def normalize(text: str, fold=True) -> str:
+    text = unicodedata.normalize('NFC', text).lower()
+    if fold:
+        return fold_diacritics(text)
+    return _tone_placement_regex.sub(lambda match: _tone_placement[match.group(0)], text)
+
+
+def tokenize(text: str, fold=True):
+    """
+    Split text into lower case syllables, Vietnamese words are made of syllables separated by spaces
+    so a syllable is the indexing unit, sample: tokenize('Luật Đất đai 2013') -> ['luat', 'dat', 'dai', '2013']
+    :param text:
+    :param fold: remove diacritics, "dat dai" then matches "đất đai"
+    :return: list of tokens
+    """
+    if not text:
+        return []
+    return _token_regex.findall(normalize(text, fold))
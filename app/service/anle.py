@@ -1,23 +1,27 @@
-import asyncio
 import os
 import re
 from datetime import datetime
 from http import HTTPStatus
 from typing import Dict
-import aiohttp
 import pdfplumber
+from sqlalchemy import select
 from bs4 import BeautifulSoup
 from app.helper.constant import AnleSectionConst
-from app.helper.custom_exception import CommonException
-from app.helper.db import LocalSession
+from app.helper.custom_exception import CommonException, UpstreamError
+from app.helper.db import run_in_db, run_in_session
+from app.helper.bulk_upsert import bulk_upsert, model_to_row
+from app.helper.db_writer import db_writer
+from app.helper.http_client import fetch
+from app.helper.archive import ArchiveBuilder
+from app.helper.sql_export import stream_rows, write_insert_statements
+from app.search import search_index
 from app.helper.logger import setup_logger
-from app.helper.utility import get_html_node_text
+from app.helper.utility import get_html_node_text, content_hash
 from app.model import Anle
 from app.model import AnleSection
 from app.service.get_pdf import get_document, is_pdf
 from setting import setting
 import aspose.words as aw
-import py7zr
 
 _logger = setup_logger('anle_logger', 'log/anle.log')
 
@@ -34,27 +38,20 @@ class AnleService:
     async def call(cls, method: str, url_path: str, query_params=None, json_data=None, timeout=90):
         url = cls._api_base_url + url_path
         headers = cls.get_headers()
-        max_retries = 3
-        for retry in range(max_retries):
-            try:
-                async with aiohttp.ClientSession(trust_env=True) as session:
-                    async with session.request(method, url, params=query_params, json=json_data, timeout=timeout,
-                                               headers=headers, verify_ssl=False) as resp:
-                        await resp.text()
-                if resp.status != HTTPStatus.OK:
-                    _logger.warning(
-                        "Calling Anle URL: %s, request_param %s, request_payload %s, http_code: %s, response: %s" %
-                        (url, str(query_params), str(json_data), str(resp.status), resp.text))
-                return resp
-            except Exception as e:
-                _logger.warning(f"Calling Anle URL: {url},"
-                                f" request_params {str(query_params)}, request_body {str(json_data)},"
-                                f" error {str(e)}")
-                if retry < max_retries - 1:
-                    _logger.warning(f"Retrying... (Attempt {retry + 1}/{max_retries})")
-                    await asyncio.sleep(2 ** retry)  # Sleep for an increasing amount of time between retries
-                else:
-                    raise e
+        try:
+            # retried on network errors, 5xx and 429 with backoff
+            resp = await fetch(method, url, params=query_params, json=json_data, timeout=timeout, headers=headers,
+                               verify_ssl=False)
+            if resp.status != HTTPStatus.OK:
+                _logger.warning(
+                    "Calling Anle URL: %s, request_param %s, request_payload %s, http_code: %s, response: %s" %
+                    (url, str(query_params), str(json_data), str(resp.status), resp.text))
+            return resp
+        except UpstreamError as e:
+            _logger.warning(f"Calling Anle URL: {url},"
+                            f" request_params {str(query_params)}, request_body {str(json_data)},"
+                            f" error {str(e)}")
+            raise
 
     @classmethod
     async def crawl_anle_info(cls, anle: Anle):
@@ -119,34 +116,12 @@ class AnleService:
                     anle.org_pdf_link = ' '.join(pdf_links)
                     anle.file_link = ' '.join(file_links)
 
-                update_data = {
-                    'file_link': anle.file_link,
-                    'serial_number': anle.serial_number,
-                    'expiration_date': anle.expiration_date,
-                    'org_pdf_link': anle.org_pdf_link,
-                    'doc_id': anle.doc_id,
-                    'title': anle.title,
-                    'adoption_date': anle.adoption_date,
-                    'publication_date': anle.publication_date,
-                    'publication_decision': anle.publication_decision,
-                    'application_date': anle.application_date,
-                    'sector': anle.sector,
-                    'state': anle.state
-                }
-
-                # add to db
-                with LocalSession.begin() as session:
-                    statement = session.query(Anle).filter(Anle.doc_id == anle.doc_id)
-                    check_anle = session.execute(statement).first()
-                    if check_anle is not None:
-                        # upsert anle
-                        session.query(Anle).filter(Anle.doc_id == anle.doc_id).update(update_data)
-                    else:
-                        session.add(anle)
+                # add to db, upserted on the unique doc_id in batch by the db writer
+                await db_writer.asubmit([(Anle, [model_to_row(anle)])])
 
                 for file_link in file_links:
                     file_id, anle_context, anle_solution, anle_content = cls.process_anle(file_link)
-                    cls.to_anle_section_db(file_id, anle_context, anle_solution, anle_content)
+                    await cls.to_anle_section_db(file_id, anle_context, anle_solution, anle_content)
 
         except Exception as e:
             _logger.exception(f'Crawl anle info {anle.id} {e}')
@@ -190,6 +165,10 @@ class AnleService:
                 _logger.exception(f'Call anle search api {e}')
                 raise CommonException(500, 'call anle search api')
 
+        # make sure everything batched by the writer is in the database before returning
+        await db_writer.aflush()
+        search_index.flush()
+
     @classmethod
     def process_anle(cls, file_path: str):
         try:
@@ -257,32 +236,42 @@ class AnleService:
         return extracted_content
 
     @classmethod
-    def to_anle_section_db(cls, file_id: str, anle_context: str, anle_solution: str, anle_content: str):
-        with LocalSession.begin() as session:
-            target_anle = session.query(Anle).filter(Anle.doc_id == file_id).all()
-            for anle in target_anle:
-                check_anle_section = session.query(AnleSection).filter(AnleSection.anle_id == anle.id).first()
-                if check_anle_section:
-                    # upsert anle section
-                    update_data = {
-                        'context': anle_context,
-                        'solution': anle_solution,
-                        'content': anle_content,
-                    }
-                    session.query(AnleSection).filter(AnleSection.anle_id == anle.id).update(update_data)
-                else:
-                    new_anle_section = AnleSection(
-                        anle_id=anle.id,
-                        context=anle_context,
-                        solution=anle_solution,
-                        content=anle_content,
-                    )
-                    session.add(new_anle_section)
+    async def to_anle_section_db(cls, file_id: str, anle_context: str, anle_solution: str, anle_content: str):
+        after_commit = []
+        if search_index.exists():
+            after_commit.append(lambda: search_index.add_documents([(
+                f'anle_section:{file_id}', content_hash(anle_context, anle_solution, anle_content),
+                f'{anle_context or ""}\n{anle_solution or ""}\n{anle_content or ""}')]))
+        # queued after the anle itself so the lookup by doc_id below finds it
+        await db_writer.asubmit(ops=[lambda session: cls.write_anle_section(session, file_id, anle_context,
+                                                                            anle_solution, anle_content)],
+                                after_commit=after_commit)
+
+    @classmethod
+    def write_anle_section(cls, session, file_id: str, anle_context: str, anle_solution: str, anle_content: str):
+        new_content_hash = content_hash(anle_context, anle_solution, anle_content)
+        target = session.query(Anle.id, AnleSection.content_hash). \
+            outerjoin(AnleSection, AnleSection.anle_id == Anle.id). \
+            filter(Anle.doc_id == file_id).first()
+        # skip rewriting the section when its content did not change
+        if target is None or target.content_hash == new_content_hash:
+            return
+
+        # upsert anle section on its unique anle_id
+        new_anle_section = AnleSection(
+            anle_id=target.id,
+            context=anle_context,
+            solution=anle_solution,
+            content=anle_content,
+            content_hash=new_content_hash,
+        )
+        bulk_upsert(session, AnleSection, [model_to_row(new_anle_section)])
 
     @classmethod
     async def fetch_anle_by_id(cls, anle_id):
-        with LocalSession.begin() as session:
-            target_anle = session.query(Anle).filter(Anle.doc_id == anle_id).order_by(Anle.updated_at.desc()).first()
+        target_anle = await run_in_db(run_in_session,
+                                      lambda session: session.query(Anle).filter(Anle.doc_id == anle_id).
+                                      order_by(Anle.updated_at.desc()).first())
 
         formatted_output = (
             f"ID trong bảng ghi: {target_anle.id},\n"
@@ -305,34 +294,32 @@ class AnleService:
 
     @classmethod
     async def get_anle_preview(cls):
-        with LocalSession.begin() as session:
-            query = session.query(Anle)
-
         sql_folder_path = 'documents/preview/anle'
         os.makedirs(sql_folder_path, exist_ok=True)
         sql_file_path = os.path.join(sql_folder_path, 'anle_preview_script.sql')
 
-        with open(sql_file_path, 'w') as dump_file:
-            for anle_instance in query:
-                values = []
-                for column in Anle.__table__.columns.keys():
-                    value = getattr(anle_instance, column)
-                    if value is None:
-                        values.append("NULL")
-                    else:
-                        values.append(f"'{value}'")
-                values_str = ", ".join(values)
-                insert_sql = f"INSERT INTO anle ({', '.join(Anle.__table__.columns.keys())}) VALUES ({values_str});"
-                dump_file.write(insert_sql + '\n')
-
-        file_links = []
-
-        target_records = query.all()
-        for record in target_records:
-            if record.file_link is not None:
-                file_links.append(record.file_link)
-
-        output_rar_filepath = os.path.join(sql_folder_path, 'preview_anle.rar')
-        with py7zr.SevenZipFile(output_rar_filepath, 'w') as archive:
-            for file_link in file_links:
-                archive.write(file_link)
+        def export(session):
+            file_links = []
+
+            def on_anle_row(row):
+                if row.file_link is not None:
+                    file_links.append(row.file_link)
+
+            anle_table = Anle.__table__
+            section_table = AnleSection.__table__
+            with open(sql_file_path, 'w', encoding='utf-8') as dump_file:
+                count = write_insert_statements(dump_file, anle_table.name, anle_table.columns.keys(),
+                                                stream_rows(session, select(anle_table).order_by(anle_table.c.id)),
+                                                on_row=on_anle_row)
+                write_insert_statements(dump_file, section_table.name, section_table.columns.keys(),
+                                        stream_rows(session, select(section_table).order_by(section_table.c.id)))
+            _logger.info(f'Export {count} anle to {sql_file_path}')
+            return file_links
+
+        file_links = await run_in_db(run_in_session, export)
+
+        # a file_link can hold several paths, identical files are stored once
+        archive = ArchiveBuilder(os.path.join(sql_folder_path, 'preview_anle.zip'))
+        for file_link in file_links:
+            archive.add_file_links(file_link)
+        archive.build()
@@ -0,0 +1,501 @@
+import asyncio
+import json
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+from http import HTTPStatus
+from typing import Dict
+
+import aiohttp
+import yarl
+from bs4 import BeautifulSoup
+from sqlalchemy import select, update
+
+from app.helper.bulk_upsert import bulk_upsert
+from app.helper.concurrency import host_limiters
+from app.helper.db import LocalSession, run_in_db
+from app.helper.db_writer import db_writer
+from app.helper.enrichment_cache import enrichment_cache
+from app.helper.enum import EnrichmentSource
+from app.helper.http_client import send_with_retries
+from app.helper.logger import setup_logger
+from app.helper.sql_export import stream_rows
+from app.helper.utility import concetti_query_params_url_encode, convert_datetime_to_str, get_html_node_text
+from app.helper.vbpl_index import FINGERPRINT_COLUMNS, known_vbpl_index, vbpl_fingerprint
+from app.helper.fuzzy_match import CandidateSet, batch_match
+from app.helper.vbpl_resolver import extract_serial_numbers, resolver_key
+from app.model import ConcettiDocument, EnrichmentCache, Vbpl
+from setting import setting
+
+_logger = setup_logger('enrichment_logger', 'log/enrichment.log')
+
+
+def join_sectors(sectors, max_length=100):
+    """
+    vbpl.sector of a list of sectors, the last sectors are dropped to fit the column, sample:
+    join_sectors(['Đất đai', 'Xây dựng']) -> 'Đất đai - Xây dựng'
+    """
+    sector = ''
+    for name in sectors:
+        joined = f'{sector} - {name}' if sector else name
+        if len(joined) > max_length:
+            break
+        sector = joined
+    return sector or None
+
+
+def parse_concetti_date(value):
+    # concetti dates are 'YYYY-MM-DD', sometimes followed by a time
+    if not value:
+        return None
+    return datetime.strptime(value[:10], '%Y-%m-%d')
+
+
+def concetti_dates(item, now=None):
+    """
+    Effective date, expiration date and state of a vbpl from a concetti item
+    :param item: dict with effectiveDate and expiryDate
+    :param now:
+    :return: dict of the vbpl columns to set, empty when concetti has no effective date
+    """
+    now = now or datetime.now()
+    changes = {}
+    effective_date = parse_concetti_date(item['effectiveDate'])
+    if effective_date is None:
+        return changes
+    changes['effective_date'] = effective_date
+    if effective_date > now:
+        changes['state'] = 'Chưa có hiệu lực'
+        return changes
+
+    expiry_date = parse_concetti_date(item['expiryDate'])
+    if expiry_date is None:
+        changes['state'] = 'Có hiệu lực'
+    else:
+        changes['expiration_date'] = expiry_date
+        changes['state'] = 'Hết hiệu lực' if expiry_date < now else 'Có hiệu lực'
+    return changes
+
+
+class EnrichmentService:
+    """
+    Bulk enrichment jobs, they mirror a third-party source once and apply it to every vbpl
+    instead of searching the source document by document
+    """
+    _luat_vn_base_url = setting.LUAT_VN_BASE_URL
+    _mirror_dir = 'documents/enrichment'
+    _sector_map_file = 'luatvietnam_sectors.json'
+    _max_listing_pages = 1000
+    _max_concurrency = setting.CRAWL_MAX_THREADS
+    _batch_size = 10000
+    _update_chunk = 1000
+    _sector_map = None
+
+    _concetti_base_url = setting.CONCETTI_BASE_URL
+    _concetti_select = ('active,'
+                        'slug,'
+                        'key,'
+                        'name,'
+                        'number,'
+                        'issueDate,'
+                        'effectiveDate,'
+                        'expiryDate,'
+                        'pdfFile')
+    _concetti_page_size = 100
+    _concetti_first_year = 1945
+    _concetti_window_months = 1
+    _concetti_threshold = 0.8
+    _concetti_match_limit = 5
+    # position -> concetti document, the candidate set holds their name, number and key
+    _concetti_docs = None
+    _concetti_index = None
+    _concetti_lock = threading.Lock()
+
+    @classmethod
+    def get_headers(cls) -> Dict:
+        return {'Content-Type': 'application/json'}
+
+    @classmethod
+    async def fetch_text(cls, session, semaphore, url, query_params=None):
+        async def send(attempt):
+            async with host_limiters.get(url).slot() as outcome:
+                async with session.request('GET', url, params=query_params, headers=cls.get_headers()) as resp:
+                    await resp.text()
+                outcome.status = resp.status
+            return resp
+
+        async with semaphore:
+            try:
+                resp = await send_with_retries(url, send)
+                text = await resp.text()
+            except Exception as e:
+                _logger.warning(f'Calling {url}, request_params {query_params}, error {e}')
+                return None
+        if resp.status != HTTPStatus.OK:
+            _logger.warning(f'Calling {url}, request_params {query_params}, http_code: {resp.status}')
+            return None
+        return text
+
+    @classmethod
+    def parse_sector_links(cls, html):
+        """
+        Sector listing links of a luatvietnam page, their title is "Lĩnh vực: <sector>"
+        :return: dict of sector -> listing url
+        """
+        soup = BeautifulSoup(html, 'lxml')
+        links = {}
+        for link in soup.find_all('a', {'title': re.compile('^Lĩnh vực')}):
+            title = link.get('title')
+            colon_index = title.find(':')
+            href = link.get('href')
+            if colon_index == -1 or not href:
+                continue
+            links.setdefault(title[colon_index + 1:].strip(), href)
+        return links
+
+    @classmethod
+    def is_unique_serial(cls, serial_number):
+        """
+        A serial number without its year, like '01/VBHN-BTP', is reused every year and names several documents
+        """
+        return re.search(r'/\d{4}/', serial_number) is not None
+
+    @classmethod
+    async def crawl_sector_listing(cls, session, semaphore, sector, url, sector_map):
+        """
+        Page through one sector listing and add its serial numbers to sector_map
+        :return: number of listed documents
+        """
+        if not url.startswith('http'):
+            url = cls._luat_vn_base_url + url.lstrip('/')
+        count = 0
+        previous_first = None
+        for page in range(1, cls._max_listing_pages + 1):
+            html = await cls.fetch_text(session, semaphore, url, {'page': page})
+            if html is None:
+                break
+            soup = BeautifulSoup(html, 'lxml')
+            doc_titles = soup.find_all('h2', {'class': 'doc-title'})
+            if len(doc_titles) == 0:
+                break
+            # past the last page the listing keeps returning the last page
+            first = doc_titles[0].find('a').get('href')
+            if first == previous_first:
+                break
+            previous_first = first
+
+            for doc_title in doc_titles:
+                link = doc_title.find('a')
+                title = link.get('title') or get_html_node_text(link)
+                # the title starts with the serial number of the listed document, the other ones are documents
+                # it amends or implements and are not in this sector
+                serial_numbers = extract_serial_numbers(title)
+                count += 1
+                if not serial_numbers or not cls.is_unique_serial(serial_numbers[0]):
+                    continue
+                sectors = sector_map.setdefault(resolver_key(serial_numbers[0]), [])
+                if sector not in sectors:
+                    sectors.append(sector)
+        _logger.info(f'Sector {sector}: {count} documents')
+        return count
+
+    @classmethod
+    async def build_sector_map(cls):
+        """
+        Crawl every luatvietnam sector listing
+        :return: dict of serial number key (see resolver_key) -> list of sectors
+        """
+        sector_map = {}
+        semaphore = asyncio.Semaphore(cls._max_concurrency)
+        async with aiohttp.ClientSession(trust_env=True) as session:
+            html = await cls.fetch_text(session, semaphore, cls._luat_vn_base_url + 'tim-van-ban.html')
+            if html is None:
+                return sector_map
+            sector_links = cls.parse_sector_links(html)
+            _logger.info(f'Found {len(sector_links)} sectors on luatvietnam')
+            # sorted so a document listed in many sectors always gets them in the same order
+            await asyncio.gather(*[cls.crawl_sector_listing(session, semaphore, sector, url, sector_map)
+                                   for sector, url in sorted(sector_links.items())])
+        for sectors in sector_map.values():
+            sectors.sort()
+        return sector_map
+
+    @classmethod
+    def save_sector_map(cls, sector_map):
+        os.makedirs(cls._mirror_dir, exist_ok=True)
+        path = os.path.join(cls._mirror_dir, cls._sector_map_file)
+        with open(path + '.tmp', 'w', encoding='utf-8') as map_file:
+            json.dump(sector_map, map_file, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+        cls._sector_map = sector_map
+
+    @classmethod
+    def load_sector_map(cls):
+        if cls._sector_map is None:
+            path = os.path.join(cls._mirror_dir, cls._sector_map_file)
+            if os.path.exists(path):
+                with open(path, encoding='utf-8') as map_file:
+                    cls._sector_map = json.load(map_file)
+            else:
+                cls._sector_map = {}
+        return cls._sector_map
+
+    @classmethod
+    def mirrored_sector(cls, serial_number):
+        """
+        Sector of a serial number from the last mirror, None if it was not listed
+        """
+        if not serial_number or serial_number == 'Không số' or not cls.is_unique_serial(serial_number):
+            return None
+        sectors = cls.load_sector_map().get(resolver_key(serial_number))
+        return join_sectors(sectors) if sectors else None
+
+    @classmethod
+    def apply_sector_map(cls, sector_map):
+        """
+        Write the mirrored sectors to every matching vbpl, one UPDATE per distinct sector,
+        and cache them so the crawl does not search luatvietnam for these documents again
+        :return: number of updated vbpl
+        """
+        now = datetime.now()
+        ids_by_sector = {}
+        # id -> fingerprint with the new sector, for the known vbpl index
+        fingerprints = {}
+        cache_rows = []
+        with LocalSession.begin() as session:
+            # the fingerprint columns include serial_number, title and sector
+            statement = select(Vbpl.id, *(getattr(Vbpl, column) for column in FINGERPRINT_COLUMNS)).\
+                where(Vbpl.deleted_at.is_(None))
+            for row in stream_rows(session, statement, cls._batch_size):
+                if not row.serial_number or row.serial_number == 'Không số' or \
+                        not cls.is_unique_serial(row.serial_number):
+                    continue
+                sectors = sector_map.get(resolver_key(row.serial_number))
+                if not sectors:
+                    continue
+                sector = join_sectors(sectors)
+                cache_rows.append(enrichment_cache.to_row(EnrichmentSource.LUAT_VN, row.serial_number, row.title,
+                                                          {'sector': sector}))
+                if sector != row.sector:
+                    ids_by_sector.setdefault(sector, []).append(row.id)
+                    fingerprints[row.id] = vbpl_fingerprint(row, {'sector': sector})
+
+        count = 0
+        with LocalSession.begin() as session:
+            for sector, ids in ids_by_sector.items():
+                for i in range(0, len(ids), cls._update_chunk):
+                    chunk = ids[i:i + cls._update_chunk]
+                    session.execute(update(Vbpl.__table__).where(Vbpl.id.in_(chunk)).
+                                    values(sector=sector, updated_at=now))
+                    count += len(chunk)
+            bulk_upsert(session, EnrichmentCache, cache_rows)
+
+        for sector, ids in ids_by_sector.items():
+            for doc_id in ids:
+                known_vbpl_index.set_sector(doc_id, sector, fingerprints[doc_id])
+        _logger.info(f'Applied luatvietnam sectors: {len(cache_rows)} matched, {count} updated')
+        return count
+
+    @classmethod
+    async def mirror_sectors(cls):
+        """
+        Mirror the luatvietnam sector listings and apply them to the vbpl table,
+        enrich_vbpl_sector only searches luatvietnam for the serial numbers missing from the mirror
+        :return: dict of serial number and updated vbpl counts
+        """
+        sector_map = await cls.build_sector_map()
+        if not sector_map:
+            _logger.warning('Luatvietnam sector mirror is empty, nothing applied')
+            return {'serial_numbers': 0, 'updated': 0}
+        await run_in_db(cls.save_sector_map, sector_map)
+        updated = await run_in_db(cls.apply_sector_map, sector_map)
+        return {'serial_numbers': len(sector_map), 'updated': updated}
+
+    @classmethod
+    def concetti_windows(cls, first_year=None, until=None):
+        """
+        Issue date windows covering first_year to until, sample: [(2014-01-01, 2014-02-01), ...]
+        """
+        start = datetime(first_year or cls._concetti_first_year, 1, 1)
+        until = until or datetime.now()
+        windows = []
+        while start <= until:
+            month = start.month - 1 + cls._concetti_window_months
+            end = datetime(start.year + month // 12, month % 12 + 1, 1)
+            windows.append((start, end))
+            start = end
+        return windows
+
+    @classmethod
+    def to_concetti_row(cls, item, now):
+        return {
+            'slug': item['slug'],
+            'key': item.get('key'),
+            'name': item.get('name'),
+            'number': (item.get('number') or '')[:100] or None,
+            'issue_date': parse_concetti_date(item.get('issueDate')),
+            'effective_date': parse_concetti_date(item.get('effectiveDate')),
+            'expiry_date': parse_concetti_date(item.get('expiryDate')),
+            'pdf_file': item.get('pdfFile'),
+            'fetched_at': now,
+        }
+
+    @classmethod
+    async def crawl_concetti_window(cls, session, semaphore, start, end):
+        """
+        Page through the concetti documents issued in [start, end) and queue them for the database
+        :return: number of documents
+        """
+        count = 0
+        page = 1
+        while True:
+            query_params = {
+                'target': 'document',
+                'limit': cls._concetti_page_size,
+                'page': page,
+                'select': cls._concetti_select,
+                'issueDateFrom': convert_datetime_to_str(start),
+                'issueDateTo': convert_datetime_to_str(end - timedelta(days=1)),
+            }
+            url = yarl.URL(f'{cls._concetti_base_url}/documents/search?'
+                           f'{concetti_query_params_url_encode(query_params)}', encoded=True)
+            text = await cls.fetch_text(session, semaphore, url)
+            if text is None:
+                _logger.warning(f'Concetti window {start:%Y-%m-%d} stopped at page {page}')
+                break
+            items = json.loads(text)['items']
+            now = datetime.now()
+            rows = [cls.to_concetti_row(item, now) for item in items if item.get('slug')]
+            if rows:
+                await db_writer.asubmit([(ConcettiDocument, rows)])
+            count += len(items)
+            if len(items) < cls._concetti_page_size:
+                break
+            page += 1
+        return count
+
+    @classmethod
+    async def mirror_concetti(cls, first_year=None):
+        """
+        Mirror the concetti documents window by window of issue date, then apply them to the vbpl table
+        :param first_year: first issue year to mirror, default _concetti_first_year
+        :return: dict of mirrored document and updated vbpl counts
+        """
+        semaphore = asyncio.Semaphore(cls._max_concurrency)
+        async with aiohttp.ClientSession(trust_env=True) as session:
+            counts = await asyncio.gather(*[cls.crawl_concetti_window(session, semaphore, start, end)
+                                            for start, end in cls.concetti_windows(first_year)])
+        await db_writer.aflush()
+        _logger.info(f'Mirrored {sum(counts)} concetti documents')
+
+        await run_in_db(cls.load_concetti_index, True)
+        updated = await run_in_db(cls.apply_concetti)
+        return {'documents': sum(counts), 'updated': updated}
+
+    @classmethod
+    def load_concetti_index(cls, reload=False):
+        if cls._concetti_index is not None and not reload:
+            return
+        with cls._concetti_lock:
+            if cls._concetti_index is not None and not reload:
+                return
+            docs = []
+            statement = select(ConcettiDocument.slug, ConcettiDocument.key, ConcettiDocument.name,
+                               ConcettiDocument.number, ConcettiDocument.issue_date,
+                               ConcettiDocument.effective_date, ConcettiDocument.expiry_date,
+                               ConcettiDocument.pdf_file)
+            with LocalSession.begin() as session:
+                docs.extend(stream_rows(session, statement, cls._batch_size))
+            cls._concetti_index = CandidateSet([text for doc in docs for text in (doc.name, doc.number, doc.key)])
+            cls._concetti_docs = docs
+            _logger.info(f'Loaded {len(docs)} concetti documents')
+
+    @classmethod
+    def _concetti_date_match(cls, vbpl, doc):
+        # the same filters the concetti search is called with, documents issued or effective from the vbpl dates
+        for vbpl_date, doc_date in ((vbpl.issuance_date, doc.issue_date),
+                                    (vbpl.effective_date, doc.effective_date),
+                                    (vbpl.expiration_date, doc.expiry_date)):
+            if vbpl_date is not None and (doc_date is None or doc_date < vbpl_date):
+                return False
+        return True
+
+    @classmethod
+    def concetti_item(cls, doc):
+        return {
+            'slug': doc.slug,
+            'effectiveDate': doc.effective_date.strftime('%Y-%m-%d') if doc.effective_date else None,
+            'expiryDate': doc.expiry_date.strftime('%Y-%m-%d') if doc.expiry_date else None,
+            'pdfFile': doc.pdf_file,
+        }
+
+    @classmethod
+    def match_concetti_batch(cls, vbpl_list):
+        """
+        Find vbpl in the concetti mirror, same keys, date filters and threshold as
+        VbplService.find_concetti_item: title first, then sub title, then serial number
+        :param vbpl_list: Vbpl or rows with the title, serial number and dates
+        :return: one concetti item dict per vbpl, None when the mirror has no similar document
+        """
+        items = [None] * len(vbpl_list)
+        if not cls._concetti_docs:
+            return items
+        for key in ('title', 'sub_title', 'serial_number'):
+            pending = [position for position, vbpl in enumerate(vbpl_list)
+                       if items[position] is None and getattr(vbpl, key)]
+            matches = batch_match([getattr(vbpl_list[position], key) for position in pending], cls._concetti_index,
+                                  cls._concetti_threshold, cls._concetti_match_limit)
+            for position, candidates in zip(pending, matches):
+                for candidate, _ in candidates:
+                    # name, number and key of every document, in this order
+                    doc = cls._concetti_docs[candidate // 3]
+                    if cls._concetti_date_match(vbpl_list[position], doc):
+                        items[position] = cls.concetti_item(doc)
+                        break
+        return items
+
+    @classmethod
+    def match_concetti(cls, vbpl):
+        """
+        :return: concetti item dict, None when the mirror is not loaded or has no similar document
+        """
+        return cls.match_concetti_batch([vbpl])[0]
+
+    @classmethod
+    def apply_concetti(cls):
+        """
+        Match every vbpl against the concetti mirror and write the dates and states in multi-row upserts.
+        The matched items are cached so the crawl reuses them, the pdf is downloaded by the crawl since
+        it also needs the local file.
+        :return: number of updated vbpl
+        """
+        cls.load_concetti_index()
+        now = datetime.now()
+        statement = select(Vbpl.id, Vbpl.title, Vbpl.sub_title, Vbpl.serial_number, Vbpl.issuance_date,
+                           Vbpl.effective_date, Vbpl.expiration_date, Vbpl.state).\
+            where(Vbpl.deleted_at.is_(None))
+        with LocalSession.begin() as session:
+            vbpl_rows = list(stream_rows(session, statement, cls._batch_size))
+
+        rows = []
+        cache_rows = []
+        for row, item in zip(vbpl_rows, cls.match_concetti_batch(vbpl_rows)):
+            if item is None:
+                continue
+            cache_rows.append(enrichment_cache.to_row(EnrichmentSource.CONCETTI, row.serial_number, row.title, item))
+            changes = concetti_dates(item, now)
+            if all(getattr(row, column) == value for column, value in changes.items()):
+                continue
+            # title and serial number are not null, the insert half of the upsert needs them
+            vbpl_row = {'id': row.id, 'title': row.title, 'serial_number': row.serial_number,
+                        'effective_date': row.effective_date, 'expiration_date': row.expiration_date,
+                        'state': row.state, 'updated_at': now}
+            vbpl_row.update(changes)
+            rows.append(vbpl_row)
+
+        with LocalSession.begin() as session:
+            bulk_upsert(session, Vbpl, rows, ['effective_date', 'expiration_date', 'state', 'updated_at'])
+            bulk_upsert(session, EnrichmentCache, cache_rows)
+        _logger.info(f'Applied concetti: {len(cache_rows)} matched, {len(rows)} updated')
+        return len(rows)
@@ -0,0 +1,173 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import DateTime, Integer, select
+
+from app.helper.custom_exception import CommonException
+from app.helper.db import LocalSession
+from app.helper.db_writer import db_writer
+from app.helper.logger import setup_logger
+from app.helper.sql_export import stream_rows
+from app.model import Anle, AnleSection, Vbpl, VbplDocMap, VbplRelatedDocument, VbplToanVan
+from app.model.vbpl import VbplSubPart
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+_logger = setup_logger('export_logger', 'log/export.log')
+
+
+class ExportService:
+    _export_dir = 'documents/export'
+    _watermark_file = 'watermark.json'
+    # rows per parquet row group, also the number of rows held in memory
+    _batch_size = 10000
+    # a new part file is started after this many rows
+    _rows_per_file = 500000
+    # updated_at is stamped when a crawl thread builds the row, the batch writer can commit it later than that,
+    # after the export read the table; the watermark is moved back by more than a row waits in the writer
+    _watermark_margin = timedelta(minutes=10)
+
+    # table -> (model, parent model, join between the two)
+    # tables without updated_at follow their parent, the parent is touched whenever its children change
+    _tables = {
+        'vbpl': (Vbpl, None, None),
+        'vbpl_toan_van': (VbplToanVan, Vbpl, VbplToanVan.vbpl_id == Vbpl.id),
+        'vbpl_sub_part': (VbplSubPart, Vbpl, VbplSubPart.vbpl_id == Vbpl.id),
+        'vbpl_related_document': (VbplRelatedDocument, Vbpl, VbplRelatedDocument.source_id == Vbpl.id),
+        'vbpl_doc_map': (VbplDocMap, Vbpl, VbplDocMap.source_id == Vbpl.id),
+        'anle': (Anle, None, None),
+        'anle_section': (AnleSection, None, None),
+    }
+
+    @classmethod
+    def _arrow_type(cls, column):
+        if isinstance(column.type, Integer):
+            return pyarrow.int64()
+        if isinstance(column.type, DateTime):
+            return pyarrow.timestamp('us')
+        return pyarrow.string()
+
+    @classmethod
+    def _schema(cls, table):
+        return pyarrow.schema([pyarrow.field(column.name, cls._arrow_type(column), nullable=column.nullable)
+                               for column in table.columns])
+
+    @classmethod
+    def load_watermark(cls):
+        path = os.path.join(cls._export_dir, cls._watermark_file)
+        if not os.path.exists(path):
+            return {}
+        with open(path, encoding='utf-8') as watermark_file:
+            return {table: datetime.fromisoformat(value) for table, value in json.load(watermark_file).items()}
+
+    @classmethod
+    def save_watermark(cls, watermark):
+        os.makedirs(cls._export_dir, exist_ok=True)
+        path = os.path.join(cls._export_dir, cls._watermark_file)
+        # written to a temporary file first so an interrupted export never leaves a broken watermark
+        with open(path + '.tmp', 'w', encoding='utf-8') as watermark_file:
+            json.dump({table: value.isoformat() for table, value in watermark.items()}, watermark_file, indent=2)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def export_all(cls, incremental=False):
+        """
+        Export every table to documents/export/<table>/run=<time>/part-<n>.parquet
+        An incremental export only contains the rows changed since the previous export; for the tables
+        without updated_at it contains all the children of the changed parents, so a consumer can replace
+        the children of these parents.
+        Rows updated in the last _watermark_margin before an export are exported again by the next one, a
+        consumer upserts the rows on their primary key.
+        Deletions are not in the incremental export: the crawler only deletes children, which are replaced with
+        their parent, but a vbpl or anle row deleted or given a deleted_at without touching updated_at only
+        disappears from a full export.
+        :param incremental: False for a full export
+        :return: dict of table -> number of exported rows
+        """
+        if pyarrow is None:
+            raise CommonException(500, 'pyarrow is required for the parquet export')
+
+        watermark = cls.load_watermark() if incremental else {}
+        # rows still queued in this process are committed first, a crawl running in another process is covered
+        # by the margin
+        db_writer.flush()
+        # updated_at is written by the crawler clock, so is the watermark
+        export_time = datetime.now()
+        run_name = f'run={export_time:%Y%m%dT%H%M%S}'
+
+        counts = {}
+        for table_name in cls._tables.keys():
+            counts[table_name] = cls.export_table(table_name, run_name, watermark.get(table_name))
+            watermark[table_name] = export_time - cls._watermark_margin
+            # saved per table so a failed export resumes from the tables already done
+            cls.save_watermark(watermark)
+        return counts
+
+    @classmethod
+    def export_table(cls, table_name, run_name, since=None):
+        """
+        Stream one table into parquet files, one row group per batch
+        :param table_name: key of _tables
+        :param run_name: partition directory of this export
+        :param since: only export rows updated after it, None for all rows
+        :return: number of exported rows
+        """
+        model, parent_model, parent_join = cls._tables[table_name]
+        table = model.__table__
+        statement = select(table)
+        if since is not None:
+            if parent_model is None:
+                statement = statement.where(table.c.updated_at > since)
+            else:
+                statement = statement.join(parent_model.__table__, parent_join). \
+                    where(parent_model.updated_at > since)
+        statement = statement.order_by(*table.primary_key.columns)
+
+        schema = cls._schema(table)
+        folder = os.path.join(cls._export_dir, table_name, run_name)
+        os.makedirs(folder, exist_ok=True)
+
+        writer = None
+        file_index = 0
+        file_rows = 0
+        count = 0
+        batch = []
+
+        def write_batch():
+            nonlocal writer, file_index, file_rows
+            if writer is None:
+                path = os.path.join(folder, f'part-{file_index:05d}.parquet')
+                writer = pyarrow.parquet.ParquetWriter(path, schema, compression='zstd')
+            columns = list(zip(*batch))
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema))
+            file_rows += len(batch)
+            if file_rows >= cls._rows_per_file:
+                writer.close()
+                writer = None
+                file_index += 1
+                file_rows = 0
+
+        try:
+            with LocalSession.begin() as session:
+                for row in stream_rows(session, statement, cls._batch_size):
+                    batch.append(tuple(row))
+                    if len(batch) >= cls._batch_size:
+                        write_batch()
+                        count += len(batch)
+                        batch = []
+                if batch:
+                    write_batch()
+                    count += len(batch)
+        finally:
+            if writer is not None:
+                writer.close()
+
+        _logger.info(f'Export {count} rows of {table_name} to {folder}'
+                     + (f' (updated after {since})' if since is not None else ''))
+        return count
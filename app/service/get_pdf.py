@@ -6,6 +6,7 @@ import requests
 import requests.packages
 import urllib3.exceptions
 
+from app.helper.concurrency import host_breakers, host_limiters, is_overload_status
 from app.helper.logger import setup_logger
 
 _logger = setup_logger('pdf_logger', 'log/pdf.log')
@@ -34,7 +35,17 @@ def get_document(document_url, is_vbpl, file_id=None, is_pdf_file=None):
         os.makedirs(doc_folder_path, exist_ok=True)
 
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-        response = requests.get(document_url, verify=False)
+        breaker = host_breakers.get(document_url)
+        if not breaker.allow():
+            raise Exception(f"Circuit of {breaker.host} is open")
+        try:
+            with host_limiters.get(document_url).blocking_slot() as outcome:
+                response = requests.get(document_url, verify=False)
+                outcome.status = response.status_code
+        except requests.RequestException:
+            breaker.record(True)
+            raise
+        breaker.record(is_overload_status(response.status_code))
 
         if is_vbpl:
             file_name_from_url = os.path.basename(document_url)
@@ -0,0 +1,181 @@
+from sqlalchemy import and_, bindparam, text, tuple_, type_coerce, update, LargeBinary
+
+from app.helper.compression import CODEC_NONE, compress_text, decompress_text, get_default_codec, stored_codec, \
+    text_column_type
+from app.helper.db import LocalSession
+from app.helper.logger import setup_logger
+from app.helper.utility import content_hash
+from app.model import Vbpl, VbplHtml, VbplToanVan, AnleSection
+from app.model.vbpl import VbplSubPart
+
+_logger = setup_logger('maintenance_logger', 'log/maintenance.log')
+
+
+class MaintenanceService:
+    _batch_size = 500
+
+    @classmethod
+    def backfill_content_hash(cls):
+        """
+        Fill html_hash / content_hash of the rows written before the hash columns existed
+        :return: number of updated rows
+        """
+        total = cls.backfill_hash_column(VbplHtml, [VbplHtml.vbpl_id], VbplHtml.html_hash, [VbplHtml.html])
+        total += cls.sync_vbpl_html_hash()
+        total += cls.backfill_hash_column(VbplToanVan, [VbplToanVan.vbpl_id, VbplToanVan.section_number],
+                                          VbplToanVan.content_hash,
+                                          [getattr(VbplToanVan, column) for column in VbplToanVan.hashed_columns])
+        total += cls.backfill_hash_column(VbplSubPart, [VbplSubPart.vbpl_id, VbplSubPart.sub_section_part_number],
+                                          VbplSubPart.content_hash,
+                                          [getattr(VbplSubPart, column) for column in VbplSubPart.hashed_columns])
+        total += cls.backfill_hash_column(AnleSection, [AnleSection.id], AnleSection.content_hash,
+                                          [getattr(AnleSection, column) for column in AnleSection.hashed_columns])
+        return total
+
+    @classmethod
+    def sync_vbpl_html_hash(cls):
+        """
+        Copy vbpl_html.html_hash to the vbpl rows missing it, the crawler fingerprints vbpl with it
+        :return: number of updated rows
+        """
+        statement = update(Vbpl.__table__). \
+            where(Vbpl.id == VbplHtml.vbpl_id). \
+            where(Vbpl.html_hash.is_(None)). \
+            where(VbplHtml.html_hash.isnot(None)). \
+            values(html_hash=VbplHtml.html_hash, updated_at=Vbpl.updated_at)
+        with LocalSession.begin() as session:
+            updated = session.execute(statement).rowcount
+        _logger.info(f'Backfill vbpl.html_hash from vbpl_html: {updated} rows')
+        return updated
+
+    @classmethod
+    def backfill_hash_column(cls, model, key_columns, hash_column, source_columns):
+        """
+        Walk the rows with an empty hash in primary key order and fill the hash batch by batch
+        :param model:
+        :param key_columns: primary key columns
+        :param hash_column:
+        :param source_columns: hashed columns, in the same order as the writer hashes them
+        :return: number of updated rows
+        """
+        statement = update(model.__table__). \
+            where(and_(*(column == bindparam(f'b_{column.key}') for column in key_columns))). \
+            values({hash_column.key: bindparam('b_hash')})
+
+        last_key = None
+        updated = 0
+        while True:
+            with LocalSession.begin() as session:
+                query = session.query(*key_columns, *source_columns).filter(hash_column.is_(None))
+                if last_key is not None:
+                    query = query.filter(tuple_(*key_columns) > last_key)
+                rows = query.order_by(*key_columns).limit(cls._batch_size).all()
+                if not rows:
+                    break
+
+                params = []
+                for row in rows:
+                    param = {f'b_{column.key}': row[index] for index, column in enumerate(key_columns)}
+                    param['b_hash'] = content_hash(*row[len(key_columns):])
+                    params.append(param)
+                session.execute(statement, params)
+
+            last_key = tuple(rows[-1][:len(key_columns)])
+            updated += len(rows)
+            _logger.info(f'Backfill {model.__tablename__}.{hash_column.key}: {updated} rows')
+        return updated
+
+    @classmethod
+    def recompress_text(cls, codec=None):
+        """
+        Rewrite vbpl_html.html and vbpl_toan_van.section_content with the given codec, the columns are turned
+        into LONGBLOB before writing compressed values and back into LONGTEXT once they hold plain text only
+        :param codec: none, zlib or zstd, default DB_COMPRESSION
+        :return: number of rewritten rows
+        """
+        codec = codec or get_default_codec()
+        total = 0
+        for model, key_columns, column in ((VbplHtml, [VbplHtml.vbpl_id], VbplHtml.html),
+                                           (VbplToanVan, [VbplToanVan.vbpl_id, VbplToanVan.section_number],
+                                            VbplToanVan.section_content)):
+            if codec == CODEC_NONE:
+                # a LONGTEXT column holds plain text only
+                if cls.get_column_data_type(model, column) == 'longtext':
+                    continue
+                total += cls.recompress_column(model, key_columns, column, codec)
+                cls.set_text_column_type(model, column, codec)
+            else:
+                cls.set_text_column_type(model, column, codec)
+                total += cls.recompress_column(model, key_columns, column, codec)
+        return total
+
+    @classmethod
+    def get_column_data_type(cls, model, column):
+        """
+        :return: lowercase mysql data type of the column, sample: longtext
+        """
+        with LocalSession() as session:
+            return session.execute(text(
+                'SELECT DATA_TYPE FROM information_schema.COLUMNS '
+                'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND COLUMN_NAME = :column'),
+                {'table': model.__tablename__, 'column': column.key}).scalar().lower()
+
+    @classmethod
+    def set_text_column_type(cls, model, column, codec):
+        """
+        Alter a CompressedText column to the type of codec when it is not already, see text_column_type
+        """
+        column_type = text_column_type(codec)
+        current = cls.get_column_data_type(model, column)
+        if current == column_type.__visit_name__.lower():
+            return
+        with LocalSession.begin() as session:
+            session.execute(text(f'ALTER TABLE {model.__tablename__} MODIFY {column.key} '
+                                 f'{column_type.compile(dialect=session.get_bind().dialect)} NULL'))
+        _logger.info(f'Altered {model.__tablename__}.{column.key} from {current} to {column_type}')
+
+    @classmethod
+    def recompress_column(cls, model, key_columns, column, codec):
+        """
+        Walk the rows in primary key order and rewrite the values not stored with codec
+        :param model:
+        :param key_columns: primary key columns
+        :param column: CompressedText column
+        :param codec:
+        :return: number of rewritten rows
+        """
+        # read and write the raw bytes, the column type would decompress / compress them again
+        raw_column = type_coerce(column, LargeBinary)
+        statement = update(model.__table__). \
+            where(and_(*(key == bindparam(f'b_{key.key}') for key in key_columns))). \
+            values({column.key: type_coerce(bindparam('b_value'), LargeBinary)})
+
+        last_key = None
+        scanned = 0
+        rewritten = 0
+        while True:
+            with LocalSession.begin() as session:
+                query = session.query(*key_columns, raw_column).filter(column.isnot(None))
+                if last_key is not None:
+                    query = query.filter(tuple_(*key_columns) > last_key)
+                rows = query.order_by(*key_columns).limit(cls._batch_size).all()
+                if not rows:
+                    break
+
+                params = []
+                for row in rows:
+                    value = row[len(key_columns)]
+                    if stored_codec(value) == codec:
+                        continue
+                    param = {f'b_{key.key}': row[index] for index, key in enumerate(key_columns)}
+                    param['b_value'] = compress_text(decompress_text(value), codec)
+                    params.append(param)
+                if params:
+                    session.execute(statement, params)
+
+            last_key = tuple(rows[-1][:len(key_columns)])
+            scanned += len(rows)
+            rewritten += len(params)
+            _logger.info(f'Recompress {model.__tablename__}.{column.key} to {codec}: '
+                         f'{rewritten} of {scanned} rows rewritten')
+        return rewritten
@@ -0,0 +1,106 @@
+import time
+
+from sqlalchemy import select
+
+from app.helper.db import LocalSession
+from app.helper.logger import setup_logger
+from app.helper.sql_export import stream_rows
+from app.model import Anle, AnleSection, Vbpl, VbplToanVan
+from app.model.vbpl import VbplSubPart
+from app.search import search_index
+from setting import setting
+
+_logger = setup_logger('search_service_logger', 'log/search_service.log')
+
+
+class SearchService:
+    _batch_size = 1000
+
+    @classmethod
+    def iter_documents(cls, session):
+        """
+        Every searchable document as (key, content hash, text), read with a server side cursor
+        """
+        statement = select(VbplToanVan.vbpl_id, VbplToanVan.section_number, VbplToanVan.content_hash,
+                           VbplToanVan.section_name, VbplToanVan.section_content)
+        for row in stream_rows(session, statement, cls._batch_size):
+            yield (f'vbpl_toan_van:{row.vbpl_id}:{row.section_number}', row.content_hash,
+                   f'{row.section_name or ""}\n{row.section_content or ""}')
+
+        statement = select(VbplSubPart.vbpl_id, VbplSubPart.sub_section_part_number, VbplSubPart.content_hash,
+                           VbplSubPart.sub_section_title, VbplSubPart.sub_section_part_title)
+        for row in stream_rows(session, statement, cls._batch_size):
+            yield (f'vbpl_sub_part:{row.vbpl_id}:{row.sub_section_part_number}', row.content_hash,
+                   f'{row.sub_section_title or ""}\n{row.sub_section_part_title or ""}')
+
+        statement = select(Anle.doc_id, AnleSection.content_hash, AnleSection.context, AnleSection.solution,
+                           AnleSection.content).join(Anle, AnleSection.anle_id == Anle.id)
+        for row in stream_rows(session, statement, cls._batch_size):
+            yield (f'anle_section:{row.doc_id}', row.content_hash,
+                   f'{row.context or ""}\n{row.solution or ""}\n{row.content or ""}')
+
+    @classmethod
+    def rebuild_index(cls, fold=None):
+        """
+        Build the search index from scratch, later crawls keep it up to date
+        :param fold: fold diacritics, default SEARCH_FOLD_DIACRITICS
+        :return: number of indexed documents
+        """
+        start = time.perf_counter()
+        search_index.create(setting.SEARCH_FOLD_DIACRITICS if fold is None else fold)
+        search_index.auto_merge = False
+        try:
+            batch = []
+            with LocalSession.begin() as session:
+                for doc in cls.iter_documents(session):
+                    batch.append(doc)
+                    if len(batch) >= cls._batch_size:
+                        search_index.add_documents(batch)
+                        batch = []
+                search_index.add_documents(batch)
+            search_index.merge()
+        finally:
+            search_index.auto_merge = True
+
+        count = len(search_index)
+        _logger.info(f'Rebuild search index: {count} documents in {time.perf_counter() - start:.1f}s')
+        return count
+
+    @classmethod
+    def search(cls, query, limit=10):
+        """
+        Search the index and attach the title of every hit
+        :param query:
+        :param limit:
+        :return: list of dict with key, score, title and section
+        """
+        if not search_index.exists():
+            return []
+        hits = search_index.search(query, limit)
+
+        vbpl_ids = set()
+        anle_doc_ids = set()
+        for key, _ in hits:
+            parts = key.split(':')
+            if parts[0] == 'anle_section':
+                anle_doc_ids.add(parts[1])
+            else:
+                vbpl_ids.add(int(parts[1]))
+
+        with LocalSession.begin() as session:
+            vbpl_titles = dict(session.query(Vbpl.id, Vbpl.title).filter(Vbpl.id.in_(vbpl_ids)).all()) \
+                if vbpl_ids else {}
+            anle_titles = dict(session.query(Anle.doc_id, Anle.title).filter(Anle.doc_id.in_(anle_doc_ids)).all()) \
+                if anle_doc_ids else {}
+
+        results = []
+        for key, score in hits:
+            parts = key.split(':')
+            if parts[0] == 'anle_section':
+                title = anle_titles.get(parts[1])
+                section = None
+            else:
+                title = vbpl_titles.get(int(parts[1]))
+                section = parts[2]
+            results.append({'key': key, 'score': score, 'title': title, 'section': section})
+        return results
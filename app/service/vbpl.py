@@ -5,25 +5,38 @@ import copy
 from datetime import datetime
 from http import HTTPStatus
 from typing import Dict
-import aiohttp
 import yarl
 import concurrent.futures
 from app.entity.vbpl import VbplFullTextField
-from app.helper.custom_exception import CommonException
-from app.helper.enum import VbplTab, VbplType
+from app.helper.custom_exception import CommonException, UpstreamError
+from app.helper.enum import CrawlStage, EnrichmentSource, VbplTab, VbplType
+from app.helper.enrichment_cache import MISS, enrichment_cache
+from app.helper.concurrency import SharedLimit, host_limiters
+from app.helper.http_client import HedgedHttpClient, fetch
 from time import sleep
 from app.helper.logger import setup_logger
-from app.model import VbplToanVan, Vbpl, VbplRelatedDocument, VbplDocMap
+from app.model import VbplToanVan, Vbpl, VbplRelatedDocument, VbplDocMap, VbplHtml
 from app.model.vbpl import VbplSubPart
+from app.service.enrichment import EnrichmentService, concetti_dates
 from app.service.get_pdf import get_document
 from setting import setting
 from app.helper.utility import convert_dict_to_pascal, get_html_node_text, convert_datetime_to_str, \
-    concetti_query_params_url_encode, convert_str_to_datetime, check_header_tag
-from app.helper.db import LocalSession
+    concetti_query_params_url_encode, convert_str_to_datetime, check_header_tag, content_hash
+from sqlalchemy import delete, select, update
+from app.helper.db import run_in_db, run_in_session
+from app.helper.db_writer import db_writer
+from app.helper.dead_letter import dead_letters
+from app.helper.vbpl_index import known_vbpl_index, vbpl_fingerprint
+from app.helper.fuzzy_match import best_match
+from app.helper.vbpl_resolver import vbpl_resolver
+from app.helper.tab_probe import tab_probe_order
+from app.helper.bulk_upsert import bulk_upsert, model_to_row, sync_edges, upsert_changed
+from app.graph import EDGE_KINDS, discovery_frontier, document_graph
+from app.helper.archive import ArchiveBuilder
+from app.helper.sql_export import stream_rows, write_insert_statements
+from app.search import search_index
 from urllib.parse import quote
-import Levenshtein
 from bs4 import BeautifulSoup
-import py7zr
 
 _logger = setup_logger('vbpl_logger', 'log/vbpl.log')
 find_id_regex = '(?<=ItemID=)\\d+'
@@ -32,7 +45,11 @@ find_id_regex = '(?<=ItemID=)\\d+'
 class VbplService:
     _api_base_url = setting.VBPl_BASE_URL
     _default_row_per_page = 130
-    _max_threads = 8
+    _max_threads = setting.CRAWL_MAX_THREADS
+    # documents crawling each edge stage at the same time, shared by the page threads; below the number of
+    # page threads so the other threads keep crawling documents, the doc map also searches the missing links
+    _related_doc_limit = SharedLimit('related_doc', setting.CRAWL_RELATED_DOC_THREADS or setting.CRAWL_MAX_THREADS // 2)
+    _doc_map_limit = SharedLimit('doc_map', setting.CRAWL_DOC_MAP_THREADS or setting.CRAWL_MAX_THREADS // 4)
     _find_big_part_regex = '^((Phần)|(Phần thứ)) (nhất|hai|ba|bốn|năm|sáu|bảy|tám|chín|mười)$'
     _find_section_regex = '^((Điều)|(Điều thứ)) \\d+'
     _find_chapter_regex = '^Chương [IVX]+'
@@ -46,30 +63,32 @@ class VbplService:
     _tvpl_base_url = setting.TVPL_BASE_URL
     _cong_bao_base_url = setting.CONG_BAO_BASE_URL
     _luat_vn_base_url = setting.LUAT_VN_BASE_URL
+    _http = HedgedHttpClient('vbpl', hedge=setting.VBPL_HEDGE_REQUESTS)
 
     @classmethod
     def get_headers(cls) -> Dict:
         return {'Content-Type': 'application/json'}
 
     # base url call to use in later functions
+    # the timeout follows the latency of the page, slow GETs are hedged with a second request
+    # raises UpstreamError once the retries are exhausted instead of returning None
     @classmethod
-    async def call(cls, method: str, url_path: str, query_params=None, json_data=None, timeout=90):
+    async def call(cls, method: str, url_path: str, query_params=None, json_data=None):
         url = cls._api_base_url + url_path
         headers = cls.get_headers()
         try:
-            async with aiohttp.ClientSession(trust_env=True) as session:
-                async with session.request(method, url, params=query_params, json=json_data, timeout=timeout,
-                                           headers=headers) as resp:
-                    await resp.text()
+            resp = await cls._http.request(method, url, endpoint=url_path, params=query_params, json=json_data,
+                                           headers=headers)
             if resp.status != HTTPStatus.OK:
                 _logger.warning(
                     "Calling VBPL URL: %s, request_param %s, request_payload %s, http_code: %s, response: %s" %
                     (url, str(query_params), str(json_data), str(resp.status), resp.text))
             return resp
-        except Exception as e:
+        except UpstreamError as e:
             _logger.warning(f"Calling VBPL URL: {url},"
                             f" request_params {str(query_params)}, request_body {str(json_data)},"
                             f" error {str(e)}")
+            raise
 
     # get total number of vbpl
     @classmethod
@@ -94,27 +113,38 @@ class VbplService:
     @classmethod
     async def crawl_all_vbpl(cls, vbpl_type: VbplType):
         # total_doc = await cls.get_total_doc(vbpl_type)
+        await run_in_db(known_vbpl_index.ensure_loaded)
+        await run_in_db(vbpl_resolver.ensure_loaded)
+        await run_in_db(EnrichmentService.load_concetti_index)
+        await run_in_db(dead_letters.ensure_loaded)
         total_pages = 1000
-        full_id_list = []
-
-        # crawl all vbpl info and full text using multi thread
-        with concurrent.futures.ThreadPoolExecutor(max_workers=cls._max_threads) as executor:
-            info_and_fulltext_coroutines = [cls.crawl_vbpl_in_one_page(page, full_id_list, vbpl_type) for page in
-                                            range(1, total_pages + 1)]
-            executor.map(asyncio.run, info_and_fulltext_coroutines)
-
-        # crawl vbpl relate doc using multi thread
-        with concurrent.futures.ThreadPoolExecutor(max_workers=cls._max_threads) as executor:
-            related_doc_coroutines = [cls.crawl_vbpl_related_doc(doc_id) for doc_id in full_id_list]
-            executor.map(asyncio.run, related_doc_coroutines)
 
-        # crawl vbpl doc map using multi thread
+        # crawl all vbpl info, full text and edges using multi thread, one document after the other in a page
         with concurrent.futures.ThreadPoolExecutor(max_workers=cls._max_threads) as executor:
-            doc_map_coroutines = [cls.crawl_vbpl_doc_map(doc_id, vbpl_type) for doc_id in full_id_list]
-            executor.map(asyncio.run, doc_map_coroutines)
+            page_coroutines = [cls.crawl_vbpl_in_one_page(page, vbpl_type) for page in range(1, total_pages + 1)]
+            executor.map(asyncio.run, page_coroutines)
+
+        # crawl the vbpl referenced by the edges above but missing from the database, and sync again the edges
+        # to the vbpl listed after their source
+        await db_writer.aflush()
+        await cls.crawl_discovered_vbpl()
+
+        # make sure everything batched by the writer is in the database before returning
+        await db_writer.aflush()
+        search_index.flush()
+        document_graph.flush()
+        cls._http.log_stats()
+        host_limiters.log_metrics()
+        _logger.info(f'Enrichment cache: {enrichment_cache.hits} hits, {enrichment_cache.misses} misses')
+        if db_writer.failed_units:
+            _logger.warning(f'{db_writer.failed_units} write units failed, see the dead letters')
 
     @classmethod
-    async def crawl_vbpl_in_one_page(cls, page, full_id_list, vbpl_type: VbplType):
+    async def crawl_vbpl_in_one_page(cls, page, vbpl_type: VbplType):
+        """
+        Crawl the vbpl of one listing page, a vbpl that fails goes to the dead letters and the page goes on
+        :return: False when the listing page itself failed, it is then in the dead letters
+        """
         query_params = convert_dict_to_pascal({
             'row_per_page': cls._default_row_per_page,
             'page': page
@@ -122,6 +152,8 @@ class VbplService:
         progress = 0
         max_progress = cls._default_row_per_page
 
+        # list of (id, title, sub title)
+        listing = []
         try:
             resp = await cls.call(method='GET',
                                   url_path=f'/VBQPPL_UserControls/Publishing_22/TimKiem/p_{vbpl_type.value}.aspx?IsVietNamese=True',
@@ -130,126 +162,290 @@ class VbplService:
                 soup = BeautifulSoup(await resp.text(), 'lxml')
                 titles = soup.find_all('p', {"class": "title"})
                 sub_titles = soup.find_all('div', {'class': "des"})
-                id_set = set()
 
                 for j in range(len(titles)):
-                    title = titles[j]
-                    sub_title = sub_titles[j]
-
-                    link = title.find('a')
+                    link = titles[j].find('a')
                     doc_id = int(re.findall(find_id_regex, link.get('href'))[0])
+                    listing.append((doc_id, get_html_node_text(link), get_html_node_text(sub_titles[j])))
+        except Exception as e:
+            _logger.exception(f'Crawl all doc in page {page} {e}')
+            await dead_letters.arecord(CrawlStage.PAGE, page, vbpl_type, e)
+            return False
+
+        for doc_id, title, sub_title in listing:
+            # check for existing vbpl in memory instead of querying the db
+            is_known = known_vbpl_index.contains(doc_id)
+            _logger.info(f"Crawling {'known' if is_known else 'new'} vbpl {doc_id}")
+
+            new_vbpl = Vbpl(
+                id=doc_id,
+                title=title,
+                sub_title=sub_title
+            )
+            try:
+                await cls.crawl_vbpl_document(new_vbpl, vbpl_type)
+            except Exception as e:
+                _logger.exception(f'Crawl vbpl {doc_id} in page {page} {e}')
+                await dead_letters.arecord(CrawlStage.DOCUMENT, doc_id, vbpl_type, e)
+                continue
+            # the writer commits units in submit order, the vbpl row is written before its edges
+            await cls.crawl_vbpl_edges(doc_id, vbpl_type)
+
+            # update progress
+            progress += 1
+            _logger.info(f'Finished crawling vbpl {doc_id}')
+            _logger.info(f"Page {page} progress: {progress}/{max_progress}")
+        # the vbpl of the page that failed have their own dead letters, the page itself writes nothing
+        await dead_letters.aresolve_recorded(CrawlStage.PAGE, page, vbpl_type)
+        sleep(3)
+        return True
 
-                    _logger.info(f"Crawling vbpl {doc_id}")
-                    id_set.add(doc_id)
-                    full_id_list.append(doc_id)
+    @classmethod
+    async def crawl_vbpl_document(cls, new_vbpl: Vbpl, vbpl_type: VbplType, skip_missing=False):
+        """
+        Crawl the tabs of one vbpl and its third-party sources then submit it to the writer, its edges are
+        crawled apart
+        :param skip_missing: do not write anything when the attribute page has no document, the id may be
+        of the other vbpl type
+        :return: False when skipped
+        """
+        vbpl_fulltext = None
+        vbpl_sub_part = None
 
-                    # check for existing vbpl
-                    with LocalSession.begin() as session:
-                        check_vbpl = session.query(Vbpl).filter(Vbpl.id == doc_id).first()
+        if vbpl_type == VbplType.PHAP_QUY:
+            await cls.crawl_vbpl_phapquy_info(new_vbpl)
+            if skip_missing and new_vbpl.title is None:
+                return False
+            await cls.crawl_vbpl_pdf(new_vbpl, vbpl_type)
+            vbpl_fulltext, vbpl_sub_part = await cls.crawl_vbpl_phapquy_fulltext(new_vbpl)
+            await cls.search_concetti(new_vbpl)
+            await cls.enrich_vbpl_sector(new_vbpl)
 
-                    # if it does not exist, add to db
-                    new_vbpl = Vbpl(
-                        id=doc_id,
-                        title=get_html_node_text(link),
-                        sub_title=get_html_node_text(sub_title)
-                    )
-                    vbpl_fulltext = None
-                    vbpl_sub_part = None
-
-                    if vbpl_type == VbplType.PHAP_QUY:
-                        await cls.crawl_vbpl_phapquy_info(new_vbpl)
-                        await cls.crawl_vbpl_pdf(new_vbpl, vbpl_type)
-                        vbpl_fulltext, vbpl_sub_part = await cls.crawl_vbpl_phapquy_fulltext(new_vbpl)
-                        await cls.search_concetti(new_vbpl)
-                        await cls.enrich_vbpl_sector(new_vbpl)
-
-                    elif vbpl_type == VbplType.HOP_NHAT:
-                        await cls.crawl_vbpl_hopnhat_info(new_vbpl)
-                        await cls.crawl_vbpl_pdf(new_vbpl, vbpl_type)
-                        await cls.crawl_vbpl_hopnhat_fulltext(new_vbpl)
-                        await cls.search_concetti(new_vbpl)
-                        await cls.enrich_vbpl_sector(new_vbpl)
-                        vbpl_fulltext, vbpl_sub_part = await cls.additional_html_crawl(new_vbpl)
-
-                    # add to db
-                    await cls.push_vbpl_to_db(doc_id, new_vbpl, vbpl_fulltext, vbpl_sub_part)
-
-                    # update progress
-                    progress += 1
-                    _logger.info(f'Finished crawling vbpl {doc_id}')
-                    _logger.info(f"Page {page} progress: {progress}/{max_progress}")
-            sleep(3)
-        except Exception as e:
-            _logger.exception(f'Crawl all doc in page {page} {e}')
-            raise CommonException(500, 'Crawl all doc')
+        elif vbpl_type == VbplType.HOP_NHAT:
+            await cls.crawl_vbpl_hopnhat_info(new_vbpl)
+            if skip_missing and new_vbpl.title is None:
+                return False
+            await cls.crawl_vbpl_pdf(new_vbpl, vbpl_type)
+            await cls.crawl_vbpl_hopnhat_fulltext(new_vbpl)
+            await cls.search_concetti(new_vbpl)
+            await cls.enrich_vbpl_sector(new_vbpl)
+            vbpl_fulltext, vbpl_sub_part = await cls.additional_html_crawl(new_vbpl)
+
+        # add to db
+        await cls.push_vbpl_to_db(new_vbpl.id, new_vbpl, vbpl_fulltext, vbpl_sub_part, vbpl_type)
+        return True
 
     @classmethod
-    async def push_vbpl_to_db(cls, doc_id, new_vbpl, vbpl_fulltext, vbpl_sub_part):
-        with LocalSession.begin() as session:
-            check_vbpl = session.query(Vbpl).filter(Vbpl.id == doc_id).first()
-            if check_vbpl is not None:
-                # upsert vbpl
-                update_vbpl = {
-                    'file_link': new_vbpl.file_link,
-                    'title': new_vbpl.title,
-                    'doc_type': new_vbpl.doc_type,
-                    'serial_number': new_vbpl.serial_number,
-                    'issuance_date': new_vbpl.issuance_date,
-                    'effective_date': new_vbpl.effective_date,
-                    'expiration_date': new_vbpl.expiration_date,
-                    'gazette_date': new_vbpl.gazette_date,
-                    'state': new_vbpl.state,
-                    'issuing_authority': new_vbpl.issuing_authority,
-                    'applicable_information': new_vbpl.applicable_information,
-                    'html': new_vbpl.html,
-                    'org_pdf_link': new_vbpl.org_pdf_link,
-                    'sub_title': new_vbpl.sub_title,
-                    'sector': new_vbpl.sector,
-                }
-                session.query(Vbpl).filter(Vbpl.id == doc_id).update(update_vbpl)
+    async def crawl_vbpl_edges(cls, doc_id, vbpl_type: VbplType):
+        """
+        Related docs then doc map of one vbpl, each stage under its own concurrency limit.
+        A failed stage goes to the dead letters and only loses the edges of this vbpl, a stage that succeeds
+        deletes its dead letter with its edges, see push_vbpl_edges_to_db.
+        """
+        async with cls._related_doc_limit.slot():
+            try:
+                await cls.crawl_vbpl_related_doc(doc_id, vbpl_type)
+            except CommonException as e:
+                await dead_letters.arecord(CrawlStage.RELATED_DOC, doc_id, vbpl_type, e)
+        async with cls._doc_map_limit.slot():
+            try:
+                await cls.crawl_vbpl_doc_map(doc_id, vbpl_type)
+            except CommonException as e:
+                await dead_letters.arecord(CrawlStage.DOC_MAP, doc_id, vbpl_type, e)
+
+    @classmethod
+    async def retry_dead_letters(cls, limit=None):
+        """
+        Crawl again the pages, vbpl and edges in the dead letters whose retry is due, a step failing again
+        is put back with a longer delay
+        :param limit: number of steps to retry, None for all the due ones
+        :return: (retried steps, succeeded steps)
+        """
+        await run_in_db(known_vbpl_index.ensure_loaded)
+        await run_in_db(vbpl_resolver.ensure_loaded)
+        await run_in_db(EnrichmentService.load_concetti_index)
+        await run_in_db(dead_letters.ensure_loaded)
+        due = await run_in_db(dead_letters.due, limit)
+        succeeded = 0
+        for stage, item_id, vbpl_type in due:
+            _logger.info(f'Retrying {stage.value} {item_id} ({vbpl_type.name})')
+            if stage == CrawlStage.PAGE:
+                # the page deletes its dead letter when it succeeds
+                if await cls.crawl_vbpl_in_one_page(item_id, vbpl_type):
+                    succeeded += 1
+                continue
+            try:
+                if stage == CrawlStage.DOCUMENT:
+                    written = await cls.crawl_vbpl_document(Vbpl(id=item_id), vbpl_type)
+                elif stage == CrawlStage.RELATED_DOC:
+                    written = await cls.crawl_vbpl_related_doc(item_id, vbpl_type)
+                else:
+                    written = await cls.crawl_vbpl_doc_map(item_id, vbpl_type)
+            except Exception as e:
+                await dead_letters.arecord(stage, item_id, vbpl_type, e)
+                continue
+            # the unit holding what was crawled deletes the dead letter once it commits, a page without
+            # anything to write deletes it here
+            if not written:
+                await dead_letters.aresolve(stage, item_id, vbpl_type)
+            succeeded += 1
+            if stage == CrawlStage.DOCUMENT:
+                await cls.crawl_vbpl_edges(item_id, vbpl_type)
+        await db_writer.aflush()
+        search_index.flush()
+        document_graph.flush()
+        _logger.info(f'Retried {len(due)} dead letters, {succeeded} succeeded')
+        return len(due), succeeded
+
+    @classmethod
+    async def push_vbpl_to_db(cls, doc_id, new_vbpl, vbpl_fulltext, vbpl_sub_part, vbpl_type: VbplType = None):
+        now = datetime.now()
+        new_vbpl.id = doc_id
+        new_vbpl.html_hash = content_hash(new_vbpl.html)
+        fingerprint = vbpl_fingerprint(new_vbpl)
+
+        # upsert vbpl, sections and sub parts with multi-row INSERT ... ON DUPLICATE KEY UPDATE
+        # the vbpl row is skipped when neither its metadata nor its html changed since the last crawl
+        upserts = []
+        ops = []
+        if known_vbpl_index.needs_refresh(doc_id, fingerprint):
+            upserts.append((Vbpl, [model_to_row(new_vbpl, now)]))
+            # the html goes to its own table, its upsert keeps the stored html when html_hash did not change
+            if new_vbpl.html is not None:
+                upserts.append((VbplHtml, [{'vbpl_id': doc_id, 'html': new_vbpl.html,
+                                            'html_hash': new_vbpl.html_hash}]))
             else:
-                session.add(new_vbpl)
-
-            if vbpl_fulltext is not None:
-                for fulltext_section in vbpl_fulltext:
-                    check_fulltext = session.query(VbplToanVan).filter(
-                        VbplToanVan.vbpl_id == fulltext_section.vbpl_id,
-                        VbplToanVan.section_number == fulltext_section.section_number).first()
-                    if check_fulltext is None:
-                        session.add(fulltext_section)
-                    else:
-                        # upsert toan van
-                        updated_toan_van = {
-                            'section_name': fulltext_section.section_name,
-                            'section_content': fulltext_section.section_content,
-                            'chapter_number': fulltext_section.chapter_number,
-                            'chapter_name': fulltext_section.chapter_name,
-                            'part_number': fulltext_section.part_number,
-                            'part_name': fulltext_section.part_name,
-                            'mini_part_number': fulltext_section.mini_part_number,
-                            'mini_part_name': fulltext_section.mini_part_name,
-                            'big_part_number': fulltext_section.big_part_number,
-                            'big_part_name': fulltext_section.big_part_name,
-                        }
-                        session.query(VbplToanVan).filter(
-                            VbplToanVan.vbpl_id == fulltext_section.vbpl_id,
-                            VbplToanVan.section_number == fulltext_section.section_number).update(updated_toan_van)
-            if vbpl_sub_part is not None:
-                for sub_part in vbpl_sub_part:
-                    check_sub_part = session.query(VbplSubPart).filter(
-                        VbplSubPart.vbpl_id == sub_part.vbpl_id,
-                        VbplSubPart.sub_section_part_number == sub_part.sub_section_part_number).first()
-                    if check_sub_part is None:
-                        session.add(sub_part)
-                    else:
-                        # upsert sub parts
-                        updated_sub_part = {
-                            'sub_section_title': sub_part.sub_section_title,
-                            'sub_section_part_title': sub_part.sub_section_part_title
-                        }
-                        session.query(VbplSubPart).filter(
-                            VbplSubPart.vbpl_id == sub_part.vbpl_id,
-                            VbplSubPart.sub_section_part_number == sub_part.sub_section_part_number).update(updated_sub_part)
+                ops.append(lambda session: session.execute(
+                    delete(VbplHtml.__table__).where(VbplHtml.vbpl_id == doc_id)))
+
+        # an empty result means the full text could not be crawled, keep the old sections in that case
+        # only the sections whose content hash changed are written
+        if vbpl_fulltext:
+            section_rows = []
+            for section in vbpl_fulltext:
+                section.content_hash = section.compute_content_hash()
+                section_rows.append(model_to_row(section, now))
+
+            def write_sections(session):
+                if upsert_changed(session, VbplToanVan, VbplToanVan.vbpl_id == doc_id,
+                                  [VbplToanVan.section_number], section_rows):
+                    cls.touch_vbpl(session, doc_id, now)
+            ops.append(write_sections)
+
+        if vbpl_sub_part:
+            sub_part_rows = []
+            for sub_part in vbpl_sub_part:
+                sub_part.content_hash = sub_part.compute_content_hash()
+                sub_part_rows.append(model_to_row(sub_part, now))
+
+            def write_sub_parts(session):
+                if upsert_changed(session, VbplSubPart, VbplSubPart.vbpl_id == doc_id,
+                                  [VbplSubPart.sub_section_part_number], sub_part_rows):
+                    cls.touch_vbpl(session, doc_id, now)
+            ops.append(write_sub_parts)
+
+        after_commit = [lambda: known_vbpl_index.add(doc_id, fingerprint, new_vbpl.sector),
+                        lambda: vbpl_resolver.add(doc_id, new_vbpl)]
+        if upserts:
+            # a vbpl written for the first time can have edges skipped while it was missing
+            inserted_edges = {}
+            ops.append(lambda session: cls.insert_pending_edges(session, doc_id, inserted_edges))
+            after_commit.append(lambda: cls.resolve_pending_edges(doc_id, inserted_edges))
+        # keep the search index in step with the committed sections, unchanged sections are skipped by hash
+        if search_index.exists():
+            if vbpl_fulltext:
+                section_docs = [(f'vbpl_toan_van:{doc_id}:{row["section_number"]}', row['content_hash'],
+                                 f'{row["section_name"] or ""}\n{row["section_content"] or ""}')
+                                for row in section_rows]
+                after_commit.append(lambda: search_index.replace_group(f'vbpl_toan_van:{doc_id}', section_docs))
+            if vbpl_sub_part:
+                sub_part_docs = [(f'vbpl_sub_part:{doc_id}:{row["sub_section_part_number"]}', row['content_hash'],
+                                  f'{row["sub_section_title"] or ""}\n{row["sub_section_part_title"] or ""}')
+                                 for row in sub_part_rows]
+                after_commit.append(lambda: search_index.replace_group(f'vbpl_sub_part:{doc_id}', sub_part_docs))
+
+        # the crawl of a vbpl the writer could not commit is retried like a vbpl that failed to crawl
+        on_failure = []
+        if vbpl_type is not None:
+            dead_letters.resolve_in(CrawlStage.DOCUMENT, doc_id, vbpl_type, ops, after_commit)
+            on_failure.append(lambda error: dead_letters.record(CrawlStage.DOCUMENT, doc_id, vbpl_type, error))
+        await db_writer.asubmit(upserts, ops, after_commit=after_commit, on_failure=on_failure)
+
+    @classmethod
+    def touch_vbpl(cls, session, doc_id, now=None):
+        # vbpl.updated_at also moves when only its sections or edges changed, incremental exports rely on it
+        session.execute(update(Vbpl.__table__).where(Vbpl.id == doc_id).values(updated_at=now or datetime.now()))
+
+    @classmethod
+    async def push_vbpl_edges_to_db(cls, edge_model, source_id, edges, vbpl_type: VbplType = VbplType.PHAP_QUY):
+        if edge_model == VbplRelatedDocument:
+            target_column, type_column = VbplRelatedDocument.related_id, VbplRelatedDocument.doc_type
+            target_type = vbpl_type
+        else:
+            target_column, type_column = VbplDocMap.doc_map_id, VbplDocMap.doc_map_type
+            # the doc map of a hop nhat lists the consolidated phap quy
+            target_type = VbplType.PHAP_QUY
+
+        skipped_targets = set()
+
+        def sync(session):
+            # insert new edges, update changed types and delete the ones that disappeared in one diff
+            inserted, updated, deleted, skipped = sync_edges(session, edge_model, edge_model.source_id,
+                                                             target_column, type_column, source_id, edges,
+                                                             target_model=Vbpl)
+            skipped_targets.update(skipped)
+            _logger.info(f'Sync {edge_model.__tablename__} of vbpl {source_id}: {len(inserted)} inserted, '
+                         f'{len(updated)} updated, {len(deleted)} deleted')
+            if inserted or updated or deleted:
+                cls.touch_vbpl(session, source_id)
+            if skipped:
+                _logger.info(f'Skip {len(skipped)} {edge_model.__tablename__} edges of vbpl {source_id} '
+                             f'to not crawled vbpl {skipped}')
+
+        # the committed edges are the crawled ones minus the targets not crawled yet
+        kind = 'related' if edge_model == VbplRelatedDocument else 'doc_map'
+        stage = CrawlStage.RELATED_DOC if edge_model == VbplRelatedDocument else CrawlStage.DOC_MAP
+        after_commit = [lambda: document_graph.replace_edges(
+            kind, source_id, {target: edge_type for target, edge_type in edges.items()
+                              if target not in skipped_targets}),
+                        lambda: discovery_frontier.add({target: edges[target] for target in skipped_targets},
+                                                       target_type, kind, source_id)]
+        ops = [sync]
+        dead_letters.resolve_in(stage, source_id, vbpl_type, ops, after_commit)
+        await db_writer.asubmit(ops=ops, after_commit=after_commit,
+                                on_failure=[lambda error: dead_letters.record(stage, source_id, vbpl_type, error)])
+
+    @classmethod
+    def insert_pending_edges(cls, session, doc_id, inserted):
+        """
+        Insert the edges to doc_id skipped by sync_edges while it was not crawled, see DiscoveryFrontier.
+        Run by the writer after the vbpl row of doc_id in the same transaction.
+        :param inserted: filled with kind -> {source id: edge type} of the inserted edges
+        """
+        for kind, edges in discovery_frontier.pending_edges(doc_id).items():
+            model, target_column, type_column = EDGE_KINDS[kind]
+            bulk_upsert(session, model, [{model.source_id.key: source_id, target_column.key: doc_id,
+                                          type_column.key: edge_type} for source_id, edge_type in edges.items()])
+            session.execute(update(Vbpl.__table__).where(Vbpl.id.in_(list(edges))).values(updated_at=datetime.now()))
+            inserted[kind] = edges
+        if inserted:
+            _logger.info(f'Insert {sum(len(edges) for edges in inserted.values())} pending edges to vbpl {doc_id}')
+
+    @classmethod
+    def resolve_pending_edges(cls, doc_id, inserted):
+        for kind, edges in inserted.items():
+            for source_id, edge_type in edges.items():
+                document_graph.add_edges(kind, source_id, {doc_id: edge_type})
+        discovery_frontier.resolve(doc_id, inserted)
+
+    @classmethod
+    async def push_pending_edges(cls, doc_id):
+        """
+        Insert the pending edges to a vbpl already in the database
+        """
+        inserted = {}
+        await db_writer.asubmit(ops=[lambda session: cls.insert_pending_edges(session, doc_id, inserted)],
+                                after_commit=[lambda: cls.resolve_pending_edges(doc_id, inserted)])
 
     @classmethod
     def update_vbpl_phapquy_fulltext(cls, line, fulltext_obj: VbplFullTextField):
@@ -652,76 +848,79 @@ class VbplService:
             raise CommonException(500, 'Crawl vbpl thuoc tinh')
 
     @classmethod
-    async def crawl_vbpl_related_doc(cls, vbpl_id):
+    async def crawl_vbpl_related_doc(cls, vbpl_id, vbpl_type: VbplType = VbplType.PHAP_QUY):
+        """
+        :return: True when the edges were submitted to the writer
+        """
         aspx_url = f'/TW/Pages/vbpq-{VbplTab.RELATED_DOC.value}.aspx'
         query_params = {
             'ItemID': vbpl_id
         }
+        pushed = False
         try:
             resp = await cls.call(method='GET', url_path=aspx_url, query_params=query_params)
             if resp.status == HTTPStatus.OK:
                 soup = BeautifulSoup(await resp.text(), 'lxml')
 
                 related_doc_node = soup.find('div', {'class': 'vbLienQuan'})
-                if related_doc_node is None or re.search(cls._empty_related_doc_msg,
-                                                         get_html_node_text(related_doc_node)):
+                if related_doc_node is None:
                     return
 
-                doc_type_node = related_doc_node.find_all('td', {'class': 'label'})
+                # dict of related id -> doc type, the page can list the same doc twice, the last one wins
+                related_docs = {}
+                if not re.search(cls._empty_related_doc_msg, get_html_node_text(related_doc_node)):
+                    doc_type_node = related_doc_node.find_all('td', {'class': 'label'})
+                    # neither the empty message nor a list, the page did not render, syncing would delete
+                    # every stored edge
+                    if len(doc_type_node) == 0:
+                        return
+
+                    for node in doc_type_node:
+                        doc_type = get_html_node_text(node)
+                        related_doc_list_node = node.find_next_sibling('td').find('ul', {'class': 'listVB'})
 
-                for node in doc_type_node:
-                    doc_type = get_html_node_text(node)
-                    related_doc_list_node = node.find_next_sibling('td').find('ul', {'class': 'listVB'})
+                        related_doc_list = related_doc_list_node.find_all('p', {'class': 'title'})
+                        for doc in related_doc_list:
+                            link = doc.find('a')
+                            doc_id = int(re.findall(find_id_regex, link.get('href'))[0])
+                            related_docs[doc_id] = doc_type
 
-                    related_doc_list = related_doc_list_node.find_all('p', {'class': 'title'})
-                    for doc in related_doc_list:
-                        link = doc.find('a')
-                        doc_id = int(re.findall(find_id_regex, link.get('href'))[0])
-                        new_vbpl_related_doc = VbplRelatedDocument(
-                            source_id=vbpl_id,
-                            related_id=doc_id,
-                            doc_type=doc_type
-                        )
-                        with LocalSession.begin() as session:
-                            check_related_doc = session.query(VbplRelatedDocument).filter(
-                                VbplRelatedDocument.source_id == new_vbpl_related_doc.source_id,
-                                VbplRelatedDocument.related_id == new_vbpl_related_doc.related_id).first()
-                            if check_related_doc is None:
-                                session.add(new_vbpl_related_doc)
-                            else:
-                                # upsert vbpl_related_document
-                                update_data = {
-                                    'doc_type': doc_type
-                                }
-                                session.query(VbplRelatedDocument).filter(
-                                    VbplRelatedDocument.source_id == new_vbpl_related_doc.source_id,
-                                    VbplRelatedDocument.related_id == new_vbpl_related_doc.related_id).update(
-                                    update_data)
+                await cls.push_vbpl_edges_to_db(VbplRelatedDocument, vbpl_id, related_docs, vbpl_type)
+                pushed = True
 
             sleep(1)
+            return pushed
         except Exception as e:
             _logger.exception(f'Crawl vbpl related doc {vbpl_id} {e}')
             raise CommonException(500, 'Crawl vbpl van ban lien quan')
 
     @classmethod
     async def crawl_vbpl_doc_map(cls, vbpl_id, vbpl_type: VbplType):
+        """
+        :return: True when the edges were submitted to the writer
+        """
         aspx_url = f'/TW/Pages/vbpq-{VbplTab.DOC_MAP.value}.aspx'
         if vbpl_type == VbplType.HOP_NHAT:
             aspx_url = f'/TW/Pages/vbpq-{VbplTab.DOC_MAP_HOP_NHAT.value}.aspx'
         query_params = {
             'ItemID': vbpl_id
         }
+        pushed = False
         try:
             resp = await cls.call(method='GET', url_path=aspx_url, query_params=query_params)
             if resp.status == HTTPStatus.OK:
                 soup = BeautifulSoup(await resp.text(), 'lxml')
+                # dict of doc map id -> doc map type
+                doc_maps = {}
                 if vbpl_type == VbplType.PHAP_QUY:
                     doc_map_title_nodes = soup.find_all('div', {'class': re.compile('title')})
-                    for doc_map_title_node in doc_map_title_nodes:
-                        doc_map_title = get_html_node_text(doc_map_title_node)
-
-                        doc_map_content_node = doc_map_title_node.find_next_sibling('div')
-                        doc_map_list = doc_map_content_node.find_all('li')
+                    doc_map_lists = [(get_html_node_text(node), node.find_next_sibling('div').find_all('li'))
+                                     for node in doc_map_title_nodes]
+                    # like the hop nhat page below, a page without any doc map link did not render (an error
+                    # page served with 200), syncing it would delete every stored edge
+                    if not any(doc_map_list for _, doc_map_list in doc_map_lists):
+                        return
+                    for doc_map_title, doc_map_list in doc_map_lists:
                         for doc_map in doc_map_list:
                             link = doc_map.find('a')
                             link_ref = re.findall(find_id_regex, link.get('href'))
@@ -733,7 +932,10 @@ class VbplService:
                                 doc_map_id = int(link_ref[0])
                             else:
                                 doc_title = link.text.strip()
+                                # most linked documents are already crawled, the remote search is only for a miss
+                                doc_map_id = vbpl_resolver.resolve(doc_title)
 
+                            if doc_map_id is None:
                                 search_resp = await cls.call(method='GET',
                                                              url_path=f'/VBQPPL_UserControls/Publishing_22/TimKiem/p_{vbpl_type.value}.aspx?IsVietNamese=True',
                                                              query_params=convert_dict_to_pascal({
@@ -748,25 +950,11 @@ class VbplService:
                                         search_link = titles[0].find('a')
                                         doc_map_id = int(re.findall(find_id_regex, search_link.get('href'))[0])
 
-                            new_vbpl_doc_map = VbplDocMap(
-                                source_id=vbpl_id,
-                                doc_map_id=doc_map_id,
-                                doc_map_type=doc_map_title
-                            )
-                            with LocalSession.begin() as session:
-                                check_doc_map = session.query(VbplDocMap).filter(
-                                    VbplDocMap.source_id == new_vbpl_doc_map.source_id,
-                                    VbplDocMap.doc_map_id == new_vbpl_doc_map.doc_map_id).first()
-                                if check_doc_map is None:
-                                    session.add(new_vbpl_doc_map)
-                                else:
-                                    # upsert doc_map for phap quy
-                                    update_data = {
-                                        'doc_map_type': doc_map_title
-                                    }
-                                    session.query(VbplDocMap).filter(
-                                        VbplDocMap.source_id == new_vbpl_doc_map.source_id,
-                                        VbplDocMap.doc_map_id == new_vbpl_doc_map.doc_map_id).update(update_data)
+                            # the search above can come back empty, there is nothing to link to then
+                            if doc_map_id is None:
+                                continue
+
+                            doc_maps[doc_map_id] = doc_map_title
 
                 elif vbpl_type == VbplType.HOP_NHAT:
                     doc_map_nodes = soup.find_all('div', {'class': 'w'})
@@ -779,26 +967,12 @@ class VbplService:
                         link_ref = re.findall(find_id_regex, link.get('href'))
                         doc_map_id = int(link_ref[0])
 
-                        new_vbpl_doc_map = VbplDocMap(
-                            source_id=vbpl_id,
-                            doc_map_id=doc_map_id,
-                            doc_map_type='Văn bản được hợp nhất'
-                        )
-                        with LocalSession.begin() as session:
-                            check_doc_map = session.query(VbplDocMap).filter(
-                                VbplDocMap.source_id == new_vbpl_doc_map.source_id,
-                                VbplDocMap.doc_map_id == new_vbpl_doc_map.doc_map_id).first()
-                            if check_doc_map is None:
-                                session.add(new_vbpl_doc_map)
-                            else:
-                                # upsert doc_map for hop nhat
-                                update_data = {
-                                    'doc_map_type': 'Văn bản được hợp nhất'
-                                }
-                                session.query(VbplDocMap).filter(
-                                    VbplDocMap.source_id == new_vbpl_doc_map.source_id,
-                                    VbplDocMap.doc_map_id == new_vbpl_doc_map.doc_map_id).update(update_data)
+                        doc_maps[doc_map_id] = 'Văn bản được hợp nhất'
+
+                await cls.push_vbpl_edges_to_db(VbplDocMap, vbpl_id, doc_maps, vbpl_type)
+                pushed = True
             sleep(1)
+            return pushed
         except Exception as e:
             _logger.exception(f'Crawl vbpl doc map {vbpl_id} {e}')
             raise CommonException(500, 'Crawl vbpl luoc do')
@@ -806,6 +980,56 @@ class VbplService:
     # fetch additional data from concetti
     @classmethod
     async def search_concetti(cls, vbpl: Vbpl):
+        source = EnrichmentSource.CONCETTI
+        item = await enrichment_cache.aget(source, vbpl.serial_number, vbpl.title)
+        if item is MISS:
+            # the concetti mirror first, see EnrichmentService.mirror_concetti
+            # scoring the mirror is CPU bound, it runs off the event loop of the crawl thread
+            item = await run_in_db(EnrichmentService.match_concetti, vbpl)
+            if item is None:
+                item = await cls.find_concetti_item(vbpl)
+                if item is MISS:
+                    return
+                if item is not None:
+                    item = {key: item[key] for key in ('slug', 'effectiveDate', 'expiryDate')}
+            await enrichment_cache.aput(source, vbpl.serial_number, vbpl.title, item)
+        if item is None:
+            return
+
+        # Update effective date, expiry date and state of vbpl
+        for column, value in concetti_dates(item).items():
+            setattr(vbpl, column, value)
+
+        # fetch pdf if needed
+        if vbpl.org_pdf_link is None or vbpl.org_pdf_link.strip() == '':
+            # the pdf id is only looked up the first time a pdf is needed, then cached with the item
+            if 'pdfFile' not in item:
+                slug = item['slug']
+                doc_url = '/documents/slug'
+                try:
+                    doc_resp = await fetch('GET', f'{cls._concetti_base_url + doc_url}/{slug}',
+                                           headers=cls.get_headers())
+                    if doc_resp.status == HTTPStatus.OK:
+                        raw_doc_json = await doc_resp.json()
+                        item['pdfFile'] = raw_doc_json['pdfFile']
+                        await enrichment_cache.aput(source, vbpl.serial_number, vbpl.title, item)
+                except Exception as e:
+                    _logger.exception(f'Get concetti {slug} {e}')
+                    raise CommonException(500, 'Get concetti')
+
+            pdf_id = item.get('pdfFile')
+            if pdf_id is not None:
+                pdf_url = f'{cls._concetti_base_url}/files/{pdf_id}/fetch'
+                vbpl.org_pdf_link = pdf_url
+                vbpl.file_link = get_document(pdf_url, True, pdf_id, True)
+
+    @classmethod
+    async def find_concetti_item(cls, vbpl: Vbpl):
+        """
+        Search concetti by title, sub title then serial number
+        :param vbpl:
+        :return: the first similar item, None if there is none, MISS if a search failed
+        """
         search_url = f'/documents/search'
         key_type = ['title', 'sub_title', 'serial_number']
         select_params = ('active,'
@@ -822,10 +1046,9 @@ class VbplService:
                          'gazetteNumber,'
                          'gazetteDate,'
                          'createdAt')
-        date_format = '%Y-%m-%d'
         max_page = 2
         threshold = 0.8
-        found = False
+        complete = True
         query_params = {
             'target': 'document',
             'sort': 'keyword',
@@ -840,99 +1063,87 @@ class VbplService:
             query_params['expiryDateFrom'] = convert_datetime_to_str(vbpl.expiration_date)
 
         for key in key_type:
-            if found:
-                break
             search_key = getattr(vbpl, key)
             if search_key is None:
                 continue
             query_params['key'] = quote(search_key)
             for i in range(max_page):
-                if found:
-                    break
                 query_params['page'] = i + 1
                 params = concetti_query_params_url_encode(query_params)
                 try:
-                    async with aiohttp.ClientSession(trust_env=True) as session:
-                        async with session.request('GET',
-                                                   yarl.URL(f'{cls._concetti_base_url + search_url}?{params}',
-                                                            encoded=True),
-                                                   headers=cls.get_headers()
-                                                   ) as resp:
-                            await resp.text()
+                    resp = await fetch('GET',
+                                       yarl.URL(f'{cls._concetti_base_url + search_url}?{params}', encoded=True),
+                                       headers=cls.get_headers())
                     if resp.status == HTTPStatus.OK:
                         raw_json = await resp.json()
-                        result_items = raw_json['items']
-
-                        if len(result_items) == 0:
-                            continue
-
-                        for item in result_items:
-                            # if the search result is similar to the source vbpl
-                            if (Levenshtein.ratio(search_key, item['name']) >= threshold
-                                    or Levenshtein.ratio(search_key, item['number']) >= threshold
-                                    or Levenshtein.ratio(search_key, item['key']) >= threshold):
-
-                                # Update effective date, expiry date and state of vbpl
-                                effective_date_str = item['effectiveDate']
-                                expiry_date_str = item['expiryDate']
-                                if effective_date_str is not None:
-                                    effective_date = datetime.strptime(effective_date_str, date_format)
-                                    vbpl.effective_date = effective_date
-                                    if effective_date > datetime.now():
-                                        vbpl.state = 'Chưa có hiệu lực'
-                                    else:
-                                        if expiry_date_str is None:
-                                            vbpl.state = 'Có hiệu lực'
-                                        else:
-                                            expiry_date = datetime.strptime(expiry_date_str, date_format)
-                                            vbpl.expiration_date = expiry_date
-                                            if expiry_date < datetime.now():
-                                                vbpl.state = 'Hết hiệu lực'
-                                            else:
-                                                vbpl.state = 'Có hiệu lực'
-
-                                # fetch pdf if needed
-                                if vbpl.org_pdf_link is None or vbpl.org_pdf_link.strip() == '':
-                                    slug = item['slug']
-                                    doc_url = '/documents/slug'
-                                    try:
-                                        async with aiohttp.ClientSession(trust_env=True) as session:
-                                            async with session.request('GET',
-                                                                       f'{cls._concetti_base_url + doc_url}/{slug}',
-                                                                       headers=cls.get_headers()
-                                                                       ) as doc_resp:
-                                                await doc_resp.text()
-                                        if resp.status == HTTPStatus.OK:
-                                            raw_doc_json = await doc_resp.json()
-                                            pdf_id = raw_doc_json['pdfFile']
-                                            if pdf_id is not None:
-                                                pdf_url = f'{cls._concetti_base_url}/files/{pdf_id}/fetch'
-                                                vbpl.org_pdf_link = pdf_url
-                                                vbpl.file_link = get_document(pdf_url, True, pdf_id, True)
-                                    except Exception as e:
-                                        _logger.exception(f'Get concetti {slug} {e}')
-                                        raise CommonException(500, 'Get concetti')
-
-                                found = True
-                                break
+                        items = raw_json['items']
+                        # the item whose name, number or key is the most similar to the source vbpl
+                        match = best_match(search_key, [item[field] for item in items
+                                                        for field in ('name', 'number', 'key')], threshold)
+                        if match is not None:
+                            return items[match[0] // 3]
+                    else:
+                        complete = False
                 except Exception as e:
                     _logger.exception(f'Search using concetti {e}')
                     raise CommonException(500, 'Search using concetti')
+        # a failed page may have held the document, only a complete search is a "not found"
+        return None if complete else MISS
 
     # additional html crawl from tvpl
     @classmethod
     async def additional_html_crawl(cls, vbpl: Vbpl):
+        source = EnrichmentSource.TVPL
+        results = []
+        vbpl_sub_parts = None
+
+        # the cache keeps the url of the matching tvpl document, the full text is always fetched fresh
+        cached = await enrichment_cache.aget(source, vbpl.serial_number, vbpl.title)
+        if cached is MISS:
+            result_url = await cls.find_tvpl_url(vbpl)
+            if result_url is MISS:
+                return results, vbpl_sub_parts
+            await enrichment_cache.aput(source, vbpl.serial_number, vbpl.title,
+                                        None if result_url is None else {'url': result_url})
+        else:
+            result_url = None if cached is None else cached['url']
+        if result_url is None:
+            return results, vbpl_sub_parts
+
+        try:
+            full_text_resp = await fetch('GET', result_url,
+                                         headers=cls.get_headers())
+            if full_text_resp.status == HTTPStatus.OK:
+                full_text_soup = BeautifulSoup(await full_text_resp.text(), 'lxml')
+                full_text = full_text_soup.find('div', {'class': 'cldivContentDocVn'})
+
+                if full_text is None:
+                    return None
+
+                vbpl.html = str(full_text)
+
+                lines = full_text.find_all('p')
+                if len(lines) == 0:
+                    lines = full_text.find_all('div')
+                results, vbpl_sub_parts = cls.process_html_full_text(vbpl, lines)
+        except Exception as e:
+            _logger.exception(f'Get tvpl html {result_url} {e}')
+            raise CommonException(500, 'Get tvpl html')
+        return results, vbpl_sub_parts
+
+    @classmethod
+    async def find_tvpl_url(cls, vbpl: Vbpl):
+        """
+        Search tvpl by title, sub title then serial number
+        :param vbpl:
+        :return: url of the first similar document, None if there is none, MISS if a search failed
+        """
         search_url = '/page/tim-van-ban.aspx'
         key_type = ['title', 'sub_title', 'serial_number']
         threshold = 0.8
-        found = False
-        results = []
-        vbpl_sub_parts = None
+        complete = True
 
         for key in key_type:
-            if found:
-                break
-
             if getattr(vbpl, key) is None:
                 continue
 
@@ -942,13 +1153,9 @@ class VbplService:
                 'sort': 1,
             }
             try:
-                async with aiohttp.ClientSession(trust_env=True) as session:
-                    async with session.request('GET',
-                                               cls._tvpl_base_url + search_url,
-                                               params=query_params,
-                                               headers=cls.get_headers()
-                                               ) as resp:
-                        await resp.text()
+                resp = await fetch('GET', cls._tvpl_base_url + search_url,
+                                   params=query_params,
+                                   headers=cls.get_headers())
             except Exception as e:
                 _logger.exception(f'Search tvpl {e}')
                 raise CommonException(500, 'Search tvpl')
@@ -956,36 +1163,12 @@ class VbplService:
                 soup = BeautifulSoup(await resp.text(), 'lxml')
                 search_results = soup.find_all('p', {'class': 'nqTitle'})
 
-                for result in search_results:
-                    search_text = get_html_node_text(result)
-                    if Levenshtein.ratio(search_text, search_key) >= threshold:
-                        found = True
-                        result_url = result.find('a').get('href')
-                        try:
-                            async with aiohttp.ClientSession(trust_env=True) as session:
-                                async with session.request('GET',
-                                                           result_url,
-                                                           headers=cls.get_headers()
-                                                           ) as full_text_resp:
-                                    await full_text_resp.text()
-                            if full_text_resp.status == HTTPStatus.OK:
-                                full_text_soup = BeautifulSoup(await full_text_resp.text(), 'lxml')
-                                full_text = full_text_soup.find('div', {'class': 'cldivContentDocVn'})
-
-                                if full_text is None:
-                                    return None
-
-                                vbpl.html = str(full_text)
-
-                                lines = full_text.find_all('p')
-                                if len(lines) == 0:
-                                    lines = full_text.find_all('div')
-                                results, vbpl_sub_parts = cls.process_html_full_text(vbpl, lines)
-                            break
-                        except Exception as e:
-                            _logger.exception(f'Get tvpl html {result_url} {e}')
-                            raise CommonException(500, 'Get tvpl html')
-        return results, vbpl_sub_parts
+                match = best_match(search_key, [get_html_node_text(result) for result in search_results], threshold)
+                if match is not None:
+                    return search_results[match[0]].find('a').get('href')
+            else:
+                complete = False
+        return None if complete else MISS
 
     # get vbpl pdf from Download Tab
     @classmethod
@@ -994,84 +1177,167 @@ class VbplService:
         # unfortunately any link relate to vbpl can return null so we need to check all of them
         # and i will say it again, this web is retarded
         if vbpl_type == VbplType.PHAP_QUY:
-            possible_path = [
-                VbplTab.FULL_TEXT.value,
-                VbplTab.ATTRIBUTE.value,
-                VbplTab.RELATED_DOC.value,
-                VbplTab.DOC_MAP.value
+            possible_tabs = [
+                VbplTab.FULL_TEXT,
+                VbplTab.ATTRIBUTE,
+                VbplTab.RELATED_DOC,
+                VbplTab.DOC_MAP
             ]
         else:
-            possible_path = [
-                VbplTab.FULL_TEXT_HOP_NHAT.value,
-                VbplTab.FULL_TEXT_HOP_NHAT_2.value,
-                VbplTab.ATTRIBUTE_HOP_NHAT.value,
-                VbplTab.DOC_MAP_HOP_NHAT.value
+            possible_tabs = [
+                VbplTab.FULL_TEXT_HOP_NHAT,
+                VbplTab.FULL_TEXT_HOP_NHAT_2,
+                VbplTab.ATTRIBUTE_HOP_NHAT,
+                VbplTab.DOC_MAP_HOP_NHAT
             ]
+        # the tab that held the file list of most documents of the same type goes first,
+        # the others are only probed when it misses, all at once
+        possible_tabs = tab_probe_order.order(vbpl_type, vbpl.doc_type, possible_tabs)
+
+        results = [await cls.probe_vbpl_file_list(vbpl.id, possible_tabs[0])]
+        if results[0] is None or isinstance(results[0], Exception):
+            results += await asyncio.gather(*[cls.probe_vbpl_file_list(vbpl.id, tab) for tab in possible_tabs[1:]])
+        found = [(tab, files) for tab, files in zip(possible_tabs, results)
+                 if files is not None and not isinstance(files, Exception)]
+        if not found:
+            errors = [result for result in results if isinstance(result, Exception)]
+            if errors:
+                _logger.error(f"Crawl vbpl pdf {vbpl.id}: {errors[0]}")
+                raise CommonException(500, f"Crawl vbpl pdf")
+            return
+        tab, files = found[0]
+        tab_probe_order.record(vbpl_type, vbpl.doc_type, tab)
 
-        for path in possible_path:
-            aspx_url = f'/TW/Pages/vbpq-{path}.aspx'
-            query_params = {
-                'ItemID': vbpl.id
-            }
+        try:
+            file_urls = []
+            file_links = files.find_all('li')
+
+            for link in file_links:
+                link_node = link.find_all('a')[0]
+                link_content = get_html_node_text(link_node)
+                if re.search('.+.pdf', link_content) \
+                        or re.search('.+.doc', link_content) \
+                        or re.search('.+.docx', link_content):
+                    href = link_node['href']
+                    if re.search('javascript:downloadfile', href):
+                        file_url = href[len('javascript:downloadfile('):-2].split(',')[1][1:-1]
+                        file_urls.append(quote(setting.VBPL_PDF_BASE_URL + file_url, safe='/:?'))
+
+            if len(file_urls) > 0:
+                local_links = []
+                for url in file_urls:
+                    doc_link = get_document(url, True)
+                    if doc_link is not None:
+                        local_links.append(doc_link)
+                if len(local_links) > 0:
+                    vbpl.file_link = ' '.join(local_links)
+                vbpl.org_pdf_link = ' '.join(file_urls)
 
-            try:
-                resp = await cls.call(method='GET', url_path=aspx_url, query_params=query_params)
-                if resp.status == HTTPStatus.OK:
-                    soup = BeautifulSoup(await resp.text(), 'lxml')
-                    files = soup.find('ul', {'class': 'fileAttack'})
-                    if files is not None:
-                        file_urls = []
-                        file_links = files.find_all('li')
-
-                        for link in file_links:
-                            link_node = link.find_all('a')[0]
-                            link_content = get_html_node_text(link_node)
-                            if re.search('.+.pdf', link_content) \
-                                    or re.search('.+.doc', link_content) \
-                                    or re.search('.+.docx', link_content):
-                                href = link_node['href']
-                                if re.search('javascript:downloadfile', href):
-                                    file_url = href[len('javascript:downloadfile('):-2].split(',')[1][1:-1]
-                                    file_urls.append(quote(setting.VBPL_PDF_BASE_URL + file_url, safe='/:?'))
-
-                        if len(file_urls) > 0:
-                            local_links = []
-                            for url in file_urls:
-                                doc_link = get_document(url, True)
-                                if doc_link is not None:
-                                    local_links.append(get_document(url, True))
-                            if len(local_links) > 0:
-                                vbpl.file_link = ' '.join(local_links)
-                            vbpl.org_pdf_link = ' '.join(file_urls)
-                        break
+        except Exception as e:
+            _logger.exception(f"Crawl vbpl pdf {vbpl.id}: {e}")
+            raise CommonException(500, f"Crawl vbpl pdf")
 
-            except Exception as e:
-                _logger.exception(f"Crawl vbpl pdf {vbpl.id}: {e}")
-                raise CommonException(500, f"Crawl vbpl pdf")
+    @classmethod
+    async def probe_vbpl_file_list(cls, vbpl_id, tab: VbplTab):
+        """
+        :return: the ul.fileAttack node of the tab page, None when the page does not have it,
+        the exception when the page could not be fetched
+        """
+        aspx_url = f'/TW/Pages/vbpq-{tab.value}.aspx'
+        query_params = {
+            'ItemID': vbpl_id
+        }
+        try:
+            resp = await cls.call(method='GET', url_path=aspx_url, query_params=query_params)
+            if resp.status == HTTPStatus.OK:
+                soup = BeautifulSoup(await resp.text(), 'lxml')
+                return soup.find('ul', {'class': 'fileAttack'})
+            return None
+        except Exception as e:
+            _logger.exception(f"Probe vbpl {vbpl_id} tab {tab.value}: {e}")
+            return e
 
     @classmethod
-    async def crawl_vbpl_by_id(cls, vbpl_id, vbpl_type: VbplType):
-        new_vbpl = Vbpl(
-            id=vbpl_id,
-        )
-        if vbpl_type == VbplType.HOP_NHAT:
-            await cls.crawl_vbpl_hopnhat_info(new_vbpl)
-            await cls.crawl_vbpl_pdf(new_vbpl, vbpl_type)
-            await cls.crawl_vbpl_hopnhat_fulltext(new_vbpl)
-            await cls.search_concetti(new_vbpl)
-            await cls.enrich_vbpl_sector(new_vbpl)
-            vbpl_fulltext, vbpl_sub_part = await cls.additional_html_crawl(new_vbpl)
-        else:
-            await cls.crawl_vbpl_phapquy_info(new_vbpl)
-            await cls.crawl_vbpl_pdf(new_vbpl, vbpl_type)
-            vbpl_fulltext, vbpl_sub_part = await cls.crawl_vbpl_phapquy_fulltext(new_vbpl)
-            await cls.search_concetti(new_vbpl)
-            await cls.enrich_vbpl_sector(new_vbpl)
-        await cls.push_vbpl_to_db(vbpl_id, new_vbpl, vbpl_fulltext, vbpl_sub_part)
+    async def crawl_vbpl_by_id(cls, vbpl_id, vbpl_type: VbplType, skip_missing=False):
+        """
+        :param skip_missing: do not write anything when the attribute page has no document, the id may be
+        of the other vbpl type
+        :return: False when skipped
+        """
+        await run_in_db(known_vbpl_index.ensure_loaded)
+        await run_in_db(vbpl_resolver.ensure_loaded)
+        await run_in_db(EnrichmentService.load_concetti_index)
+        await run_in_db(dead_letters.ensure_loaded)
+        return await cls.crawl_vbpl_document(Vbpl(id=vbpl_id), vbpl_type, skip_missing)
+
+    @classmethod
+    async def crawl_discovered_vbpl(cls, max_docs=None):
+        """
+        Crawl the vbpl referenced by the crawled edges but missing from the database, the most referenced first,
+        without going through the listing. The edges skipped while they were missing are inserted when their row
+        commits. The edges of the crawled vbpl can reference more missing vbpl, they are crawled in the next
+        round of the same run.
+        :param max_docs: stop after this many vbpl, None to drain the frontier
+        :return: number of crawled vbpl
+        """
+        await run_in_db(known_vbpl_index.ensure_loaded)
+        await run_in_db(vbpl_resolver.ensure_loaded)
+        await run_in_db(EnrichmentService.load_concetti_index)
+        await run_in_db(discovery_frontier.ensure_loaded)
+        total = 0
+        while len(discovery_frontier) > 0 and (max_docs is None or total < max_docs):
+            # list of (doc id, vbpl type)
+            crawled = []
+            with concurrent.futures.ThreadPoolExecutor(max_workers=cls._max_threads) as executor:
+                worker_coroutines = [cls.crawl_discovered_worker(None if max_docs is None else max_docs - total,
+                                                                 crawled)
+                                     for _ in range(cls._max_threads)]
+                executor.map(asyncio.run, worker_coroutines)
+            if not crawled:
+                break
+            total += len(crawled)
+
+            # the edges need the crawled vbpl rows, the new targets join the frontier when these edges commit
+            await db_writer.aflush()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=cls._max_threads) as executor:
+                edge_coroutines = [cls.crawl_vbpl_edges(doc_id, vbpl_type) for doc_id, vbpl_type in crawled]
+                executor.map(asyncio.run, edge_coroutines)
+            await db_writer.aflush()
+            discovery_frontier.save()
+            tab_probe_order.save()
+            _logger.info(f'Discovered {len(crawled)} vbpl, {len(discovery_frontier)} left in the frontier')
+        return total
+
+    @classmethod
+    async def crawl_discovered_worker(cls, max_docs, crawled):
+        while max_docs is None or len(crawled) < max_docs:
+            popped = discovery_frontier.pop()
+            if popped is None:
+                return
+            doc_id, entry = popped
+            vbpl_type = VbplType[entry['vbpl_type']]
+            # listed after its sources, its row is in the database, only the edges to it are missing
+            if known_vbpl_index.contains(doc_id):
+                await cls.push_pending_edges(doc_id)
+                continue
+            try:
+                # the type of a target is a guess from its edge, try the other type before giving up
+                # the pending edges to it are inserted with its row, see push_vbpl_to_db
+                if not await cls.crawl_vbpl_by_id(doc_id, vbpl_type, skip_missing=True):
+                    vbpl_type = VbplType.HOP_NHAT if vbpl_type == VbplType.PHAP_QUY else VbplType.PHAP_QUY
+                    if not await cls.crawl_vbpl_by_id(doc_id, vbpl_type, skip_missing=True):
+                        _logger.info(f'Discovered vbpl {doc_id} has no attribute page, dropped')
+                        discovery_frontier.drop(doc_id)
+                        continue
+            except Exception as e:
+                _logger.exception(f'Crawl discovered vbpl {doc_id} {e}')
+                discovery_frontier.retry(doc_id, entry)
+                continue
+            crawled.append((doc_id, vbpl_type))
 
     @classmethod
     async def fetch_vbpl_by_id(cls, vbpl_id):
-        with LocalSession.begin() as session:
+        def query_vbpl(session):
             vbpl_info = session.query(
                 Vbpl.id,
                 Vbpl.file_link,
@@ -1100,6 +1366,10 @@ class VbplService:
                 filter(VbplDocMap.source_id == vbpl_id). \
                 all()
 
+            return vbpl_info, vbpl_related_document_info, vbpl_doc_map_info
+
+        vbpl_info, vbpl_related_document_info, vbpl_doc_map_info = await run_in_db(run_in_session, query_vbpl)
+
         formatted_vbpl_info = (
             f"ID văn bản: {vbpl_info.id},\n"
             f"Đường dẫn lưu file: {vbpl_info.file_link},\n"
@@ -1142,42 +1412,76 @@ class VbplService:
     @classmethod
     async def get_vbpl_preview(cls, num_of_rows, issuance_date):
         target_date = convert_str_to_datetime(issuance_date)
-        with LocalSession.begin() as session:
-            query = session.query(Vbpl).filter(Vbpl.issuance_date == target_date).order_by(
-                Vbpl.issuance_date.desc()).limit(num_of_rows)
 
         sql_folder_path = 'documents/preview/vbpl'
         os.makedirs(sql_folder_path, exist_ok=True)
         sql_file_path = os.path.join(sql_folder_path, 'vbpl_preview_script.sql')
 
-        with open(sql_file_path, 'w') as dump_file:
-            for vbpl_instance in query:
-                values = []
-                for column in Vbpl.__table__.columns.keys():
-                    value = getattr(vbpl_instance, column)
-                    if value is None:
-                        values.append("NULL")
-                    else:
-                        values.append(f"'{value}'")
-                values_str = ", ".join(values)
-                insert_sql = f"INSERT INTO vbpl ({', '.join(Vbpl.__table__.columns.keys())}) VALUES ({values_str});"
-                dump_file.write(insert_sql + '\n')
-
-        file_links = []
-
-        target_records = query.all()
-        for record in target_records:
-            if record.file_link is not None:
-                file_links.append(record.file_link)
-
-        output_rar_filepath = os.path.join(sql_folder_path, 'preview_vbpl.rar')
-        with py7zr.SevenZipFile(output_rar_filepath, 'w') as archive:
-            for file_link in file_links:
-                archive.write(file_link)
+        def export(session):
+            # one streaming pass writes the rows and collects what the second pass and the archive need
+            vbpl_ids = []
+            file_links = []
+
+            def on_vbpl_row(row):
+                vbpl_ids.append(row.id)
+                if row.file_link is not None:
+                    file_links.append(row.file_link)
+
+            vbpl_table = Vbpl.__table__
+            html_table = VbplHtml.__table__
+            statement = select(vbpl_table).where(vbpl_table.c.issuance_date == target_date). \
+                order_by(vbpl_table.c.issuance_date.desc(), vbpl_table.c.id).limit(int(num_of_rows))
+
+            with open(sql_file_path, 'w', encoding='utf-8') as dump_file:
+                count = write_insert_statements(dump_file, vbpl_table.name, vbpl_table.columns.keys(),
+                                                stream_rows(session, statement), on_row=on_vbpl_row)
+                for index in range(0, len(vbpl_ids), 500):
+                    html_statement = select(html_table). \
+                        where(html_table.c.vbpl_id.in_(vbpl_ids[index:index + 500])). \
+                        order_by(html_table.c.vbpl_id)
+                    write_insert_statements(dump_file, html_table.name, html_table.columns.keys(),
+                                            stream_rows(session, html_statement, 50))
+            _logger.info(f'Export {count} vbpl of {issuance_date} to {sql_file_path}')
+            return file_links
+
+        file_links = await run_in_db(run_in_session, export)
+
+        # a file_link can hold several paths, identical files are stored once
+        archive = ArchiveBuilder(os.path.join(sql_folder_path, 'preview_vbpl.zip'))
+        for file_link in file_links:
+            archive.add_file_links(file_link)
+        archive.build()
 
     # get vbpl sector
     @classmethod
     async def enrich_vbpl_sector(cls, vbpl: Vbpl):
+        # a known vbpl with the same serial number (sub title for those without one) is the same document,
+        # its sector saves the luatvietnam round trips
+        local_key = vbpl.sub_title if vbpl.serial_number == 'Không số' else vbpl.serial_number
+        known_ids = [] if vbpl.id is None else [int(vbpl.id)]
+        matches = vbpl_resolver.lookup(local_key)
+        # a key shared by several documents (VBHN numbers without a year, 'Không số' sub titles) does not tell
+        # which one this is, same rule as vbpl_resolver.resolve
+        if len(matches) == 1:
+            known_ids.extend(matches)
+        for known_id in known_ids:
+            known_sector = known_vbpl_index.sector(known_id)
+            if known_sector is not None and known_sector != 'Lĩnh vực khác':
+                vbpl.sector = known_sector
+                return
+
+        # then the luatvietnam sector listings mirrored by EnrichmentService.mirror_sectors
+        mirrored_sector = EnrichmentService.mirrored_sector(vbpl.serial_number)
+        if mirrored_sector is not None:
+            vbpl.sector = mirrored_sector
+            return
+
+        source = EnrichmentSource.LUAT_VN
+        cached = await enrichment_cache.aget(source, vbpl.serial_number, vbpl.title)
+        if cached is not MISS:
+            vbpl.sector = 'Lĩnh vực khác' if cached is None else cached['sector']
+            return
+
         if vbpl.serial_number == 'Không số':
             query_params = {
                 'Keywords': vbpl.sub_title,
@@ -1195,13 +1499,9 @@ class VbplService:
         vbpl_sectors = []
 
         try:
-            async with aiohttp.ClientSession(trust_env=True) as session:
-                async with session.request('GET',
-                                           f'{cls._luat_vn_base_url + search_url}',
-                                           params=query_params,
-                                           headers=cls.get_headers()
-                                           ) as resp:
-                    await resp.text()
+            resp = await fetch('GET', f'{cls._luat_vn_base_url + search_url}',
+                               params=query_params,
+                               headers=cls.get_headers())
         except Exception as e:
             _logger.exception(f'Search vbpl on luatvietnam with url {search_url}')
             raise CommonException(500, 'Crawl vbpl sector from luatvietnam')
@@ -1219,15 +1519,12 @@ class VbplService:
             # if not found, then stop the function, and mark those as "Lĩnh vực khác"
             if result_url == '':
                 vbpl.sector = 'Lĩnh vực khác'
+                await enrichment_cache.aput(source, vbpl.serial_number, vbpl.title, None)
                 return
             try:
-                async with aiohttp.ClientSession(trust_env=True) as session:
-                    async with session.request('GET',
-                                               f'{cls._luat_vn_base_url + result_url}',
-                                               params=query_params,
-                                               headers=cls.get_headers()
-                                               ) as vbpl_resp:
-                        await vbpl_resp.text()
+                vbpl_resp = await fetch('GET', f'{cls._luat_vn_base_url + result_url}',
+                                        params=query_params,
+                                        headers=cls.get_headers())
             except Exception as e:
                 _logger.exception(f'Get vbpl info on luatvietnam with url {result_url}')
                 raise CommonException(500, 'Crawl vbpl sector from luatvietnam')
@@ -1252,12 +1549,14 @@ class VbplService:
 
                         vbpl.sector = ' - '.join(vbpl_sectors)
 
-        with LocalSession.begin() as session:
-            # avoid upsert into 'Lĩnh vực khác' for the already specific sector
-            check_sector = session.query(Vbpl).filter(Vbpl.id == vbpl.id).first()
-            if check_sector is not None:
-                if check_sector.sector != 'Lĩnh vực khác' and vbpl.sector is None:
-                    vbpl.sector = check_sector.sector
+                if vbpl.sector is not None:
+                    await enrichment_cache.aput(source, vbpl.serial_number, vbpl.title, {'sector': vbpl.sector})
+
+        # avoid upsert into 'Lĩnh vực khác' for the already specific sector
+        if known_vbpl_index.contains(vbpl.id):
+            known_sector = known_vbpl_index.sector(vbpl.id)
+            if known_sector != 'Lĩnh vực khác' and vbpl.sector is None:
+                vbpl.sector = known_sector
 
         if vbpl.sector is None:
             vbpl.sector = 'Lĩnh vực khác'
@@ -0,0 +1,131 @@
+"""
+Compare the storage codecs of vbpl_html.html on a sample of real documents:
+write throughput, read latency and footprint, both in process and through MySQL.
+
+    python -m benchmark.compression --sample 200
+"""
+import argparse
+import time
+
+from sqlalchemy import Column, Integer, MetaData, Table, text
+from sqlalchemy.dialects.mysql import LONGBLOB
+
+from app.helper.compression import CODECS, compress_text, decompress_text, zstandard
+from app.helper.db import LocalSession, db_engine
+from app.model import VbplHtml
+
+_scratch_table = Table('benchmark_compressed_text', MetaData(),
+                       Column('id', Integer, primary_key=True),
+                       Column('value', LONGBLOB))
+
+
+def load_sample(size):
+    with LocalSession.begin() as session:
+        rows = session.query(VbplHtml.html).filter(VbplHtml.html.isnot(None)). \
+            order_by(VbplHtml.vbpl_id.desc()).limit(size).all()
+    return [row.html for row in rows]
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def bench_in_process(sample, codec):
+    raw_bytes = sum(len(value.encode('utf-8')) for value in sample)
+
+    start = time.perf_counter()
+    encoded = [compress_text(value, codec) for value in sample]
+    write_seconds = time.perf_counter() - start
+
+    latencies = []
+    for value in encoded:
+        start = time.perf_counter()
+        decompress_text(value)
+        latencies.append(time.perf_counter() - start)
+
+    stored_bytes = sum(len(value) for value in encoded)
+    return {
+        'write_mb_s': raw_bytes / write_seconds / 1e6,
+        'read_p50_ms': percentile(latencies, 50) * 1000,
+        'read_p99_ms': percentile(latencies, 99) * 1000,
+        'stored_mb': stored_bytes / 1e6,
+        'ratio': raw_bytes / stored_bytes,
+    }, encoded
+
+
+def bench_database(encoded):
+    _scratch_table.drop(db_engine, checkfirst=True)
+    _scratch_table.create(db_engine)
+    try:
+        start = time.perf_counter()
+        with LocalSession.begin() as session:
+            for index in range(0, len(encoded), 50):
+                session.execute(_scratch_table.insert(),
+                                [{'id': index + offset + 1, 'value': value}
+                                 for offset, value in enumerate(encoded[index:index + 50])])
+        write_seconds = time.perf_counter() - start
+
+        latencies = []
+        with LocalSession.begin() as session:
+            statement = _scratch_table.select().where(_scratch_table.c.id == text(':id'))
+            for doc_id in range(1, len(encoded) + 1):
+                start = time.perf_counter()
+                value = session.execute(statement, {'id': doc_id}).first().value
+                decompress_text(value)
+                latencies.append(time.perf_counter() - start)
+
+        with LocalSession.begin() as session:
+            session.execute(text(f'ANALYZE TABLE {_scratch_table.name}'))
+            data_length = session.execute(text(
+                'SELECT data_length FROM information_schema.tables '
+                'WHERE table_schema = DATABASE() AND table_name = :name'), {'name': _scratch_table.name}).scalar()
+        return {
+            'db_write_rows_s': len(encoded) / write_seconds,
+            'db_read_p50_ms': percentile(latencies, 50) * 1000,
+            'db_read_p99_ms': percentile(latencies, 99) * 1000,
+            'db_data_mb': (data_length or 0) / 1e6,
+        }
+    finally:
+        _scratch_table.drop(db_engine, checkfirst=True)
+
+
+def current_footprint():
+    with LocalSession.begin() as session:
+        rows = session.execute(text(
+            'SELECT table_name, data_length FROM information_schema.tables '
+            'WHERE table_schema = DATABASE() AND table_name IN (\'vbpl\', \'vbpl_html\', \'vbpl_toan_van\')')).all()
+        codecs = session.execute(text(
+            'SELECT HEX(LEFT(html, 1)) AS header, COUNT(*) AS total FROM vbpl_html '
+            'WHERE html IS NOT NULL GROUP BY header')).all()
+    for row in rows:
+        print(f'{row[0]}: {row[1] / 1e6:.1f} MB on disk')
+    for row in codecs:
+        print(f'vbpl_html.html header {row.header}: {row.total} rows')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sample', type=int, default=200, help='number of documents to benchmark')
+    parser.add_argument('--skip-db', action='store_true', help='only run the in-process benchmark')
+    args = parser.parse_args()
+
+    sample = load_sample(args.sample)
+    if not sample:
+        print('No vbpl html to benchmark')
+        return
+    print(f'{len(sample)} documents, {sum(len(value) for value in sample) / 1e6:.1f} M characters')
+    current_footprint()
+
+    for codec in CODECS:
+        if codec == 'zstd' and zstandard is None:
+            print('zstd: skipped, zstandard is not installed')
+            continue
+        result, encoded = bench_in_process(sample, codec)
+        if not args.skip_db:
+            result.update(bench_database(encoded))
+        print(f'{codec}: ' + ', '.join(f'{key}={value:.2f}' for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+EXPLAIN the crawler hot-path lookups and time them, a lookup using an index shows its key
+and an access type other than ALL. Also checks the unique keys the native upserts rely on.
+
+    python -m benchmark.query_plan --repeat 200
+"""
+import argparse
+import time
+from datetime import datetime
+
+from sqlalchemy import literal_column, text
+from sqlalchemy.dialects import mysql
+
+from app.helper.db import LocalSession
+from app.model import Anle, AnleSection, Vbpl
+
+# table -> column that must carry a unique index for INSERT ... ON DUPLICATE KEY UPDATE
+_upsert_keys = {
+    'anle': 'doc_id',
+    'anle_section': 'anle_id',
+}
+
+
+def hot_queries(session, doc_id, anle_id, issuance_date):
+    return {
+        'anle by doc_id': session.query(Anle.id).filter(Anle.doc_id == doc_id),
+        'anle_section by anle_id': session.query(AnleSection.id, AnleSection.content_hash).
+        filter(AnleSection.anle_id == anle_id),
+        'vbpl preview by issuance_date': session.query(Vbpl.id).
+        filter(Vbpl.issuance_date == literal_column(f"'{issuance_date:%Y-%m-%d %H:%M:%S}'")).
+        order_by(Vbpl.issuance_date.desc()).limit(10),
+        'vbpl latest by updated_at': session.query(Vbpl.id).order_by(Vbpl.updated_at.desc()).limit(10),
+    }
+
+
+def to_sql(query):
+    return str(query.statement.compile(dialect=mysql.dialect(), compile_kwargs={'literal_binds': True}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=200, help='number of timed executions per query')
+    args = parser.parse_args()
+
+    with LocalSession.begin() as session:
+        sample_anle = session.query(Anle.id, Anle.doc_id).order_by(Anle.id.desc()).first()
+        sample_date = session.query(Vbpl.issuance_date).filter(Vbpl.issuance_date.isnot(None)). \
+            order_by(Vbpl.id.desc()).scalar()
+        doc_id, anle_id = (sample_anle.doc_id, sample_anle.id) if sample_anle else ('TAND000000', 0)
+        queries = hot_queries(session, doc_id, anle_id, sample_date or datetime.now())
+
+        for name, query in queries.items():
+            sql = to_sql(query)
+            plan = session.execute(text(f'EXPLAIN {sql}')).mappings().first()
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                session.execute(text(sql)).fetchall()
+            elapsed_ms = (time.perf_counter() - start) / args.repeat * 1000
+            verdict = 'FULL SCAN' if plan['type'] == 'ALL' else 'index'
+            print(f'{name}: type={plan["type"]}, key={plan["key"]}, rows={plan["rows"]}, '
+                  f'extra={plan["Extra"]}, {elapsed_ms:.3f} ms -> {verdict}')
+
+        for table, column in _upsert_keys.items():
+            indexes = session.execute(text(f'SHOW INDEX FROM {table} WHERE Column_name = :column'),
+                                      {'column': column}).mappings().all()
+            unique = any(index['Non_unique'] == 0 for index in indexes)
+            print(f'{table}.{column}: {"unique, native upsert possible" if unique else "NOT unique"}')
+
+
+if __name__ == '__main__':
+    main()
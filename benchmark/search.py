@@ -0,0 +1,75 @@
+"""
+Measure the search index: build throughput over the crawled sections and query latency.
+The index is built in a separate directory, the live index is not touched.
+
+    python -m benchmark.search --limit 50000 --queries "quyền sử dụng đất" "thuế thu nhập cá nhân"
+"""
+import argparse
+import itertools
+import shutil
+import statistics
+import tempfile
+import time
+
+from app.helper.db import LocalSession
+from app.search import SearchIndex
+from app.service.search import SearchService
+
+_default_queries = [
+    'quyền sử dụng đất',
+    'thuế thu nhập cá nhân',
+    'xử phạt vi phạm hành chính',
+    'hợp đồng lao động',
+    'bồi thường thiệt hại',
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--limit', type=int, default=50000, help='number of documents to index')
+    parser.add_argument('--queries', nargs='*', default=_default_queries)
+    parser.add_argument('--repeat', type=int, default=20, help='executions of every query')
+    parser.add_argument('--no-fold', action='store_true', help='keep the diacritics')
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp(prefix='search_benchmark_')
+    index = SearchIndex(path)
+    try:
+        index.create(fold=not args.no_fold)
+        index.auto_merge = False
+        count = 0
+        characters = 0
+        start = time.perf_counter()
+        with LocalSession.begin() as session:
+            documents = itertools.islice(SearchService.iter_documents(session), args.limit)
+            while True:
+                batch = list(itertools.islice(documents, 1000))
+                if not batch:
+                    break
+                count += len(batch)
+                characters += sum(len(doc[2]) for doc in batch)
+                index.add_documents(batch)
+        index.flush()
+        build_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        index.merge()
+        merge_seconds = time.perf_counter() - start
+        print(f'build: {count} documents, {characters / 1e6:.1f} M characters in {build_seconds:.1f}s '
+              f'({count / build_seconds:.0f} docs/s, {characters / build_seconds / 1e6:.2f} M chars/s), '
+              f'merge {merge_seconds:.1f}s')
+
+        for query in args.queries:
+            latencies = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                hits = index.search(query, 10)
+                latencies.append((time.perf_counter() - start) * 1000)
+            print(f'"{query}": {len(hits)} hits, median {statistics.median(latencies):.2f} ms, '
+                  f'max {max(latencies):.2f} ms')
+    finally:
+        index.close()
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,25 +2,48 @@ import asyncio
 import re
 import sys
 
+from app.graph import document_graph
+from app.helper.concurrency import host_limiters
+from app.helper.db_writer import db_writer
+from app.helper.enrichment_cache import enrichment_cache
 from app.helper.enum import VbplType
 from app.model import Anle, Vbpl
+from app.search import search_index
 from app.service.anle import AnleService
+from app.service.enrichment import EnrichmentService
+from app.service.export import ExportService
+from app.service.maintenance import MaintenanceService
+from app.service.search import SearchService
 
 from app.service.vbpl import VbplService
+from setting import setting
 
 vbpl_service = VbplService()
 anle_service = AnleService()
+maintenance_service = MaintenanceService()
+export_service = ExportService()
+search_service = SearchService()
+enrichment_service = EnrichmentService()
+
+
+def print_host_metrics():
+    for line in host_limiters.format_metrics():
+        print(line)
 
 
 def crawl_all_vbpl_phap_quy():
     print("Đang cào dữ liệu vbpl - văn bản pháp quy")
+    host_limiters.start_reporting(setting.CRAWL_METRICS_INTERVAL, print_host_metrics)
     asyncio.run(vbpl_service.crawl_all_vbpl(VbplType.PHAP_QUY))
+    host_limiters.stop_reporting()
     print("Cào dữ liệu hoàn tất")
 
 
 def crawl_all_vbpl_hop_nhat():
     print("Đang cào dữ liệu vbpl - văn bản hợp nhất")
+    host_limiters.start_reporting(setting.CRAWL_METRICS_INTERVAL, print_host_metrics)
     asyncio.run(vbpl_service.crawl_all_vbpl(VbplType.HOP_NHAT))
+    host_limiters.stop_reporting()
     print("Cào dữ liệu hoàn tất")
 
 
@@ -34,18 +57,24 @@ def crawl_anle_by_id(id):
     print(f"Đang cào dữ liệu của án lệ có id: {id}")
     new_anle = Anle(doc_id=id)
     asyncio.run(anle_service.crawl_anle_info(new_anle))
+    db_writer.flush()
+    search_index.flush()
     print("Cào dữ liệu hoàn tất")
 
 
 def crawl_vbpl_by_id_phap_quy(id):
     print(f"Đang cào dữ liệu của văn bản pháp quy có id: {id}")
     asyncio.run(vbpl_service.crawl_vbpl_by_id(id, VbplType.PHAP_QUY))
+    db_writer.flush()
+    search_index.flush()
     print("Cào dữ liệu hoàn tất")
 
 
 def crawl_vbpl_by_id_hop_nhat(id):
     print(f"Đang cào dữ liệu của văn bản hợp nhất có id: {id}")
     asyncio.run(vbpl_service.crawl_vbpl_by_id(id, VbplType.HOP_NHAT))
+    db_writer.flush()
+    search_index.flush()
     print("Cào dữ liệu hoàn tất")
 
 
@@ -79,6 +108,8 @@ def crawl_anle_by_id_string(id_string):
     for anle_id in id_arr:
         new_anle = Anle(doc_id=anle_id)
         asyncio.run(anle_service.crawl_anle_info(new_anle))
+    db_writer.flush()
+    search_index.flush()
     print("Cào dữ liệu hoàn tất")
 
 
@@ -87,6 +118,8 @@ def crawl_vbpl_by_id_string_hop_nhat(id_string):
     id_arr = re.split(r',\s*|,', id_string)
     for vbpl_id in id_arr:
         asyncio.run(vbpl_service.crawl_vbpl_by_id(vbpl_id, VbplType.HOP_NHAT))
+    db_writer.flush()
+    search_index.flush()
     print("Cào dữ liệu hoàn tất")
 
 
@@ -95,9 +128,89 @@ def crawl_vbpl_by_id_string_phap_quy(id_string):
     id_arr = re.split(r',\s*|,', id_string)
     for vbpl_id in id_arr:
         asyncio.run(vbpl_service.crawl_vbpl_by_id(vbpl_id, VbplType.PHAP_QUY))
+    db_writer.flush()
+    search_index.flush()
     print("Cào dữ liệu hoàn tất")
 
 
+def backfill_content_hash():
+    print("Đang tính mã băm nội dung cho dữ liệu cũ")
+    updated = maintenance_service.backfill_content_hash()
+    print(f"Đã cập nhật {updated} dòng")
+
+
+def recompress_text():
+    print("Đang nén lại html và nội dung văn bản theo DB_COMPRESSION")
+    updated = maintenance_service.recompress_text()
+    print(f"Đã cập nhật {updated} dòng")
+
+
+def export_parquet(incremental):
+    print("Đang xuất dữ liệu ra Parquet" + (" (chỉ dữ liệu mới)" if incremental else ""))
+    counts = export_service.export_all(incremental)
+    for table_name, count in counts.items():
+        print(f"{table_name}: {count} dòng")
+    print("Dữ liệu được lưu tại documents/export")
+
+
+def search_full_text(query):
+    results = search_service.search(query)
+    if not results:
+        print("Không tìm thấy kết quả (nếu chưa có chỉ mục, chọn 20 để tạo)")
+    for result in results:
+        section = f", mục {result['section']}" if result['section'] is not None else ""
+        print(f"{result['score']:.2f} | {result['key']} | {result['title']}{section}")
+
+
+def rebuild_search_index():
+    print("Đang tạo lại chỉ mục tìm kiếm")
+    count = search_service.rebuild_index()
+    print(f"Đã đánh chỉ mục {count} văn bản")
+
+
+def purge_enrichment_cache():
+    print("Đang xóa kết quả tra cứu concetti, thuvienphapluat, luatvietnam đã hết hạn")
+    count = enrichment_cache.purge_expired()
+    print(f"Đã xóa {count} dòng")
+
+
+def mirror_sectors():
+    print("Đang đồng bộ lĩnh vực từ luatvietnam")
+    result = asyncio.run(enrichment_service.mirror_sectors())
+    print(f"Đã lấy lĩnh vực của {result['serial_numbers']} số hiệu, cập nhật {result['updated']} vbpl")
+
+
+def mirror_concetti():
+    print("Đang đồng bộ dữ liệu văn bản từ concetti")
+    result = asyncio.run(enrichment_service.mirror_concetti())
+    print(f"Đã lấy {result['documents']} văn bản, cập nhật {result['updated']} vbpl")
+
+
+def crawl_discovered_vbpl(max_docs):
+    print("Đang cào các văn bản được tham chiếu nhưng chưa có trong dữ liệu")
+    host_limiters.start_reporting(setting.CRAWL_METRICS_INTERVAL, print_host_metrics)
+    count = asyncio.run(vbpl_service.crawl_discovered_vbpl(max_docs))
+    host_limiters.stop_reporting()
+    search_index.flush()
+    document_graph.flush()
+    print(f"Đã cào {count} văn bản mới")
+
+
+def retry_dead_letters():
+    print("Đang cào lại các trang, văn bản bị lỗi đã đến hạn thử lại")
+    retried, succeeded = asyncio.run(vbpl_service.retry_dead_letters())
+    print(f"Đã thử lại {retried} mục, thành công {succeeded} mục")
+
+
+def trace_vbpl_graph(id):
+    print(f"Đang truy vết các văn bản liên quan đến văn bản có id: {id}")
+    for direction, label in (("in", "Các văn bản trỏ đến văn bản này"), ("out", "Các văn bản được văn bản này trỏ đến")):
+        reached = document_graph.traverse(id, direction)
+        print(f"{label}: {len(reached)}")
+        for doc_id, depth in sorted(reached.items(), key=lambda item: (item[1], item[0])):
+            print(f"  {doc_id} (cấp {depth})")
+
+
 def print_menu():
     menu = """
 ╔══════════════════════════════════════════════════════╗
@@ -122,6 +235,19 @@ def print_menu():
 ║ 13. Preview văn bản pháp luật                        ║
 ║ 14. --help                                           ║
 ║ 15. Thoát                                            ║
+║------------------------------------------------------║
+║ Tiện ích                                             ║
+║ 16. Tính mã băm nội dung cho dữ liệu cũ              ║
+║ 17. Nén lại html theo cấu hình DB_COMPRESSION        ║
+║ 18. Xuất dữ liệu ra Parquet                          ║
+║ 19. Tìm kiếm toàn văn                                ║
+║ 20. Tạo lại chỉ mục tìm kiếm                         ║
+║ 21. Xóa kết quả tra cứu bên ngoài đã hết hạn         ║
+║ 22. Đồng bộ lĩnh vực từ luatvietnam                  ║
+║ 23. Đồng bộ hiệu lực, pdf từ concetti                ║
+║ 24. Truy vết văn bản liên quan (bắc cầu)             ║
+║ 25. Cào văn bản mới được tham chiếu                  ║
+║ 26. Cào lại các trang, văn bản bị lỗi                ║
 ╚══════════════════════════════════════════════════════╝
 """
     print(menu)
@@ -174,6 +300,32 @@ def main():
             elif choice == "15":
                 print("Đang thoát chương trình.")
                 break
+            elif choice == "16":
+                backfill_content_hash()
+            elif choice == "17":
+                recompress_text()
+            elif choice == "18":
+                mode = input("Chỉ xuất dữ liệu mới từ lần xuất trước? (y/n): ")
+                export_parquet(mode.strip().lower() == "y")
+            elif choice == "19":
+                query = input("Nhập nội dung cần tìm (VD: quyền sử dụng đất): ")
+                search_full_text(query)
+            elif choice == "20":
+                rebuild_search_index()
+            elif choice == "21":
+                purge_enrichment_cache()
+            elif choice == "22":
+                mirror_sectors()
+            elif choice == "23":
+                mirror_concetti()
+            elif choice == "24":
+                vbpl_id = input("Nhập ID vbpl (VD: 32801): ")
+                trace_vbpl_graph(vbpl_id)
+            elif choice == "25":
+                max_docs = input("Nhập số văn bản tối đa (bỏ trống để cào hết): ")
+                crawl_discovered_vbpl(int(max_docs) if max_docs.strip() else None)
+            elif choice == "26":
+                retry_dead_letters()
             else:
                 print("Yêu cầu không hợp lệ, để biết các câu lệnh cần dùng, nhập 6 hoặc --help.")
     except KeyboardInterrupt:
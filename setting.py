@@ -18,6 +18,19 @@ class Setting(BaseSettings):
     TVPL_BASE_URL: str = os.getenv('TVPL_BASE_URL')
     CONG_BAO_BASE_URL: str = os.getenv('CONG_BAO_BASE_URL')
     LUAT_VN_BASE_URL: str = os.getenv('LUAT_VN_BASE_URL')
+    CRAWL_MAX_THREADS: int = int(os.getenv('CRAWL_MAX_THREADS', 8))
+    CRAWL_RELATED_DOC_THREADS: int = int(os.getenv('CRAWL_RELATED_DOC_THREADS', 0))
+    CRAWL_DOC_MAP_THREADS: int = int(os.getenv('CRAWL_DOC_MAP_THREADS', 0))
+    CRAWL_MAX_HOST_CONCURRENCY: int = int(os.getenv('CRAWL_MAX_HOST_CONCURRENCY', 32))
+    CRAWL_METRICS_INTERVAL: int = int(os.getenv('CRAWL_METRICS_INTERVAL', 60))
+    VBPL_HEDGE_REQUESTS: bool = os.getenv('VBPL_HEDGE_REQUESTS', 'true').lower() == 'true'
+    DB_POOL_SIZE: int = int(os.getenv('DB_POOL_SIZE', 0))
+    DB_COMPRESSION: str = os.getenv('DB_COMPRESSION', 'none')
+    DB_COMPRESSION_LEVEL: int = int(os.getenv('DB_COMPRESSION_LEVEL', 0))
+    SEARCH_INDEX_DIR: str = os.getenv('SEARCH_INDEX_DIR', 'documents/search_index')
+    SEARCH_FOLD_DIACRITICS: bool = os.getenv('SEARCH_FOLD_DIACRITICS', 'true').lower() == 'true'
+    GRAPH_DIR: str = os.getenv('GRAPH_DIR', 'documents/graph')
+    ENRICHMENT_CACHE_REFRESH: bool = os.getenv('ENRICHMENT_CACHE_REFRESH', 'false').lower() == 'true'
 
 
 setting = Setting()
@@ -0,0 +1,248 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app.helper.concurrency import AimdLimiter, CircuitBreaker, HostCircuitBreakers, HostLimiters, SharedLimit, \
+    is_overload_status
+
+
+def test_is_overload_status():
+    assert is_overload_status(429)
+    assert is_overload_status(503)
+    assert not is_overload_status(200)
+    assert not is_overload_status(404)
+
+
+def test_aimd_limit_grows_while_saturated():
+    limiter = AimdLimiter('vbpl.vn', 4, max_limit=6)
+
+    for _ in range(4):
+        for _ in range(4):
+            limiter.acquire_blocking()
+        for _ in range(4):
+            limiter.release(0.1, overloaded=False)
+
+    assert limiter.limit == pytest.approx(5.0, abs=0.3)
+    assert limiter.successes == 16
+
+
+def test_aimd_limit_does_not_grow_when_not_saturated():
+    limiter = AimdLimiter('vbpl.vn', 4)
+
+    for _ in range(20):
+        limiter.acquire_blocking()
+        limiter.release(0.1, overloaded=False)
+
+    assert limiter.limit == 4
+
+
+def test_aimd_limit_halves_once_per_round_on_overload():
+    limiter = AimdLimiter('vbpl.vn', 8, min_limit=2)
+    limiter.acquire_blocking()
+    limiter.release(10.0, overloaded=False)
+
+    for _ in range(3):
+        limiter.acquire_blocking()
+    for _ in range(3):
+        limiter.release(10.0, overloaded=True)
+
+    assert limiter.limit == 4
+    assert limiter.overloads == 3
+    assert limiter.decreases == 1
+
+
+def test_aimd_limit_stays_above_min_limit():
+    limiter = AimdLimiter('vbpl.vn', 4, min_limit=2)
+
+    for _ in range(5):
+        limiter.acquire_blocking()
+        limiter.release(0.0, overloaded=True)
+
+    assert limiter.limit == 2
+
+
+def test_aimd_slot_reads_the_outcome():
+    limiter = AimdLimiter('vbpl.vn', 4)
+
+    async def request(status):
+        async with limiter.slot() as outcome:
+            outcome.status = status
+
+    asyncio.run(request(503))
+    assert limiter.overloads == 1
+    assert limiter.limit == 2
+    asyncio.run(request(200))
+    assert limiter.successes == 1
+    assert limiter.in_flight == 0
+
+
+def test_aimd_slot_errors():
+    limiter = AimdLimiter('vbpl.vn', 4)
+
+    async def request(error):
+        async with limiter.slot():
+            raise error
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(request(asyncio.TimeoutError()))
+    assert limiter.overloads == 1
+    with pytest.raises(ValueError):
+        asyncio.run(request(ValueError()))
+    # not an overload, only frees the slot
+    assert limiter.overloads == 1
+    assert limiter.successes == 0
+    assert limiter.in_flight == 0
+
+
+def test_aimd_acquire_waits_for_a_free_slot():
+    limiter = AimdLimiter('vbpl.vn', 2)
+    peak = 0
+
+    async def request():
+        nonlocal peak
+        await limiter.acquire()
+        peak = max(peak, limiter.in_flight)
+        await asyncio.sleep(0.01)
+        limiter.release(0.01, overloaded=False, failed=True)
+
+    async def crawl():
+        await asyncio.gather(*(request() for _ in range(6)))
+
+    asyncio.run(crawl())
+    assert peak == 2
+    assert limiter.in_flight == 0
+
+
+def test_shared_limit_is_shared_by_the_event_loops_of_several_threads():
+    limit = SharedLimit('related_doc', 2)
+    peak = 0
+    lock = threading.Lock()
+
+    async def crawl_edges():
+        nonlocal peak
+        async with limit.slot():
+            with lock:
+                peak = max(peak, limit.in_flight)
+            await asyncio.sleep(0.02)
+
+    async def page():
+        await asyncio.gather(*(crawl_edges() for _ in range(3)))
+
+    threads = [threading.Thread(target=asyncio.run, args=(page(),)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert peak == 2
+    assert limit.in_flight == 0
+
+
+def test_shared_limit_waiting_does_not_block_the_loop():
+    limit = SharedLimit('doc_map', 1)
+    ticks = 0
+
+    async def hold():
+        async with limit.slot():
+            await asyncio.sleep(0.1)
+
+    async def tick():
+        nonlocal ticks
+        for _ in range(5):
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    async def page():
+        await asyncio.gather(hold(), hold(), tick())
+
+    asyncio.run(page())
+    assert ticks == 5
+
+
+def test_shared_limit_frees_the_slot_on_error():
+    limit = SharedLimit('doc_map', 0)
+
+    async def crawl_edges():
+        async with limit.slot():
+            raise ValueError()
+
+    with pytest.raises(ValueError):
+        asyncio.run(crawl_edges())
+    assert limit.limit == 1
+    assert limit.in_flight == 0
+
+
+def test_circuit_breaker_opens_after_failures_in_a_row():
+    breaker = CircuitBreaker('vbpl.vn', failure_threshold=3)
+
+    breaker.record(True)
+    breaker.record(True)
+    breaker.record(False)
+    breaker.record(True)
+    breaker.record(True)
+    assert breaker.state == 'closed'
+    breaker.record(True)
+
+    assert breaker.state == 'open'
+    assert breaker.opens == 1
+    assert not breaker.allow()
+
+
+def test_circuit_breaker_half_open_probe():
+    breaker = CircuitBreaker('vbpl.vn', failure_threshold=1, open_seconds=30, max_open_seconds=100)
+    breaker.record(True)
+
+    # the open period is over
+    breaker._opened_at -= 30
+    assert breaker.state == 'half_open'
+    assert breaker.allow()
+    # the probe is in flight, the other requests still fail fast
+    assert not breaker.allow()
+
+    breaker.record(True)
+    assert breaker.state == 'open'
+    assert breaker._open_for == 60
+    assert breaker.opens == 2
+
+    breaker._opened_at -= 60
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == 'closed'
+    assert breaker._open_for == 30
+
+
+def test_host_limiters_metrics():
+    breakers = HostCircuitBreakers()
+    limiters = HostLimiters(4, 16, breakers)
+
+    limiter = limiters.get('https://vbpl.vn/TW/Pages/vbpq-toanvan.aspx?ItemID=1')
+    assert limiters.get('https://VBPL.vn/other') is limiter
+    assert limiters.get('https://api.concetti.vn/') is not limiter
+    breakers.get('https://vbpl.vn/').record(True)
+
+    metrics = limiters.metrics()
+    assert metrics['vbpl.vn']['limit'] == 4
+    assert metrics['vbpl.vn']['circuit'] == 'closed'
+    assert 'circuit' not in metrics['api.concetti.vn']
+    lines = limiters.format_metrics()
+    assert lines[1].startswith('vbpl.vn: limit 4, in_flight 0')
+    assert lines[1].endswith('circuit closed, circuit_opens 0')
+
+
+def test_host_limiters_reporting():
+    limiters = HostLimiters(4, 16)
+    reports = []
+
+    limiters.start_reporting(0.01, lambda: reports.append(limiters.format_metrics()))
+    time.sleep(0.1)
+    limiters.stop_reporting()
+    count = len(reports)
+    time.sleep(0.03)
+
+    assert count >= 2
+    assert len(reports) == count
+
+    limiters.start_reporting(0, reports.append)
+    assert limiters._reporter is None
@@ -0,0 +1,160 @@
+from array import array
+from datetime import datetime
+
+import pytest
+
+from app.graph.csr import DocumentGraph, _Csr, _EdgeSet
+
+
+def build_csr(node_count, edges):
+    sources, targets, codes = array('I'), array('I'), array('H')
+    for source, target, code in edges:
+        sources.append(source)
+        targets.append(target)
+        codes.append(code)
+    return _Csr.build(node_count, sources, targets, codes)
+
+
+def build_edge_set(node_count, edges):
+    return _EdgeSet(build_csr(node_count, edges), build_csr(node_count, [(t, s, c) for s, t, c in edges]))
+
+
+def test_csr_build_groups_edges_by_source():
+    csr = build_csr(5, [(3, 1, 0), (0, 2, 1), (3, 4, 2), (0, 3, 0)])
+
+    assert csr.node_count == 5
+    assert list(csr.offsets) == [0, 2, 2, 2, 4, 4]
+    assert sorted(csr.edges(0)) == [(2, 1), (3, 0)]
+    assert sorted(csr.edges(3)) == [(1, 0), (4, 2)]
+    assert list(csr.edges(1)) == []
+    assert csr.degree(0) == 2
+    assert csr.degree(4) == 0
+
+
+def test_csr_out_of_range_nodes_have_no_edges():
+    csr = build_csr(2, [(0, 1, 0)])
+
+    assert list(csr.edges(-1)) == []
+    assert list(csr.edges(7)) == []
+    assert csr.degree(7) == 0
+
+
+def test_csr_empty():
+    csr = build_csr(0, [])
+
+    assert csr.node_count == 0
+    assert list(csr.edges(0)) == []
+
+
+def test_csr_write_and_open(tmp_path):
+    csr = build_csr(4, [(0, 1, 3), (2, 3, 1), (2, 0, 2)])
+    csr.write(str(tmp_path), 'related.out')
+
+    opened = _Csr.open(str(tmp_path), 'related.out')
+    try:
+        assert opened.node_count == 4
+        assert sorted(opened.edges(2)) == [(0, 2), (3, 1)]
+        assert list(opened.edges(0)) == [(1, 3)]
+    finally:
+        opened.close()
+
+
+def test_csr_open_empty_arrays(tmp_path):
+    build_csr(0, []).write(str(tmp_path), 'doc_map.in')
+
+    opened = _Csr.open(str(tmp_path), 'doc_map.in')
+    assert list(opened.edges(0)) == []
+    opened.close()
+
+
+def test_edge_set_replace_overrides_compacted_edges():
+    edge_set = build_edge_set(4, [(0, 1, 0), (0, 2, 0), (3, 2, 1)])
+
+    edge_set.replace(0, {3: 2})
+
+    assert dict(edge_set.out_edges(0)) == {3: 2}
+    assert sorted(edge_set.in_edges(2)) == [(3, 1)]
+    assert sorted(edge_set.in_edges(3)) == [(0, 2)]
+    assert sorted(edge_set.all_edges()) == [(0, 3, 2), (3, 2, 1)]
+
+
+def test_edge_set_replace_twice_drops_the_previous_reverse_edges():
+    edge_set = build_edge_set(3, [])
+
+    edge_set.replace(0, {1: 0})
+    edge_set.replace(0, {2: 0})
+
+    assert list(edge_set.in_edges(1)) == []
+    assert list(edge_set.in_edges(2)) == [(0, 0)]
+
+
+def test_edge_set_sources_beyond_the_compacted_arrays():
+    edge_set = build_edge_set(2, [(0, 1, 0)])
+
+    edge_set.replace(10, {0: 1})
+
+    assert dict(edge_set.out_edges(10)) == {0: 1}
+    assert sorted(edge_set.in_edges(0)) == [(10, 1)]
+    assert sorted(edge_set.all_edges()) == [(0, 1, 0), (10, 0, 1)]
+
+
+@pytest.fixture
+def graph(tmp_path):
+    # written from edge lists, as rebuild does once it has read the database
+    graph = DocumentGraph(str(tmp_path / 'graph'))
+    graph._types = ['Sửa đổi', 'Thay thế']
+    graph._type_codes = {'Sửa đổi': 0, 'Thay thế': 1}
+    edges = {
+        'related': [(2, 1, 0), (3, 2, 0), (4, 1, 1)],
+        'doc_map': [(5, 3, 1)],
+    }
+    edge_lists = {}
+    for kind, kind_edges in edges.items():
+        edge_lists[kind] = tuple(array(type_code, [edge[index] for edge in kind_edges])
+                                 for index, type_code in enumerate('IIH'))
+    graph._write_snapshot(edge_lists, datetime(2026, 1, 1))
+    graph._loaded = True
+    yield graph
+    graph.close()
+
+
+def test_graph_neighbors(graph):
+    assert sorted(graph.neighbors(1, 'in')) == [(2, 'related', 'Sửa đổi'), (4, 'related', 'Thay thế')]
+    assert graph.neighbors(1, 'in', types=['Thay thế']) == [(4, 'related', 'Thay thế')]
+    assert graph.neighbors(3, 'in', kinds=['related']) == []
+    assert graph.degree(3, 'in') == 1
+
+
+def test_graph_traverse_and_shortest_path(graph):
+    assert graph.traverse(1, 'in') == {2: 1, 4: 1, 3: 2, 5: 3}
+    assert graph.traverse(1, 'in', max_depth=1) == {2: 1, 4: 1}
+    assert graph.shortest_path(5, 1) == [5, 3, 2, 1]
+    assert graph.shortest_path(1, 5) is None
+
+
+def test_graph_replace_and_add_edges(graph):
+    graph.replace_edges('related', 3, {1: 'Thay thế'})
+    graph.add_edges('related', 3, {4: 'Sửa đổi'})
+
+    assert sorted(graph.neighbors(3)) == [(1, 'related', 'Thay thế'), (4, 'related', 'Sửa đổi')]
+    assert graph.neighbors(2, 'in') == []
+
+
+def test_graph_compact_keeps_the_edges(graph):
+    graph.replace_edges('doc_map', 5, {})
+    graph.add_edges('related', 7, {1: 'Bãi bỏ'})
+    before = graph.stats()
+
+    graph.flush()
+
+    assert graph.stats() == before == {'related': 4, 'doc_map': 0}
+    assert graph.neighbors(7) == [(1, 'related', 'Bãi bỏ')]
+
+
+def test_graph_edges_are_dropped_before_the_graph_is_loaded(tmp_path):
+    graph = DocumentGraph(str(tmp_path / 'graph'))
+
+    # nothing to load them into, loading reads them from the database
+    graph.replace_edges('related', 1, {2: 'Sửa đổi'})
+
+    assert graph._edge_sets == {}
@@ -0,0 +1,117 @@
+import pytest
+
+from app.graph import frontier as frontier_module
+from app.graph.frontier import DiscoveryFrontier
+from app.helper.enum import VbplType
+from app.helper.vbpl_index import KnownVbplIndex
+
+
+@pytest.fixture
+def known(monkeypatch):
+    # filled by hand instead of loading the vbpl table
+    known = KnownVbplIndex()
+    known._loaded = True
+    monkeypatch.setattr(frontier_module, 'known_vbpl_index', known)
+    return known
+
+
+@pytest.fixture
+def frontier(tmp_path, known):
+    return DiscoveryFrontier(str(tmp_path / 'graph' / 'frontier.json'))
+
+
+def test_pop_returns_the_most_referenced_first(frontier):
+    frontier.add({10: 'Sửa đổi', 11: 'Sửa đổi'}, VbplType.PHAP_QUY, 'related', 1)
+    frontier.add({11: 'Thay thế'}, VbplType.PHAP_QUY, 'related', 2)
+    frontier.add({11: 'Hợp nhất'}, VbplType.PHAP_QUY, 'doc_map', 3)
+    frontier.add({12: 'Sửa đổi'}, VbplType.HOP_NHAT, 'doc_map', 2)
+    frontier.add({12: 'Sửa đổi'}, VbplType.HOP_NHAT, 'doc_map', 4)
+
+    assert len(frontier) == 3
+    doc_id, entry = frontier.pop()
+    assert doc_id == 11
+    assert entry['vbpl_type'] == 'PHAP_QUY'
+    assert entry['edges'] == {'related': {1: 'Sửa đổi', 2: 'Thay thế'}, 'doc_map': {3: 'Hợp nhất'}}
+    assert frontier.pop()[0] == 12
+    assert frontier.pop()[0] == 10
+    assert frontier.pop() is None
+
+
+def test_known_and_dropped_targets_are_not_added(frontier, known):
+    known.add(10, 1, None)
+    frontier.drop(11)
+
+    frontier.add({10: 'Sửa đổi', 11: 'Sửa đổi', 12: 'Sửa đổi'}, VbplType.PHAP_QUY, 'related', 1)
+
+    assert len(frontier) == 1
+    assert frontier.pending_edges(10) == {}
+    assert frontier.pending_edges(11) == {}
+    assert frontier.pending_edges(12) == {'related': {1: 'Sửa đổi'}}
+
+
+def test_edges_found_while_crawling_are_kept(frontier):
+    frontier.add({10: 'Sửa đổi'}, VbplType.PHAP_QUY, 'related', 1)
+    doc_id, _ = frontier.pop()
+
+    frontier.add({10: 'Thay thế'}, VbplType.PHAP_QUY, 'related', 2)
+
+    assert len(frontier) == 0
+    assert frontier.pending_edges(doc_id) == {'related': {1: 'Sửa đổi', 2: 'Thay thế'}}
+
+
+def test_resolve_forgets_the_inserted_edges(frontier):
+    frontier.add({10: 'Sửa đổi'}, VbplType.PHAP_QUY, 'related', 1)
+    frontier.add({10: 'Hợp nhất'}, VbplType.PHAP_QUY, 'doc_map', 2)
+    doc_id, _ = frontier.pop()
+    inserted = frontier.pending_edges(doc_id)
+
+    # an edge found after pending_edges was read
+    frontier.add({10: 'Thay thế'}, VbplType.PHAP_QUY, 'related', 3)
+    frontier.resolve(doc_id, inserted)
+    assert frontier.pending_edges(doc_id) == {'related': {3: 'Thay thế'}}
+
+    frontier.resolve(doc_id, frontier.pending_edges(doc_id))
+    assert frontier.pending_edges(doc_id) == {}
+    assert frontier.pop() is None
+
+
+def test_retry_puts_the_entry_back_until_max_attempts(frontier):
+    frontier.add({10: 'Sửa đổi'}, VbplType.PHAP_QUY, 'related', 1)
+
+    for attempt in range(1, DiscoveryFrontier._max_attempts):
+        doc_id, entry = frontier.pop()
+        assert frontier.retry(doc_id, entry)
+        assert entry['attempts'] == attempt
+
+    doc_id, entry = frontier.pop()
+    assert not frontier.retry(doc_id, entry)
+    assert frontier.pop() is None
+    frontier.add({10: 'Sửa đổi'}, VbplType.PHAP_QUY, 'related', 2)
+    assert len(frontier) == 0
+
+
+def test_save_and_load(frontier, known):
+    frontier.add({10: 'Sửa đổi', 11: 'Sửa đổi'}, VbplType.PHAP_QUY, 'related', 1)
+    frontier.add({11: 'Hợp nhất'}, VbplType.HOP_NHAT, 'doc_map', 2)
+    frontier.add({12: 'Sửa đổi'}, VbplType.PHAP_QUY, 'related', 3)
+    frontier.drop(13)
+    # popped and being crawled when the crawl stops
+    crawling, _ = frontier.pop()
+    frontier.save()
+
+    loaded = DiscoveryFrontier(frontier.path)
+    assert len(loaded) == 3
+    assert loaded.pending_edges(crawling) == {'related': {1: 'Sửa đổi'}, 'doc_map': {2: 'Hợp nhất'}}
+    assert loaded.pop()[0] == crawling
+    loaded.add({13: 'Sửa đổi'}, VbplType.PHAP_QUY, 'related', 4)
+    assert loaded.pending_edges(13) == {}
+
+
+def test_save_before_load_keeps_the_file(frontier):
+    frontier.ensure_loaded()
+    frontier.add({10: 'Sửa đổi'}, VbplType.PHAP_QUY, 'related', 1)
+    frontier.save()
+
+    DiscoveryFrontier(frontier.path).save()
+
+    assert len(DiscoveryFrontier(frontier.path)) == 1
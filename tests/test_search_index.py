@@ -0,0 +1,139 @@
+import pytest
+
+from app.search.index import SearchIndex
+from app.search.tokenizer import tokenize
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = SearchIndex(str(tmp_path / 'search_index'))
+    index.create()
+    yield index
+    index.close()
+
+
+def keys(results):
+    return [key for key, _ in results]
+
+
+def test_tokenize_folds_diacritics():
+    assert tokenize('Quyền sử dụng ĐẤT') == ['quyen', 'su', 'dung', 'dat']
+    assert tokenize('Quyền sử dụng đất', fold=False) == ['quyền', 'sử', 'dụng', 'đất']
+
+
+def test_search_ranks_by_bm25(index):
+    index.add_documents([
+        ('vbpl_toan_van:1:1', 'a', 'quyền sử dụng đất của hộ gia đình'),
+        ('vbpl_toan_van:1:2', 'b', 'đất đai đất ở đất nông nghiệp'),
+        ('vbpl_toan_van:2:1', 'c', 'thuế thu nhập cá nhân'),
+    ])
+    index.flush()
+
+    assert len(index) == 3
+    assert keys(index.search('đất')) == ['vbpl_toan_van:1:2', 'vbpl_toan_van:1:1']
+    assert keys(index.search('thue')) == ['vbpl_toan_van:2:1']
+    assert index.search('kết hôn') == []
+    assert len(index.search('đất', limit=1)) == 1
+
+
+def test_pending_documents_are_searchable_after_flush(index):
+    index.add_documents([('anle_section:1', 'a', 'án lệ về hợp đồng')])
+
+    assert index.search('hợp đồng') == []
+    index.flush()
+    assert keys(index.search('hợp đồng')) == ['anle_section:1']
+
+
+def test_unchanged_documents_are_skipped(index):
+    index.add_documents([('anle_section:1', 'a', 'án lệ về hợp đồng')])
+    index.flush()
+    segments = len(index._segments)
+
+    index.add_documents([('anle_section:1', 'a', 'án lệ về hợp đồng')])
+    index.flush()
+
+    assert len(index._segments) == segments
+
+
+def test_replaced_document_keeps_only_its_new_postings(index):
+    index.add_documents([('anle_section:1', 'a', 'hợp đồng mua bán')])
+    index.flush()
+    index.add_documents([('anle_section:1', 'b', 'thừa kế quyền sử dụng đất')])
+    index.flush()
+
+    assert len(index) == 1
+    assert index.search('mua bán') == []
+    assert keys(index.search('thừa kế')) == ['anle_section:1']
+
+
+def test_replace_group_deletes_the_missing_documents(index):
+    index.replace_group('vbpl_toan_van:1', [('vbpl_toan_van:1:1', 'a', 'điều một'),
+                                            ('vbpl_toan_van:1:2', 'b', 'điều hai phạt tiền')])
+    index.flush()
+
+    index.replace_group('vbpl_toan_van:1', [('vbpl_toan_van:1:1', 'a', 'điều một')])
+    index.flush()
+
+    assert len(index) == 1
+    assert index.search('phạt tiền') == []
+
+
+def test_replace_group_deletes_the_missing_pending_documents(index):
+    index.replace_group('vbpl_toan_van:1', [('vbpl_toan_van:1:1', 'a', 'điều một'),
+                                            ('vbpl_toan_van:1:2', 'b', 'điều hai phạt tiền')])
+    # replaced again before the first version is flushed
+    index.replace_group('vbpl_toan_van:1', [('vbpl_toan_van:1:1', 'c', 'điều một sửa đổi')])
+    index.flush()
+
+    assert len(index) == 1
+    assert index.search('phạt tiền') == []
+    assert keys(index.search('sửa đổi')) == ['vbpl_toan_van:1:1']
+
+
+def test_replace_group_keeps_the_other_groups(index):
+    index.add_documents([('vbpl_toan_van:1:1', 'a', 'điều một'), ('vbpl_toan_van:12:1', 'b', 'điều một')])
+    index.flush()
+
+    index.replace_group('vbpl_toan_van:1', [])
+    index.flush()
+
+    assert keys(index.search('điều')) == ['vbpl_toan_van:12:1']
+
+
+def test_delete_documents(index):
+    index.add_documents([('anle_section:1', 'a', 'hợp đồng'), ('anle_section:2', 'b', 'hợp đồng vay')])
+    index.flush()
+
+    index.delete_documents(['anle_section:1'])
+    index.flush()
+
+    assert keys(index.search('hợp đồng')) == ['anle_section:2']
+
+
+def test_merge_drops_deleted_documents(index):
+    for version in range(3):
+        index.add_documents([('anle_section:1', str(version), f'hợp đồng phiên bản {version}'),
+                             (f'anle_section:{version + 2}', 'x', 'hợp đồng')])
+        index.flush()
+
+    index.merge()
+
+    assert len(index._segments) == 1
+    assert len(index) == 4
+    assert sorted(keys(index.search('hợp đồng'))) == ['anle_section:1', 'anle_section:2', 'anle_section:3',
+                                                      'anle_section:4']
+
+
+def test_reopen_reads_the_segments(index):
+    index.add_documents([('anle_section:1', 'a', 'hợp đồng'), ('anle_section:2', 'b', 'thừa kế')])
+    index.flush()
+    index.delete_documents(['anle_section:2'])
+    index.flush()
+
+    reopened = SearchIndex(index.path)
+    try:
+        assert len(reopened) == 1
+        assert keys(reopened.search('hợp đồng')) == ['anle_section:1']
+        assert reopened.search('thừa kế') == []
+    finally:
+        reopened.close()
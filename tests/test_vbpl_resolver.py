@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app.helper.vbpl_resolver import VbplResolver, extract_serial_numbers, extract_years, resolver_key
+
+
+def vbpl(title, sub_title=None, serial_number=None):
+    return SimpleNamespace(title=title, sub_title=sub_title, serial_number=serial_number)
+
+
+@pytest.fixture
+def resolver():
+    # filled by hand instead of loading the vbpl table
+    resolver = VbplResolver()
+    resolver._loaded = True
+    resolver._set(1, vbpl('Nghị định 43/2014/NĐ-CP quy định chi tiết thi hành một số điều của Luật Đất đai',
+                          serial_number='43/2014/NĐ-CP'))
+    resolver._set(2, vbpl('Luật Đất đai 2013', serial_number='45/2013/QH13'))
+    resolver._set(3, vbpl('Luật Đất đai 2003', serial_number='13/2003/QH11'))
+    resolver._set(4, vbpl('Thông tư 01/2015/TT-BTC', sub_title='Hướng dẫn thuế', serial_number='01/2015/TT-BTC'))
+    resolver._set(5, vbpl('Thông tư 01/2015/TT-BTC', serial_number='01/2015/TT-BTC'))
+    return resolver
+
+
+def test_resolver_key_ignores_case_punctuation_and_diacritics():
+    assert resolver_key('Nghị định 43/2014/NĐ-CP') == 'nghi dinh 43 2014 nd cp'
+    assert resolver_key('  NGHỊ ĐỊNH   43/2014/nđ-cp ') == 'nghi dinh 43 2014 nd cp'
+    assert resolver_key('Luật Đất đai', fold=False) != resolver_key('Luật Đất đai')
+
+
+def test_extract_serial_numbers_and_years():
+    assert extract_serial_numbers('Nghị định 43/2014/NĐ-CP về đất đai') == ['43/2014/NĐ-CP']
+    assert extract_serial_numbers('Văn bản hợp nhất 01/VBHN-BTP') == ['01/VBHN-BTP']
+    assert extract_serial_numbers(None) == []
+    assert extract_years('Luật Đất đai 2013, sửa đổi năm 2018 theo 35/2018/QH14') == {'2013', '2018'}
+    assert extract_years('số 120345') == set()
+
+
+def test_lookup_exact_then_folded(resolver):
+    assert resolver.lookup('Luật Đất đai 2013') == {2}
+    assert resolver.lookup('luat dat dai 2013') == {2}
+    assert resolver.lookup('45/2013/QH13') == {2}
+    assert resolver.lookup('Hướng dẫn thuế') == {4}
+    assert resolver.lookup('Luật nhà ở') == set()
+    assert resolver.lookup('') == set()
+
+
+def test_fuzzy_scores_the_closest_keys(resolver):
+    matches = resolver.fuzzy('Luật Đất đai năm 2013')
+
+    assert matches[0][0] == 2
+    assert all(ratio >= 0.85 for _, ratio in matches)
+    assert resolver.fuzzy('Luật hôn nhân và gia đình') == []
+
+
+def test_resolve_exact_key(resolver):
+    assert resolver.resolve('Luật Đất đai 2003') == 3
+
+
+def test_resolve_ambiguous_key(resolver):
+    # two vbpl have this title and serial number
+    assert resolver.resolve('Thông tư 01/2015/TT-BTC') is None
+
+
+def test_resolve_serial_number_quoted_in_the_text(resolver):
+    assert resolver.resolve('Căn cứ Nghị định số 43/2014/NĐ-CP ngày 15 tháng 5 năm 2014') == 1
+
+
+def test_resolve_fuzzy_match_needs_the_serial_number_and_years(resolver):
+    # no serial number column, the serial number is only quoted in the title
+    resolver._set(7, vbpl('Quyết định 15/2020/QĐ-UBND ban hành quy chế quản lý nhà nước về giá trên địa bàn tỉnh'))
+
+    assert resolver.resolve('Quyết định số 15/2020/QĐ-UBND ban hành quy chế quản lý về giá trên địa bàn tỉnh') == 7
+    assert resolver.resolve('Quyết định số 15/2021/QĐ-UBND ban hành quy chế quản lý về giá trên địa bàn tỉnh') is None
+    # as close to the title of 2, but without a serial number the fuzzy match is not trusted
+    assert resolver.fuzzy('Luật Đất đai năm 2013')[0][0] == 2
+    assert resolver.resolve('Luật Đất đai năm 2013') is None
+
+
+def test_add_after_load(resolver):
+    resolver.add(6, vbpl('Luật Nhà ở 2014', serial_number='65/2014/QH13'))
+
+    assert resolver.resolve('Luật Nhà ở 2014') == 6
+    assert resolver.lookup('65/2014/QH13') == {6}